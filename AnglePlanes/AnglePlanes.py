@@ -1,15 +1,22 @@
+import concurrent.futures
+import itertools
 import json
 import logging
 import numpy
 import os
 import pickle
+import queue
 import time
 import vtk, qt, ctk, slicer
 
-from math import acos, pi, sqrt
+from collections import OrderedDict
 
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
+from AnglePlanesLib import geometry, meshes, uncertainty
+from AnglePlanesLib.instrumentation import instrumentation
+from AnglePlanesLib.landmarks import Landmark, LandmarkRegistry
+from vtk.util.numpy_support import vtk_to_numpy
 
 
 class AnglePlanes(ScriptedLoadableModule):
@@ -60,6 +67,7 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.planeControlsId = 0
         self.planeControlsDictionary = {}
         self.planeCollection = vtk.vtkPlaneCollection()
+        self.boxBounds = None
         self.ignoredNodeNames = ('Red Volume Slice', 'Yellow Volume Slice', 'Green Volume Slice')
         self.colorSliceVolumes = dict()
         self.interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
@@ -76,6 +84,8 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.treeView.header().setVisible(False)
         self.autoChangeLayout = self.ui.autoChangeLayout
         self.computeBox = self.ui.computeBox
+        self.memoryBudgetSpinBox = self.ui.memoryBudgetSpinBox
+        self.memoryUsageLabel = self.ui.memoryUsageLabel
         # -------------------------------Manage planes---------------------------------
         self.CollapsibleButton = self.ui.CollapsibleButton
         self.managePlanesFormLayout = self.ui.managePlanesFormLayout
@@ -122,12 +132,34 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.tableResult.setCellWidget(1, 1, self.getAngle_SI_comp)
         self.tableResult.setCellWidget(2, 0, self.getAngle_AP)
         self.tableResult.setCellWidget(2, 1, self.getAngle_AP_comp)
+        self.liveAnglesCheckBox = self.ui.liveAnglesCheckBox
+        self.angleTracker = AnglePlanesAngleTracker(self.updateAngleLabels)
+        self.allPairsButton = self.ui.allPairsButton
+        self.allPairsTable = self.ui.allPairsTable
+        self.uncertaintySDSpinBox = self.ui.uncertaintySDSpinBox
+        self.uncertaintySamplesSpinBox = self.ui.uncertaintySamplesSpinBox
+        self.uncertaintyReprojectCheckBox = self.ui.uncertaintyReprojectCheckBox
+        self.uncertaintyButton = self.ui.uncertaintyButton
+        self.uncertaintyTable = self.ui.uncertaintyTable
         # -------------------------------- PLANES --------------------------------#
         self.CollapsibleButton3 = self.ui.CollapsibleButton3
         self.save = self.ui.save
         self.read = self.ui.read
+        # -------------------------------- DIAGNOSTICS --------------------------------#
+        self.diagnosticsCollapsibleButton = self.ui.diagnosticsCollapsibleButton
+        self.recordTimingsCheckBox = self.ui.recordTimingsCheckBox
+        self.diagnosticsTable = self.ui.diagnosticsTable
+        self.diagnosticsCountersLabel = self.ui.diagnosticsCountersLabel
+        self.resetDiagnosticsButton = self.ui.resetDiagnosticsButton
+        self.recordJournalButton = self.ui.recordJournalButton
+        self.replayJournalButton = self.ui.replayJournalButton
+        self.replayAtRecordedSpeedCheckBox = self.ui.replayAtRecordedSpeedCheckBox
+        self.journalLabel = self.ui.journalLabel
+        self.diagnosticsTimer = qt.QTimer()
+        self.diagnosticsTimer.setInterval(500)
         #-------------------------------- CONNECTIONS --------------------------------#
         self.computeBox.connect('clicked()', self.onComputeBox)
+        self.memoryBudgetSpinBox.connect('valueChanged(int)', self.onMemoryBudgetChanged)
         self.inputModelSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onModelChanged)
         self.inputLandmarksSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onLandmarksChanged)
         self.planeComboBox1.connect('currentIndexChanged(QString)', self.valueComboBox)
@@ -138,10 +170,19 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.selectPlaneForMidPoint.connect('currentIndexChanged(int)', self.onChangeMiddlePointFiducialNode)
         self.defineMiddlePointButton.connect('clicked()', self.onAddMidPoint)
         self.results.connect('clicked()', self.angleValue)
+        self.liveAnglesCheckBox.connect('toggled(bool)', self.onLiveAnglesToggled)
+        self.allPairsButton.connect('clicked()', self.onComputeAllPairs)
+        self.uncertaintyButton.connect('clicked()', self.onEstimateUncertainty)
         self.save.connect('clicked(bool)', self.onSavePlanes)
         self.read.connect('clicked(bool)', self.onReadPlanes)
+        self.recordTimingsCheckBox.connect('toggled(bool)', self.onRecordTimingsToggled)
+        self.resetDiagnosticsButton.connect('clicked()', self.onResetDiagnostics)
+        self.recordJournalButton.connect('toggled(bool)', self.onRecordJournalToggled)
+        self.replayJournalButton.connect('clicked()', self.onReplayJournal)
+        self.diagnosticsTimer.connect('timeout()', self.updateDiagnostics)
 
         slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onCloseScene)
+        slicer.mrmlScene.AddObserver(slicer.mrmlScene.StartSaveEvent, self.onStartSaveScene)
 
         for i in self.getPositionOfModelNodes(False):
             modelnode = slicer.mrmlScene.GetNthNodeByClass(i, "vtkMRMLModelNode")
@@ -151,6 +192,8 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self.nodeRemovedCallback)
 
         # ------------------------------ INITIALISATION ---------------------------------
+        self.logic.memoryBudget.listeners.append(self.updateMemoryUsageLabel)
+        self.onMemoryBudgetChanged(self.memoryBudgetSpinBox.value)
         self.fillColorsComboBox(self.planeComboBox1)
         self.fillColorsComboBox(self.planeComboBox2)
         self.planeComboBox1.setCurrentIndex(0)
@@ -166,9 +209,14 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         Called when the application closes and the module widget is destroyed.
         """
+        self.diagnosticsTimer.stop()
+        self.angleTracker.removeObservers()
+        self.logic.projectionWorker.shutdown()
         self.removeObservers()
 
     def enter(self):
+        # the landmark descriptions may have been modified by other modules
+        self.logic.resetLandmarkRegistries()
         model = self.inputModelSelector.currentNode()
         fidlist = self.inputLandmarksSelector.currentNode()
 
@@ -184,15 +232,19 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         end = list.GetNumberOfItems()
         for i in range(0,end):
             fidList = list.GetItemAsObject(i)
-            landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            if landmarkDescription:
+            registry = self.logic.getLandmarkRegistry(fidList)
+            if registry:
                 for n in range(fidList.GetNumberOfMarkups()):
                     markupID = fidList.GetNthMarkupID(n)
                     markupLabel = fidList.GetNthMarkupLabel(n)
-                    landmarkDescription[markupID]["landmarkLabel"] = markupLabel
-                fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+                    registry.setLabel(markupID, markupLabel)
+
+    def exit(self):
+        # write the landmark descriptions back so that other modules read them up to date
+        self.logic.syncLandmarkRegistries()
 
     def UpdateInterface(self):
+        self.logic.recordUIState("landmarkSelected", None, label=self.landmarkComboBox.currentText)
         self.logic.UpdateThreeDView(self.landmarkComboBox.currentText)
 
     @vtk.calldata_type(vtk.VTK_OBJECT)
@@ -205,10 +257,13 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     @vtk.calldata_type(vtk.VTK_OBJECT)
     def nodeRemovedCallback(self, caller, eventId, callData):
         if isinstance(callData, slicer.vtkMRMLModelNode):
+            self.logic.releaseModel(callData.GetID())
             self.removeObserver(callData, callData.PolyDataModifiedEvent, self.onModelNodePolyDataModified)
             callData.RemoveObservers(callData.DisplayModifiedEvent)
             self.updateOnSurfaceCheckBoxes()
         if isinstance(callData, slicer.vtkMRMLMarkupsFiducialNode):
+            self.logic.landmarkRegistries.pop(callData.GetID(), None)
+            self.logic.ROIUnions.pop(callData.GetID(), None)
             name = callData.GetName()
             planeid = name[len('P'):]
             name = "Plane " + planeid
@@ -218,8 +273,17 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def onModelNodePolyDataModified(self, caller, eventId):
         pass
 
+    def onMemoryBudgetChanged(self, value):
+        self.logic.memoryBudget.setBudget(value * 1024 * 1024)
+
+    def updateMemoryUsageLabel(self):
+        usageByKind = self.logic.memoryBudget.usageByKind()
+        self.memoryUsageLabel.setText("Used: %.1f MB" % (self.logic.memoryBudget.usage() / 1048576.0))
+        self.memoryUsageLabel.setToolTip("\n".join("%s: %.1f MB" % (kind, size / 1048576.0)
+                                                   for kind, size in sorted(usageByKind.items())))
+
     def onModelChanged(self):
-        print("-------Model Changed--------")
+        logging.debug("Model changed")
         if self.logic.selectedModel:
             Model = self.logic.selectedModel
             try:
@@ -227,16 +291,20 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             except:
                 pass
         self.logic.selectedModel = self.inputModelSelector.currentNode()
+        self.logic.recordEvent("modelSelected", model=self.logic.selectedModel.GetID() if self.logic.selectedModel else None)
         self.logic.ModelChanged(self.inputModelSelector, self.inputLandmarksSelector)
         self.inputLandmarksSelector.setCurrentNode(None)
         self.addPlaneButton.setEnabled(False)
 
     def onLandmarksChanged(self):
-        print("-------Landmarks Changed--------")
+        logging.debug("Landmarks changed")
+        landmarks = self.inputLandmarksSelector.currentNode()
+        self.logic.recordEvent("landmarksSelected", node=landmarks.GetID() if landmarks else None)
         if self.inputModelSelector.currentNode():
             self.logic.FidList = self.inputLandmarksSelector.currentNode()
             self.logic.selectedFidList = self.inputLandmarksSelector.currentNode()
             self.logic.selectedModel = self.inputModelSelector.currentNode()
+            self.logic.updateProtectedModels()
             if self.inputLandmarksSelector.currentNode():
                 onSurface = self.loadLandmarksOnSurfacCheckBox.isChecked()
                 self.logic.connectLandmarks(self.inputModelSelector,
@@ -254,19 +322,21 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         fidList = self.logic.selectedFidList
         if not fidList:
             return
-        selectedFidReflID = self.logic.findIDFromLabel(fidList, self.landmarkComboBox.currentText)
+        registry = self.logic.getLandmarkRegistry(fidList)
+        selectedFidReflID = registry.findID(self.landmarkComboBox.currentText)
+        landmark = registry.get(selectedFidReflID)
+        if landmark is None:
+            return
         isOnSurface = self.surfaceDeplacementCheckBox.isChecked()
-        landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
         if isOnSurface:
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-            landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = True
-            landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] =\
-                self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID)
+            hardenModel = self.logic.getHardenModel(fidList)
+            landmark.isProjected = True
+            landmark.closestPointIndex = self.logic.projectOnSurface(hardenModel, fidList, selectedFidReflID)
         else:
-            landmarkDescription[selectedFidReflID]["projection"]["isProjected"] = False
-            landmarkDescription[selectedFidReflID]["projection"]["closestPointIndex"] = None
-            landmarkDescription[selectedFidReflID]["ROIradius"] = 0
-        fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+            landmark.isProjected = False
+            landmark.closestPointIndex = None
+            landmark.ROIradius = 0
+        registry.markModified()
 
     def onChangeMiddlePointFiducialNode(self):
         key = self.selectPlaneForMidPoint.currentText
@@ -291,7 +361,7 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 if self.planeControlsDictionary[x].PlaneIsDefined():
                     planeComboBox.addItem(x)
         except NameError:
-            print("exept in fillColorsComboBox")
+            logging.warning("Cannot list the planes in fillColorsComboBox")
 
     def updateOnSurfaceCheckBoxes(self):
         numberOfVisibleModels = len(self.getPositionOfModelNodes(True))
@@ -313,11 +383,12 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         return positionOfNodes
 
     def addNewPlane(self, keyLoad=-1):
-        print("------- New plane created -------")
+        logging.debug("New plane created")
         if keyLoad != -1:
             self.planeControlsId = keyLoad
         else:
             self.planeControlsId += 1
+            self.logic.recordEvent("planeAdded", id=self.planeControlsId)
         planeControls = AnglePlanesWidgetPlaneControl(self,
                                                       self.planeControlsId,
                                                       self.planeCollection,
@@ -330,13 +401,13 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.selectPlaneForMidPoint.addItem(key)
 
     def RemoveManualPlane(self, id):
-        print("--- Remove a plan ---")
+        logging.debug("Remove a plane")
         key = "Plane " + str(id)
         # If the plane has already been removed (for example, when removing this plane in this function,
         # the callback on removing the nodes will be called, and therefore this function will be called again
         # We need to not do anything the second time this function is called for the same plane
         if key not in self.planeControlsDictionary.keys():
-            print("Key error")
+            logging.debug("Plane %s already removed", key)
             return
         if self.planeComboBox1.currentText == key:
             self.planeComboBox1.setCurrentIndex(0)
@@ -357,6 +428,7 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         if self.selectPlaneForMidPoint.findText(key) > -1:
             self.selectPlaneForMidPoint.removeItem(self.selectPlaneForMidPoint.findText(key))
 
+    @instrumentation.timed()
     def onComputeBox(self):
         positionOfVisibleNodes = self.getPositionOfModelNodes(True)
         if len(positionOfVisibleNodes) == 0:
@@ -368,11 +440,9 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         bound = [maxValue, -maxValue, maxValue, -maxValue, maxValue, -maxValue]
         for i in positionOfVisibleNodes:
             node = slicer.mrmlScene.GetNthNodeByClass(i, "vtkMRMLModelNode")
-            model = self.logic.createIntermediateHardenModel(node)
-            polydata = model.GetPolyData()
-            if polydata is None or not hasattr(polydata, "GetBounds"):
+            tempbound = self.logic.getModelBounds(node)
+            if tempbound is None:
                 continue
-            tempbound = polydata.GetBounds()
             bound[0] = min(bound[0], tempbound[0])
             bound[2] = min(bound[2], tempbound[2])
             bound[4] = min(bound[4], tempbound[4])
@@ -388,6 +458,7 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             origin.append(bound[x * 2] + int(dim[x] / 2))
             dim[x] *= 1.1
         # ---------definition of planes for clipping around the bounding box ---------#
+        self.boxBounds = bound
         self.planeCollection = vtk.vtkPlaneCollection()
         self.planeXmin = vtk.vtkPlane()
         self.planeXmin.SetOrigin(bound[0],bound[2],bound[4])
@@ -472,6 +543,16 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         sampleVolumeNode.SetSaveWithScene(False)
         return sampleVolumeNode
 
+    def clipPlanesToBox(self, planeControlsList):
+        # all the planes adapted to the bounding box are clipped in one call
+        if not planeControlsList:
+            return
+        origins = [planeControls.planeSource.GetCenter() for planeControls in planeControlsList]
+        normals = [planeControls.planeSource.GetNormal() for planeControls in planeControlsList]
+        polygons = geometry.clipPlanesWithBox(origins, normals, self.boxBounds)
+        for planeControls, polygon in zip(planeControlsList, polygons):
+            planeControls.setClippedPolygon(polygon)
+
     def onAddMidPoint(self):
         key = self.selectPlaneForMidPoint.currentText
         plane = self.planeControlsDictionary[key]
@@ -484,37 +565,39 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         fidList.AddFiducial(coord[0],coord[1],coord[2])
         fidList.SetNthFiducialSelected(fidList.GetNumberOfMarkups() - 1, False)
         # update of the data structure
-        landmarkDescription = self.logic.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+        registry = self.logic.getLandmarkRegistry(fidList)
         numOfMarkups = fidList.GetNumberOfMarkups()
         markupID = fidList.GetNthMarkupID(numOfMarkups - 1)
-        landmarkDescription[landmark1ID]["midPoint"]["definedByThisMarkup"].append(markupID)
-        landmarkDescription[landmark2ID]["midPoint"]["definedByThisMarkup"].append(markupID)
-        landmarkDescription[markupID]["midPoint"]["isMidPoint"] = True
-        landmarkDescription[markupID]["midPoint"]["Point1"] = landmark1ID
-        landmarkDescription[markupID]["midPoint"]["Point2"] = landmark2ID
-        landmarkDescription[markupID]["projection"]["isProjected"] = False
-        landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
+        registry.addMidPoint(markupID, landmark1ID, landmark2ID)
+        midPoint = registry.get(markupID)
+        midPoint.isProjected = False
+        midPoint.closestPointIndex = None
         if self.midPointOnSurfaceCheckBox.isChecked():
-            landmarkDescription[markupID]["projection"]["isProjected"] = True
-            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-            landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                self.logic.projectOnSurface(hardenModel, fidList, markupID)
-        else:
-            landmarkDescription[markupID]["projection"]["isProjected"] = False
-        fidList.SetAttribute("landmarkDescription",self.logic.encodeJSON(landmarkDescription))
+            midPoint.isProjected = True
+            hardenModel = self.logic.getHardenModel(fidList)
+            midPoint.closestPointIndex = self.logic.projectOnSurface(hardenModel, fidList, markupID)
+        registry.markModified()
         self.logic.interface.UpdateInterface()
         self.logic.updateLandmarkComboBox(fidList, self.landmarkComboBox, False)
         fidList.SetNthFiducialPositionFromArray(numOfMarkups - 1, coord)
 
+    def onStartSaveScene(self, obj, event):
+        self.logic.syncLandmarkRegistries()
+
     def onCloseScene(self, obj, event):
+        self.logic.pointModifiedScheduler.cancel()
+        self.logic.projectionWorker.cancel()
         self.colorSliceVolumes = dict()
+        self.logic.locatorCache.clear()
+        self.logic.adjacencyCache.clear()
+        self.logic.ROIUnions = dict()
+        self.logic.landmarkRegistries = dict()
+        self.logic.boundsCache = dict()
+        self.logic.sliceNormals = dict()
+        self.logic.hardenedGeometry.clear()
         self.planeControlsId = 0
-        models = slicer.mrmlScene.GetNodesByClass("vtkMRMLModelNode")
-        end = models.GetNumberOfItems()
-        for i in range(0,end):
-            model = models.GetItemAsObject(i)
-            hardenModel = slicer.mrmlScene.GetNodesByName(model.GetName()).GetItemAsObject(0)
-            slicer.mrmlScene.RemoveNode(hardenModel)
+        # the hardened copies were removed with the scene
+        self.logic.memoryBudget.clear()
         keys = list(self.planeControlsDictionary.keys())
         for x in keys:
             self.RemoveManualPlane(x[len('Plane '):])
@@ -526,16 +609,45 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.getAngle_SI_comp.setText("0")
         self.getAngle_AP.setText("0")
         self.getAngle_AP_comp.setText("0")
+        self.allPairsTable.setRowCount(0)
+        self.uncertaintyTable.clearContents()
         self.landmarkComboBox.clear()
 
     def angleValue(self):
         self.valueComboBox()
-        self.getAngle_RL.setText(self.logic.angle_degre_RL)
-        self.getAngle_RL_comp.setText(self.logic.angle_degre_RL_comp)
-        self.getAngle_SI.setText(self.logic.angle_degre_SI)
-        self.getAngle_SI_comp.setText(self.logic.angle_degre_SI_comp)
-        self.getAngle_AP.setText(self.logic.angle_degre_AP)
-        self.getAngle_AP_comp.setText(self.logic.angle_degre_AP_comp)
+        self.showAngles()
+
+    def showAngles(self):
+        self.setLabelText(self.getAngle_RL, self.logic.angle_degre_RL)
+        self.setLabelText(self.getAngle_RL_comp, self.logic.angle_degre_RL_comp)
+        self.setLabelText(self.getAngle_SI, self.logic.angle_degre_SI)
+        self.setLabelText(self.getAngle_SI_comp, self.logic.angle_degre_SI_comp)
+        self.setLabelText(self.getAngle_AP, self.logic.angle_degre_AP)
+        self.setLabelText(self.getAngle_AP_comp, self.logic.angle_degre_AP_comp)
+
+    def setLabelText(self, label, value):
+        # the label is only repainted when the displayed value changes
+        text = str(value)
+        if label.text != text:
+            label.setText(text)
+
+    def updateAngleLabels(self):
+        # called by the angle tracker, at most maxRate times per second
+        colorPlane1 = self.planeComboBox1.currentText
+        colorPlane2 = self.planeComboBox2.currentText
+        if colorPlane1 == "None" or colorPlane2 == "None":
+            return
+        self.defineAngle(colorPlane1, colorPlane2)
+        self.showAngles()
+
+    def trackSelectedPlanes(self, colorPlane1, colorPlane2):
+        planeNames = [name for name in (colorPlane1, colorPlane2) if name != "None"]
+        sliceNodes = [self.logic.getSliceNode(name) for name in planeNames
+                      if name in self.logic.ColorNodeCorrespondence]
+        self.angleTracker.setPlanes(planeNames, sliceNodes)
+
+    def onLiveAnglesToggled(self, checked):
+        self.angleTracker.setEnabled(checked)
 
     def setFirstItemInComboBoxNotGivenString(self, comboBox, oldString, noThisString):
         if comboBox.findText(oldString) == -1:
@@ -544,7 +656,7 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             comboBox.setCurrentIndex(comboBox.findText(oldString))
 
     def updatePlanesComboBoxes(self):
-        print("---- update plane combobox ----")
+        logging.debug("Update plane combobox")
         self.planeComboBox1.blockSignals(True)
         self.planeComboBox2.blockSignals(True)
         colorPlane1 = self.planeComboBox1.currentText
@@ -563,28 +675,30 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def valueComboBox(self):
         self.updatePlanesComboBoxes()
-        # Hide everything before showing what is necessary
-        for x in self.logic.ColorNodeCorrespondence.keys():
-            compNode = slicer.util.getNode('vtkMRMLSliceCompositeNode' + x)
-            compNode.SetLinkedControl(False)
-            slice = slicer.mrmlScene.GetNodeByID(self.logic.ColorNodeCorrespondence[x])
-            slice.SetWidgetVisible(False)
-            slice.SetSliceVisible(False)
+        self.logic.recordUIState("planesSelected", None,
+                                 planes=[self.planeComboBox1.currentText, self.planeComboBox2.currentText])
         colorPlane1 = self.planeComboBox1.currentText
         colorPlane2 = self.planeComboBox2.currentText
+        # only the selected slices are shown, the nodes are not modified when their visibility does not change
+        for x in self.logic.ColorNodeCorrespondence.keys():
+            compNode = slicer.mrmlScene.GetNodeByID('vtkMRMLSliceCompositeNode' + x)
+            compNode.SetLinkedControl(False)
+            slice = self.logic.getSliceNode(x)
+            visible = x in (colorPlane1, colorPlane2)
+            slice.SetWidgetVisible(visible)
+            slice.SetSliceVisible(visible)
         self.defineAngle(colorPlane1, colorPlane2)
+        self.trackSelectedPlanes(colorPlane1, colorPlane2)
 
     def defineAngle(self, colorPlane1, colorPlane2):
-        print("--- defineAngle ---")
+        logging.debug("defineAngle")
         # print colorPlane1
         if colorPlane1 != "None":
             if colorPlane1 in self.logic.ColorNodeCorrespondence:
-                slice1 = slicer.util.getNode(self.logic.ColorNodeCorrespondence[colorPlane1])
-                self.logic.getMatrix(slice1)
+                slice1 = self.logic.getSliceNode(colorPlane1)
                 slice1.SetWidgetVisible(True)
                 slice1.SetSliceVisible(True)
-                matrix1 = self.logic.getMatrix(slice1)
-                normal1 = self.logic.defineNormal(matrix1)
+                normal1 = self.logic.getSliceNormal(slice1)
             else:
                 normal1 = self.planeControlsDictionary[colorPlane1].normal
         else:
@@ -592,22 +706,136 @@ class AnglePlanesWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # print colorPlane2
         if colorPlane2 != "None":
             if colorPlane2 in self.logic.ColorNodeCorrespondence:
-                slice2 = slicer.util.getNode(self.logic.ColorNodeCorrespondence[colorPlane2])
-                self.logic.getMatrix(slice2)
+                slice2 = self.logic.getSliceNode(colorPlane2)
                 slice2.SetWidgetVisible(True)
                 slice2.SetSliceVisible(True)
-                matrix2 = self.logic.getMatrix(slice2)
-                normal2 = self.logic.defineNormal(matrix2)
+                normal2 = self.logic.getSliceNormal(slice2)
             else:
                 normal2 = self.planeControlsDictionary[colorPlane2].normal
         else:
             return
-        print("normal 1")
-        print(normal1)
-        print("normal 2")
-        print(normal2)
+        logging.debug("normal 1: %s, normal 2: %s", normal1, normal2)
         self.logic.getAngle(normal1, normal2)
 
+    def getPlaneNormals(self):
+        """Names and (N, 3) array of normals of the slice planes and of the defined landmark planes"""
+        names = []
+        normals = []
+        for colorPlane in ["Red", "Yellow", "Green"]:
+            names.append(colorPlane)
+            normals.append(self.logic.getPlaneNormal(self.logic.getSliceNormal(self.logic.getSliceNode(colorPlane))))
+        for key, planeControls in self.planeControlsDictionary.items():
+            if planeControls.PlaneIsDefined() and planeControls.normal is not None:
+                names.append(key)
+                normals.append(self.logic.getPlaneNormal(planeControls.normal))
+        return names, numpy.array(normals).reshape(-1, 3)
+
+    def onComputeAllPairs(self):
+        names, normals = self.getPlaneNormals()
+        angles = self.logic.computeAngleMatrices(normals)
+        columns = ["3D", "RL", "RL_comp", "SI", "SI_comp", "AP", "AP_comp"]
+        firstPlanes, secondPlanes = numpy.triu_indices(len(names), 1)
+        self.allPairsTable.setRowCount(len(firstPlanes))
+        for row, (i, j) in enumerate(zip(firstPlanes.tolist(), secondPlanes.tolist())):
+            self.allPairsTable.setItem(row, 0, qt.QTableWidgetItem(names[i]))
+            self.allPairsTable.setItem(row, 1, qt.QTableWidgetItem(names[j]))
+            for column, key in enumerate(columns):
+                angle = angles[key][i, j]
+                text = "-" if numpy.isnan(angle) else "%.2f" % angle
+                self.allPairsTable.setItem(row, column + 2, qt.QTableWidgetItem(text))
+
+    def getUncertaintyPlane(self, name):
+        # fixed normal of a slice, (fiducial list, labels) of a landmark plane
+        if name in self.logic.ColorNodeCorrespondence:
+            return self.logic.getPlaneNormal(self.logic.getSliceNormal(self.logic.getSliceNode(name)))
+        planeControls = self.planeControlsDictionary.get(name)
+        if planeControls is None or not planeControls.PlaneIsDefined():
+            return None
+        return (planeControls.fidlist, [planeControls.landmark1ComboBox.currentText,
+                                        planeControls.landmark2ComboBox.currentText,
+                                        planeControls.landmark3ComboBox.currentText])
+
+    def onEstimateUncertainty(self):
+        self.uncertaintyTable.clearContents()
+        planes = [self.getUncertaintyPlane(self.planeComboBox1.currentText),
+                  self.getUncertaintyPlane(self.planeComboBox2.currentText)]
+        if None in planes:
+            self.logic.warningMessage("Select two planes defined by landmarks or slices.")
+            return
+        distributions = self.logic.estimateAngleUncertainty(planes, self.uncertaintySDSpinBox.value,
+                                                            self.uncertaintySamplesSpinBox.value,
+                                                            self.uncertaintyReprojectCheckBox.isChecked())
+        if distributions is None:
+            return
+        for row, summary in enumerate(distributions.values()):
+            for column, value in enumerate(summary.values()):
+                text = "-" if numpy.isnan(value) else "%.2f" % value
+                self.uncertaintyTable.setItem(row, column, qt.QTableWidgetItem(text))
+
+    def onRecordTimingsToggled(self, checked):
+        instrumentation.setEnabled(checked)
+        if checked:
+            self.diagnosticsTimer.start()
+        else:
+            self.diagnosticsTimer.stop()
+            self.updateDiagnostics()
+
+    def onResetDiagnostics(self):
+        instrumentation.reset()
+        self.logic.pointModifiedScheduler.resetCounters()
+        self.logic.projectionWorker.resetCounters()
+        self.angleTracker.resetCounters()
+        self.updateDiagnostics()
+
+    def updateDiagnostics(self):
+        if self.diagnosticsCollapsibleButton.collapsed:
+            return
+        levels = u"\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+        rows = instrumentation.summary()
+        self.diagnosticsTable.setRowCount(len(rows))
+        for row, timing in enumerate(rows):
+            counts = instrumentation.histogram(timing["name"])[0]
+            histogram = "".join(levels[int(round(count * 7.0 / max(counts.max(), 1)))] for count in counts)
+            values = [timing["name"], str(timing["calls"])] + \
+                     ["%.2f" % timing[key] for key in ["last", "mean", "median", "p95", "max"]] + [histogram]
+            for column, value in enumerate(values):
+                self.diagnosticsTable.setItem(row, column, qt.QTableWidgetItem(value))
+        counters = dict(instrumentation.counters)
+        counters.update(("point modified events " + key, value)
+                        for key, value in self.logic.pointModifiedScheduler.counters().items())
+        counters.update(("projection requests " + key, value)
+                        for key, value in self.logic.projectionWorker.counters().items())
+        counters.update(("angle updates " + key, value) for key, value in self.angleTracker.counters().items())
+        self.diagnosticsCountersLabel.setText(", ".join("%s: %d" % item for item in sorted(counters.items())))
+
+    def onRecordJournalToggled(self, checked):
+        if checked:
+            self.logic.startRecording()
+            self.journalLabel.setText("Recording...")
+            return
+        journal = self.logic.stopRecording()
+        if journal is None:
+            return
+        filename = qt.QFileDialog.getSaveFileName(self.parent, "Save the journal", "", "Journal (*.jsonl)")
+        if filename:
+            journal.save(filename)
+            self.journalLabel.setText("%d events saved in %s" % (len(journal.entries), filename))
+
+    def onReplayJournal(self):
+        filename = qt.QFileDialog.getOpenFileName(self.parent, "Replay a journal", "", "Journal (*.jsonl)")
+        if not filename:
+            return
+        speed = 1.0 if self.replayAtRecordedSpeedCheckBox.isChecked() else None
+        player = AnglePlanesJournalPlayer(self.logic, self)
+        latencies = player.replay(AnglePlanesJournal.load(filename), speed)
+        with open(os.path.splitext(filename)[0] + "_latencies.json", "w") as latencyFile:
+            json.dump(latencies, latencyFile)
+        summary = player.summarize(latencies)
+        self.journalLabel.setText("\n".join("%s: %d events, mean %.1f ms, p95 %.1f ms, max %.1f ms"
+                                             % (kind, values["count"], values["mean"], values["p95"], values["max"])
+                                             for kind, values in summary.items()))
+        self.updateDiagnostics()
+
     def onSavePlanes(self):
         self.logic.savePlanes()
 
@@ -630,8 +858,19 @@ class AnglePlanesWidgetPlaneControl(qt.QFrame):
         self.planeCollection = planeCollection
         self.id = id
         self.fidlist = fidlist
-        self.actor = vtk.vtkActor()
         self.normal = None
+        # ------------- pipeline of the plane --------
+        # built once, only its inputs are modified when the landmarks move
+        self.planeSource = vtk.vtkPlaneSource()
+        # polygon of the plane clipped by the bounding box (see geometry.clipPlanesWithBox)
+        self.clippedPolyData = vtk.vtkPolyData()
+        self.clippedPolyData.SetPoints(vtk.vtkPoints())
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.mapper.SetInputConnection(self.planeSource.GetOutputPort())
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+        self.actor.GetProperty().SetColor(0, 0.4, 0.8)
+        self.numberOfViewsWithActor = 0
         # -------------- interface -------------------
         qt.QFrame.__init__(self)
         # UI setup
@@ -699,6 +938,10 @@ class AnglePlanesWidgetPlaneControl(qt.QFrame):
         return listCoord
 
     def placePlaneClicked(self):
+        self.logic.recordUIState("planeLandmarksSelected", self.id, id=self.id,
+                                 labels=[self.landmark1ComboBox.currentText,
+                                         self.landmark2ComboBox.currentText,
+                                         self.landmark3ComboBox.currentText])
         self.anglePlanes.valueComboBox()
         self.update()
 
@@ -707,23 +950,56 @@ class AnglePlanesWidgetPlaneControl(qt.QFrame):
         self.update()
 
     def update(self):
+        if self.updatePlane():
+            self.anglePlanes.clipPlanesToBox([self])
+
+    def updatePlane(self):
+        # returns True if the plane still has to be clipped by the bounding box
         self.planeCollection = self.anglePlanes.planeCollection
+        needsClipping = False
         if self.PlaneIsDefined():
+            adaptToBoundingBox = self.AdaptToBoundingBoxCheckBox.isChecked() \
+                                 and self.anglePlanes.boxBounds is not None
+            normal = self.logic.planeLandmarks(self.fidlist,
+                                               self.landmark1ComboBox.currentText,
+                                               self.landmark2ComboBox.currentText,
+                                               self.landmark3ComboBox.currentText,
+                                               self.planeSource, adaptToBoundingBox)
+            if normal is None:
+                return False
+            self.normal = normal
+            if adaptToBoundingBox:
+                if self.mapper.GetInput() is not self.clippedPolyData:
+                    self.mapper.SetInputData(self.clippedPolyData)
+                needsClipping = True
+            else:
+                self.mapper.SetInputConnection(self.planeSource.GetOutputPort())
             if self.HidePlaneCheckBox.isChecked():
-                self.normal = self.logic.planeLandmarks(self.fidlist,
-                                          self.landmark1ComboBox.currentText, self.landmark2ComboBox.currentText,
-                                          self.landmark3ComboBox.currentText, self.normal,
-                                          self.AdaptToBoundingBoxCheckBox,
-                                          0, self.planeCollection, self.actor)
+                self.actor.GetProperty().SetOpacity(0)
             else:
-                self.normal = self.logic.planeLandmarks(self.fidlist,
-                                          self.landmark1ComboBox.currentText, self.landmark2ComboBox.currentText,
-                                          self.landmark3ComboBox.currentText, self.normal,
-                                          self.AdaptToBoundingBoxCheckBox,
-                                          self.slideOpacity.value, self.planeCollection, self.actor)
+                self.actor.GetProperty().SetOpacity(self.slideOpacity.value)
+            # the actor is only added again if 3D views were added to the layout
+            if self.numberOfViewsWithActor != slicer.app.layoutManager().threeDViewCount:
+                self.numberOfViewsWithActor = self.logic.addActorToThreeDViews(self.actor)
+            self.logic.requestRender()
+        return needsClipping
+
+    def setClippedPolygon(self, polygon):
+        points = self.clippedPolyData.GetPoints()
+        points.SetNumberOfPoints(len(polygon))
+        for i, point in enumerate(polygon):
+            points.SetPoint(i, point[0], point[1], point[2])
+        points.Modified()
+        polygons = vtk.vtkCellArray()
+        if len(polygon) >= 3:
+            polygons.InsertNextCell(len(polygon))
+            for i in range(0, len(polygon)):
+                polygons.InsertCellPoint(i)
+        self.clippedPolyData.SetPolys(polygons)
+        self.clippedPolyData.Modified()
 
     def addLandMarkClicked(self):
-        print("Add landmarks")
+        logging.debug("Add landmarks")
         self.anglePlanes.inputModelSelector.setCurrentNode(slicer.app.mrmlScene().GetNodeByID(self.fidlist.GetAttribute("connectedModelID")))
         self.anglePlanes.inputLandmarksSelector.setCurrentNode(self.fidlist)
         # Place landmarks in the 3D scene
@@ -755,6 +1031,690 @@ class AnglePlanesWidgetPlaneControl(qt.QFrame):
         self.actor = None
 
 
+class AnglePlanesMemoryBudget(object):
+    """Byte budget shared by the data the module derives from the models.
+
+    Each cache records its entries here with a kind ("hardenCopy", "locator", "bounds", ...),
+    the ID of the model node they belong to, their size and a callback releasing them.
+    When the total goes over the budget, the least recently used entries are released,
+    except the ones of the protected (i.e. currently selected) models.
+    """
+    def __init__(self, budget=1024 * 1024 * 1024):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.totalSize = 0
+        self.protectedIDs = set()
+        self.listeners = list()
+
+    def record(self, kind, key, size, release):
+        previous = self.entries.pop((kind, key), None)
+        if previous is not None:
+            self.totalSize -= previous[0]
+        self.entries[(kind, key)] = (size, release)
+        self.totalSize += size
+        self.evict((kind, key))
+        self.notify()
+
+    def touch(self, kind, key):
+        if (kind, key) in self.entries:
+            self.entries.move_to_end((kind, key))
+
+    def discard(self, kind, key):
+        entry = self.entries.pop((kind, key), None)
+        if entry is not None:
+            self.totalSize -= entry[0]
+            self.notify()
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.evict()
+        self.notify()
+
+    def setProtectedIDs(self, protectedIDs):
+        self.protectedIDs = set(protectedIDs)
+
+    def evict(self, keep=None):
+        if self.totalSize <= self.budget:
+            return
+        for entryKey in list(self.entries.keys()):
+            if self.totalSize <= self.budget:
+                break
+            if entryKey == keep or entryKey[1] in self.protectedIDs or entryKey not in self.entries:
+                continue
+            size, release = self.entries.pop(entryKey)
+            self.totalSize -= size
+            release(entryKey[1])
+
+    def usage(self):
+        return self.totalSize
+
+    def usageByKind(self):
+        usage = dict()
+        for (kind, key), (size, release) in self.entries.items():
+            usage[kind] = usage.get(kind, 0) + size
+        return usage
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+    def clear(self):
+        # forget the entries without releasing them (e.g. the scene has been closed)
+        self.entries.clear()
+        self.totalSize = 0
+        self.notify()
+
+
+class AnglePlanesProjectionWorker(object):
+    """Project the landmarks on a thread pool, the results are applied on the main thread.
+
+    Each request queries a mesh snapshot, so the threads never touch the MRML nodes. Only the
+    latest request of a landmark matters: the older ones are cancelled if they have not started yet,
+    and their results are dropped otherwise. The finished requests are queued by the threads and a
+    Qt timer, running only while requests are in flight, gives them to callback(key, snapshot,
+    position, closestPointIndex) on the main thread.
+    """
+    def __init__(self, callback, maxWorkers=2, pollInterval=10):
+        self.callback = callback
+        self.maxWorkers = maxWorkers
+        self.executor = None
+        self.requestNumbers = itertools.count(1)
+        self.latestRequests = dict()
+        self.futures = dict()
+        self.results = queue.Queue()
+        self.timer = qt.QTimer()
+        self.timer.setInterval(pollInterval)
+        self.timer.connect('timeout()', self.processResults)
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.submittedRequests = 0
+        self.cancelledRequests = 0
+        self.staleResults = 0
+        self.appliedResults = 0
+
+    def counters(self):
+        return {"submitted": self.submittedRequests,
+                "cancelled": self.cancelledRequests,
+                "stale": self.staleResults,
+                "applied": self.appliedResults}
+
+    def submit(self, key, snapshot, position):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.maxWorkers)
+        self.submittedRequests += 1
+        number = next(self.requestNumbers)
+        self.latestRequests[key] = number
+        previous = self.futures.get(key)
+        if previous is not None and previous.cancel():
+            self.cancelledRequests += 1
+        future = self.executor.submit(snapshot.findClosestPoint, position)
+        self.futures[key] = future
+        future.add_done_callback(lambda future: self.results.put((key, number, snapshot, position, future)))
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def processResults(self):
+        while True:
+            try:
+                key, number, snapshot, position, future = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if self.futures.get(key) is future:
+                del self.futures[key]
+            if future.cancelled():
+                continue
+            if self.latestRequests.get(key) != number:
+                self.staleResults += 1
+                continue
+            del self.latestRequests[key]
+            try:
+                closestPointIndex = future.result()
+            except Exception:
+                logging.exception("Projection of %s failed", key)
+                continue
+            self.appliedResults += 1
+            self.callback(key, snapshot, position, closestPointIndex)
+        if not self.futures:
+            self.timer.stop()
+
+    def flush(self):
+        # wait for the requests in flight and apply their results
+        while self.futures:
+            concurrent.futures.wait(list(self.futures.values()))
+            self.processResults()
+
+    def cancel(self):
+        for future in self.futures.values():
+            if future.cancel():
+                self.cancelledRequests += 1
+        # the results of the running requests are dropped by processResults
+        self.latestRequests = dict()
+
+    def shutdown(self):
+        self.cancel()
+        self.timer.stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class AnglePlanesROIUnion(object):
+    """ROI of a fiducial list, i.e. the union of the ROIs of its landmarks.
+
+    The ROI of each landmark is kept with the (closestPointIndex, ROIradius) it was grown from,
+    and every vertex counts the landmark ROIs it belongs to. Replacing the ROI of one landmark
+    only touches the vertices of its old and new ROIs.
+    """
+    def __init__(self, polyData):
+        self.polyData = polyData
+        self.polys = polyData.GetPolys()
+        self.counts = numpy.zeros(polyData.GetNumberOfPoints(), dtype=numpy.int32)
+        self.landmarkROIs = dict()
+
+    def isValidFor(self, polyData):
+        return polyData is self.polyData and polyData.GetPolys() is self.polys \
+               and polyData.GetNumberOfPoints() == len(self.counts)
+
+    def keyOf(self, markupID):
+        landmarkROI = self.landmarkROIs.get(markupID)
+        if landmarkROI is None:
+            return None
+        return landmarkROI[0]
+
+    def markupIDs(self):
+        return set(self.landmarkROIs.keys())
+
+    def update(self, markupID, key, pointIDs):
+        """Replace the ROI of a landmark, returns the vertices that entered or left the union"""
+        oldPointIDs = self.landmarkROIs.get(markupID, (None, numpy.zeros(0, dtype=numpy.int64)))[1]
+        candidates = numpy.concatenate((oldPointIDs, pointIDs))
+        before = self.counts[candidates] > 0
+        self.counts[oldPointIDs] -= 1
+        self.counts[pointIDs] += 1
+        after = self.counts[candidates] > 0
+        if key is None:
+            self.landmarkROIs.pop(markupID, None)
+        else:
+            self.landmarkROIs[markupID] = (key, pointIDs)
+        return numpy.unique(candidates[before != after])
+
+    def remove(self, markupID):
+        return self.update(markupID, None, numpy.zeros(0, dtype=numpy.int64))
+
+    def pointIDs(self):
+        return numpy.flatnonzero(self.counts)
+
+
+class AnglePlanesHardenedGeometry(object):
+    """World coordinates copies of the models, used to project the landmarks.
+
+    A copy is a shallow copy of the model polydata (cells and point data are shared) with its
+    own points buffer. When only the transform changes, the buffer is reused and filled with one
+    matrix product for linear transforms (vtkGeneralTransform for the other ones).
+    """
+    def __init__(self):
+        self.entries = dict()
+
+    def update(self, model):
+        source = model.GetPolyData()
+        transformNode = model.GetParentTransformNode()
+        if transformNode:
+            transformKey = (transformNode.GetID(), transformNode.GetTransformToWorldMTime())
+        else:
+            transformKey = None
+        entry = self.entries.get(model.GetID())
+        if entry is not None and entry["source"] is source and entry["geometryKey"] == self.geometryKey(source):
+            if entry["transformKey"] == transformKey:
+                return entry["polyData"]
+        else:
+            polyData = vtk.vtkPolyData()
+            polyData.ShallowCopy(source)
+            # the normals of the model would not be transformed
+            polyData.GetPointData().SetNormals(None)
+            points = vtk.vtkPoints()
+            points.SetDataTypeToDouble()
+            polyData.SetPoints(points)
+            entry = {"source": source, "polyData": polyData, "points": points}
+            self.entries[model.GetID()] = entry
+        points = entry["points"]
+        numberOfPoints = source.GetNumberOfPoints()
+        if points.GetNumberOfPoints() != numberOfPoints:
+            points.SetNumberOfPoints(numberOfPoints)
+        if numberOfPoints:
+            sourceArray = vtk_to_numpy(source.GetPoints().GetData())
+            pointsArray = vtk_to_numpy(points.GetData())
+            if transformNode is None:
+                pointsArray[:] = sourceArray
+            elif transformNode.IsTransformToWorldLinear():
+                matrix = vtk.vtkMatrix4x4()
+                transformNode.GetMatrixTransformToWorld(matrix)
+                matrix = slicer.util.arrayFromVTKMatrix(matrix)
+                numpy.matmul(sourceArray, matrix[:3, :3].T, out=pointsArray)
+                pointsArray += matrix[:3, 3]
+            else:
+                transformToWorld = vtk.vtkGeneralTransform()
+                transformNode.GetTransformToWorld(transformToWorld)
+                transformedPoints = vtk.vtkPoints()
+                transformToWorld.TransformPoints(source.GetPoints(), transformedPoints)
+                pointsArray[:] = vtk_to_numpy(transformedPoints.GetData())
+        points.Modified()
+        entry["polyData"].Modified()
+        entry["geometryKey"] = self.geometryKey(source)
+        entry["transformKey"] = transformKey
+        return entry["polyData"]
+
+    @staticmethod
+    def geometryKey(polyData):
+        # the point data of the model (e.g. its ROI array) is shared and does not change the copy
+        points = polyData.GetPoints()
+        polys = polyData.GetPolys()
+        return (points, points.GetMTime() if points else 0, polys, polys.GetMTime(), polyData.GetNumberOfPoints())
+
+    def memoryFootprint(self, modelID):
+        """Bytes owned by the copy of a model (its points) and bytes shared with the model"""
+        entry = self.entries.get(modelID)
+        if entry is None:
+            return {"owned": 0, "shared": 0}
+        owned = entry["points"].GetData().GetActualMemorySize() * 1024
+        shared = entry["polyData"].GetActualMemorySize() * 1024 - owned
+        return {"owned": owned, "shared": shared}
+
+    def memoryFootprints(self):
+        return dict((modelID, self.memoryFootprint(modelID)) for modelID in self.entries)
+
+    def remove(self, modelID):
+        self.entries.pop(modelID, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class AnglePlanesEventScheduler(object):
+    """Coalesce the events of the fiducial lists and process them at most once per frame.
+
+    Each fiducial list has one pending slot ("latest wins"): events received before the slot is
+    processed are merged into it. A single shot Qt timer processes the pending slots after
+    frameBudget milliseconds; slots that do not fit in the budget are kept for the next frame.
+    The events triggered by the module itself (projected positions written back) are only counted
+    as "ignored": "dropped" counts the external events that were never processed.
+    """
+    def __init__(self, callback, frameBudget=40):
+        self.callback = callback
+        self.frameBudget = frameBudget
+        self.pending = OrderedDict()
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(frameBudget)
+        self.timer.connect('timeout()', self.flush)
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.receivedEvents = 0
+        self.mergedEvents = 0
+        self.droppedEvents = 0
+        self.ignoredEvents = 0
+        self.processedEvents = 0
+
+    def counters(self):
+        return {"received": self.receivedEvents,
+                "merged": self.mergedEvents,
+                "dropped": self.droppedEvents,
+                "ignored": self.ignoredEvents,
+                "processed": self.processedEvents}
+
+    def setFrameBudget(self, frameBudget):
+        self.frameBudget = frameBudget
+        self.timer.setInterval(frameBudget)
+
+    def schedule(self, node):
+        self.receivedEvents += 1
+        key = node.GetID()
+        if key in self.pending:
+            self.mergedEvents += 1
+        self.pending[key] = node
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def drop(self):
+        # event that was received but will never be processed
+        self.droppedEvents += 1
+
+    def ignore(self):
+        # event triggered by the module itself, never scheduled
+        self.ignoredEvents += 1
+
+    def flush(self, frameBudget=None):
+        # process the pending slots, a budget of 0 means "until the queue is empty"
+        if frameBudget is None:
+            frameBudget = self.frameBudget
+        start = time.time()
+        while self.pending:
+            key, node = self.pending.popitem(last=False)
+            if node.GetScene() is None:
+                self.drop()
+                continue
+            self.processedEvents += 1
+            self.callback(node)
+            if frameBudget and (time.time() - start) * 1000 > frameBudget:
+                break
+        if self.pending and not self.timer.isActive():
+            self.timer.start()
+
+    def cancel(self):
+        self.timer.stop()
+        self.droppedEvents += len(self.pending)
+        self.pending = OrderedDict()
+
+
+class AnglePlanesAngleTracker(object):
+    """Recompute the angles while the selected slices and landmark planes move.
+
+    The selected slice nodes are observed and the landmark planes are reported by planesModified.
+    The requests are coalesced by a single shot Qt timer, so that update is called at most
+    maxRate times per second.
+    """
+    def __init__(self, update, maxRate=30):
+        self.update = update
+        self.interval = 1000.0 / maxRate
+        self.enabled = True
+        self.planeNames = set()
+        self.observations = list()
+        self.lastUpdate = 0
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.connect('timeout()', self.onTimeout)
+        self.resetCounters()
+
+    def resetCounters(self):
+        self.requests = 0
+        self.updates = 0
+
+    def counters(self):
+        return {"requested": self.requests, "updated": self.updates}
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if enabled:
+            self.requestUpdate()
+        else:
+            self.timer.stop()
+
+    def setPlanes(self, planeNames, sliceNodes):
+        self.removeObservers()
+        self.planeNames = set(planeNames)
+        for sliceNode in sliceNodes:
+            tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSliceModified)
+            self.observations.append((sliceNode, tag))
+
+    def removeObservers(self):
+        self.timer.stop()
+        for sliceNode, tag in self.observations:
+            sliceNode.RemoveObserver(tag)
+        self.observations = list()
+
+    def onSliceModified(self, obj, event):
+        self.requestUpdate()
+
+    def planesModified(self, planeNames):
+        if self.planeNames.intersection(planeNames):
+            self.requestUpdate()
+
+    def requestUpdate(self):
+        if not self.enabled:
+            return
+        self.requests += 1
+        if self.timer.isActive():
+            return
+        elapsed = (time.time() - self.lastUpdate) * 1000
+        self.timer.start(int(max(0, self.interval - elapsed)))
+
+    def onTimeout(self):
+        self.lastUpdate = time.time()
+        self.updates += 1
+        self.update()
+
+
+class AnglePlanesJournal(object):
+    """Compact journal of the events observed by the module and of the actions done in its interface.
+
+    The header describes the scene when the recording started (models, fiducial lists and state of
+    the interface) and each entry is [time in seconds, kind, fields]. The journal is saved as JSON
+    lines: the header on the first line, then one entry per line.
+    """
+    version = 1
+
+    def __init__(self, header=None, entries=None):
+        self.header = header or dict()
+        self.entries = entries or list()
+        self.start = time.time()
+        self.states = dict()
+
+    def record(self, kind, **fields):
+        self.entries.append([round(time.time() - self.start, 4), kind, fields])
+
+    def recordState(self, kind, key, **fields):
+        # UI actions are only recorded when they change the state of the interface
+        if self.states.get((kind, key)) == fields:
+            return
+        self.states[(kind, key)] = fields
+        self.record(kind, **fields)
+
+    def save(self, path):
+        with open(path, "w") as journalFile:
+            journalFile.write(json.dumps({"version": self.version, "header": self.header}) + "\n")
+            for entry in self.entries:
+                journalFile.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as journalFile:
+            header = json.loads(journalFile.readline())["header"]
+            entries = [json.loads(line) for line in journalFile if line.strip()]
+        return cls(header, entries)
+
+
+class AnglePlanesJournalPlayer(object):
+    """Replay a journal in a new copy of its fiducial lists and report the latency of each event.
+
+    The node events (pointAdded, pointModified, pointRemoved, modelTransformed) are applied to the
+    MRML nodes, so that they go through the same observers of the logic as during the recording.
+    With an interface, the interface events (selections, planes) are applied to its widgets too;
+    without one they are skipped and the fiducial lists are connected to their model by the logic.
+    The pending work is processed after each event, before its latency is measured. With speed=None
+    the events are replayed at full speed, otherwise the recorded delays are divided by speed.
+    Headless use, e.g. with Slicer --no-main-window:
+
+        latencies = AnglePlanesJournalPlayer(AnglePlanesLogic()).replay(AnglePlanesJournal.load(path))
+    """
+    nodeEvents = ("pointAdded", "pointModified", "pointRemoved", "modelTransformed")
+
+    def __init__(self, logic, interface=None):
+        self.logic = logic
+        self.interface = interface
+        self.nodes = dict()
+        self.markupIDs = dict()
+        self.planeIDs = dict()
+
+    def getNode(self, nodeID):
+        return self.nodes.get(nodeID) if nodeID else None
+
+    def getMarkupIndex(self, fidList, markupID):
+        return self.logic.getMarkupIndex(fidList, self.markupIDs.get(markupID, markupID))
+
+    def getPlaneControls(self, planeID):
+        return self.interface.planeControlsDictionary.get("Plane " + str(self.planeIDs.get(planeID, planeID)))
+
+    def setComboBoxText(self, comboBox, text):
+        index = comboBox.findText(text)
+        if index != -1:
+            comboBox.setCurrentIndex(index)
+
+    def restore(self, header):
+        """Find the models of the journal and create a copy of its fiducial lists"""
+        for model in header.get("models", []):
+            node = slicer.mrmlScene.GetFirstNodeByName(model["name"])
+            if node is None and model.get("fileName") and os.path.exists(model["fileName"]):
+                node = slicer.util.loadModel(model["fileName"])
+            if node is None:
+                raise ValueError("The model %s of the journal is not in the scene" % model["name"])
+            self.nodes[model["id"]] = node
+            if model.get("transform"):
+                transformNode = self.nodes.get(model["transform"])
+                if transformNode is None:
+                    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+                    self.nodes[model["transform"]] = transformNode
+                if model.get("matrix"):
+                    self.setMatrix(transformNode, model["matrix"])
+                node.SetAndObserveTransformNodeID(transformNode.GetID())
+        for fiducials in header.get("fiducials", []):
+            fidList = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", fiducials["name"])
+            for markupID, label, position in fiducials["points"]:
+                index = fidList.AddFiducial(*position)
+                fidList.SetNthMarkupLabel(index, label)
+                self.markupIDs[markupID] = fidList.GetNthMarkupID(index)
+            self.nodes[fiducials["id"]] = fidList
+        if self.interface is None:
+            self.connect(header)
+        else:
+            self.restoreInterface(header.get("interface", dict()))
+        slicer.app.processEvents()
+        self.logic.flushPendingEvents()
+
+    def connect(self, header):
+        # what the selection of the model and of the landmarks does in the interface
+        models = set()
+        for fiducials in header.get("fiducials", []):
+            model = self.getNode(fiducials.get("model"))
+            if model is None:
+                continue
+            if model.GetID() not in models:
+                self.logic.connectModel(model)
+                models.add(model.GetID())
+            self.logic.connectFiducialList(model, self.getNode(fiducials["id"]), fiducials.get("onSurface", True))
+        state = header.get("interface", dict())
+        fidList = self.getNode(state.get("landmarks"))
+        if fidList is not None and state.get("landmark"):
+            markupID = self.logic.getLandmarkRegistry(fidList).findID(state["landmark"])
+            if markupID:
+                self.logic.activeLandmarkIDs[fidList.GetID()] = markupID
+
+    def restoreInterface(self, state):
+        for plane in state.get("planes", []):
+            self.interface.inputModelSelector.setCurrentNode(self.getNode(state.get("model")))
+            self.interface.inputLandmarksSelector.setCurrentNode(self.getNode(plane["node"]))
+            self.interface.addNewPlane()
+            self.planeIDs[plane["id"]] = self.interface.planeControlsId
+            self.apply("planeLandmarksSelected", plane)
+        self.interface.inputModelSelector.setCurrentNode(self.getNode(state.get("model")))
+        self.interface.inputLandmarksSelector.setCurrentNode(self.getNode(state.get("landmarks")))
+        if state.get("landmark"):
+            self.apply("landmarkSelected", {"label": state["landmark"]})
+        if state.get("planeComboBoxes"):
+            self.apply("planesSelected", {"planes": state["planeComboBoxes"]})
+
+    def setMatrix(self, transformNode, values):
+        matrix = vtk.vtkMatrix4x4()
+        for i, value in enumerate(values):
+            matrix.SetElement(i // 4, i % 4, value)
+        transformNode.SetMatrixTransformToParent(matrix)
+
+    def apply(self, kind, fields):
+        """Apply an event, returns False if it was skipped"""
+        if kind in self.nodeEvents:
+            self.applyNodeEvent(kind, fields)
+        elif self.interface is not None:
+            self.applyInterfaceEvent(kind, fields)
+        else:
+            return False
+        return True
+
+    def applyNodeEvent(self, kind, fields):
+        if kind == "pointAdded":
+            fidList = self.getNode(fields["node"])
+            index = fidList.AddFiducial(*fields["position"])
+            fidList.SetNthMarkupLabel(index, fields["label"])
+            self.markupIDs[fields["markup"]] = fidList.GetNthMarkupID(index)
+        elif kind == "pointModified":
+            fidList = self.getNode(fields["node"])
+            index = self.getMarkupIndex(fidList, fields["markup"])
+            if fidList.GetNthMarkupLabel(index) != fields["label"]:
+                fidList.SetNthMarkupLabel(index, fields["label"])
+            fidList.SetNthFiducialPositionFromArray(index, fields["position"])
+        elif kind == "pointRemoved":
+            fidList = self.getNode(fields["node"])
+            for markupID in fields["markups"]:
+                fidList.RemoveMarkup(self.getMarkupIndex(fidList, markupID))
+        elif kind == "modelTransformed":
+            transformNode = self.getNode(fields.get("transform"))
+            if transformNode is not None and fields.get("matrix"):
+                self.setMatrix(transformNode, fields["matrix"])
+            else:
+                self.logic.onModelModified(self.getNode(fields["model"]), None)
+
+    def applyInterfaceEvent(self, kind, fields):
+        if kind == "modelSelected":
+            self.interface.inputModelSelector.setCurrentNode(self.getNode(fields["model"]))
+        elif kind == "landmarksSelected":
+            self.interface.inputLandmarksSelector.setCurrentNode(self.getNode(fields["node"]))
+        elif kind == "landmarkSelected":
+            self.setComboBoxText(self.interface.landmarkComboBox, fields["label"])
+        elif kind == "planeAdded":
+            self.interface.addNewPlane()
+            self.planeIDs[fields["id"]] = self.interface.planeControlsId
+        elif kind == "planeLandmarksSelected":
+            planeControls = self.getPlaneControls(fields["id"])
+            if planeControls is not None:
+                comboBoxes = [planeControls.landmark1ComboBox, planeControls.landmark2ComboBox,
+                              planeControls.landmark3ComboBox]
+                for comboBox, label in zip(comboBoxes, fields["labels"]):
+                    self.setComboBoxText(comboBox, label)
+        elif kind == "planesSelected":
+            for comboBox, text in zip([self.interface.planeComboBox1, self.interface.planeComboBox2],
+                                      fields["planes"]):
+                self.setComboBoxText(comboBox, text)
+        else:
+            logging.warning("Unknown event in the journal: %s", kind)
+
+    def replay(self, journal, speed=None):
+        """Replay the journal, returns one {index, time, kind, latency (ms)} dictionary per event"""
+        recordingJournal, self.logic.journal = self.logic.journal, None
+        try:
+            self.restore(journal.header)
+            latencies = list()
+            start = time.time()
+            for index, (eventTime, kind, fields) in enumerate(journal.entries):
+                if speed:
+                    delay = start + eventTime / speed - time.time()
+                    while delay > 0:
+                        slicer.app.processEvents()
+                        time.sleep(min(delay, 0.005))
+                        delay = start + eventTime / speed - time.time()
+                eventStart = time.perf_counter()
+                if not self.apply(kind, fields):
+                    continue
+                slicer.app.processEvents()
+                self.logic.flushPendingEvents()
+                latencies.append({"index": index, "time": eventTime, "kind": kind,
+                                  "latency": (time.perf_counter() - eventStart) * 1000})
+            self.logic.flushPendingEvents()
+            return latencies
+        finally:
+            self.logic.journal = recordingJournal
+
+    @staticmethod
+    def summarize(latencies):
+        """Number of events, mean, 95th percentile and max latency (ms) of each kind of event"""
+        summary = dict()
+        for kind in sorted(set(latency["kind"] for latency in latencies)):
+            values = numpy.array([latency["latency"] for latency in latencies if latency["kind"] == kind])
+            summary[kind] = {"count": len(values),
+                             "mean": float(values.mean()),
+                             "p95": float(numpy.percentile(values, 95)),
+                             "max": float(values.max())}
+        return summary
+
+
 class AnglePlanesLogic(ScriptedLoadableModuleLogic):
     try:
         slicer.sys
@@ -768,6 +1728,118 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
         self.selectedFidList = None
         self.selectedModel = None
         self.interface = interface
+        self.memoryBudget = AnglePlanesMemoryBudget()
+        self.locatorCache = meshes.LocatorCache(self.memoryBudget)
+        self.adjacencyCache = meshes.AdjacencyCache(self.memoryBudget)
+        self.ROIUnions = dict()
+        self.landmarkRegistries = dict()
+        self.updatingFidListIDs = set()
+        self.boundsCache = dict()
+        # slice node ID -> (SliceToRAS matrix, its MTime, normal), see getSliceNormal
+        self.sliceNormals = dict()
+        self.hardenedGeometry = AnglePlanesHardenedGeometry()
+        self.pointModifiedScheduler = AnglePlanesEventScheduler(self.processPointModifiedEvent)
+        # the landmark being moved is projected by projectionWorker, set to False to project it synchronously
+        self.projectAsynchronously = True
+        self.projectionWorker = AnglePlanesProjectionWorker(self.applyProjection)
+        # fiducial list ID -> markup ID of the last added or moved landmark, used without interface
+        self.activeLandmarkIDs = dict()
+        self.journal = None
+
+    def flushPendingEvents(self):
+        # process the coalesced events and the projections in flight, e.g. in tests and replays
+        self.pointModifiedScheduler.flush(0)
+        self.projectionWorker.flush()
+        self.pointModifiedScheduler.flush(0)
+
+    def startRecording(self):
+        self.journal = AnglePlanesJournal(self.describeSceneForJournal())
+
+    def stopRecording(self):
+        journal, self.journal = self.journal, None
+        return journal
+
+    def recordEvent(self, kind, **fields):
+        if self.journal is not None:
+            self.journal.record(kind, **fields)
+
+    def recordUIState(self, kind, key, **fields):
+        if self.journal is not None:
+            self.journal.recordState(kind, key, **fields)
+
+    def getTransformMatrix(self, transformNode):
+        # flattened matrix to parent of a linear transform, None for the other transforms
+        if transformNode is None or not transformNode.IsLinear():
+            return None
+        matrix = vtk.vtkMatrix4x4()
+        transformNode.GetMatrixTransformToParent(matrix)
+        return [matrix.GetElement(i // 4, i % 4) for i in range(16)]
+
+    def describeSceneForJournal(self):
+        models = list()
+        for model in slicer.util.getNodesByClass("vtkMRMLModelNode"):
+            if model.GetName().startswith("SurfaceRegistration_") \
+                    or (self.interface is not None and model.GetName() in self.interface.ignoredNodeNames):
+                continue
+            storageNode = model.GetStorageNode()
+            transformNode = model.GetParentTransformNode()
+            models.append({"id": model.GetID(),
+                           "name": model.GetName(),
+                           "fileName": storageNode.GetFileName() if storageNode else None,
+                           "transform": transformNode.GetID() if transformNode else None,
+                           "matrix": self.getTransformMatrix(transformNode)})
+        fiducials = list()
+        for fidList in slicer.util.getNodesByClass("vtkMRMLMarkupsFiducialNode"):
+            points = list()
+            for n in range(fidList.GetNumberOfMarkups()):
+                position = [0.0, 0.0, 0.0]
+                fidList.GetNthFiducialPosition(n, position)
+                points.append([fidList.GetNthMarkupID(n), fidList.GetNthMarkupLabel(n), position])
+            registry = self.landmarkRegistries.get(fidList.GetID())
+            fiducials.append({"id": fidList.GetID(), "name": fidList.GetName(), "points": points,
+                              "model": fidList.GetAttribute("connectedModelID"),
+                              "onSurface": bool(registry) and any(landmark.isProjected
+                                                                   for landmark in registry.values())})
+        if self.interface is None:
+            return {"models": models, "fiducials": fiducials, "interface": dict()}
+        model = self.interface.inputModelSelector.currentNode()
+        landmarks = self.interface.inputLandmarksSelector.currentNode()
+        planes = [{"id": planeControls.id,
+                   "node": planeControls.fidlist.GetID(),
+                   "labels": [planeControls.landmark1ComboBox.currentText,
+                              planeControls.landmark2ComboBox.currentText,
+                              planeControls.landmark3ComboBox.currentText]}
+                  for planeControls in self.interface.planeControlsDictionary.values()]
+        return {"models": models,
+                "fiducials": fiducials,
+                "interface": {"model": model.GetID() if model else None,
+                              "landmarks": landmarks.GetID() if landmarks else None,
+                              "landmark": self.interface.landmarkComboBox.currentText,
+                              "planes": planes,
+                              "planeComboBoxes": [self.interface.planeComboBox1.currentText,
+                                                  self.interface.planeComboBox2.currentText]}}
+
+    def getLandmarkRegistry(self, fidList):
+        registry = self.landmarkRegistries.get(fidList.GetID())
+        if registry is None or registry.fidList is not fidList:
+            registry = LandmarkRegistry(fidList, self.decodeJSON(fidList.GetAttribute("landmarkDescription")))
+            registry.refreshIndexes()
+            self.landmarkRegistries[fidList.GetID()] = registry
+        return registry
+
+    def getMarkupIndex(self, fidList, markupID):
+        return self.getLandmarkRegistry(fidList).indexOf(markupID)
+
+    def syncLandmarkRegistries(self):
+        # write the modified registries back in the "landmarkDescription" attribute
+        for registry in self.landmarkRegistries.values():
+            if registry.modified:
+                registry.fidList.SetAttribute("landmarkDescription", self.encodeJSON(registry.toDescription()))
+                registry.modified = False
+
+    def resetLandmarkRegistries(self):
+        self.syncLandmarkRegistries()
+        self.landmarkRegistries = dict()
 
     def UpdateThreeDView(self, landmarkLabel):
         # Update the 3D view on Slicer
@@ -783,9 +1855,9 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
         selectedFidReflID = self.findIDFromLabel(active,landmarkLabel)
         for i in range(0,end):
             fidList = list.GetItemAsObject(i)
-            landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-            for key in landmarkDescription.keys():
-                markupsIndex = fidList.GetNthControlPointIndexByID(key)
+            registry = self.getLandmarkRegistry(fidList)
+            for key in registry.keys():
+                markupsIndex = self.getMarkupIndex(fidList, key)
                 if key != selectedFidReflID:
                     fidList.SetNthMarkupLocked(markupsIndex, True)
                 else:
@@ -795,25 +1867,117 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
         if selectedFidReflID != False:
             displayNode.SetScalarVisibility(True)
 
+    @instrumentation.timed()
     def createIntermediateHardenModel(self, model):
         hardenModel = slicer.mrmlScene.GetNodesByName("SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(
             slicer.app.applicationPid())).GetItemAsObject(0)
         if hardenModel is None:
             hardenModel = slicer.vtkMRMLModelNode()
-        hardenPolyData = vtk.vtkPolyData()
-        hardenPolyData.DeepCopy(model.GetPolyData())
-        hardenModel.SetAndObservePolyData(hardenPolyData)
+        # the points are transformed in place, the cells are shared with the model
+        hardenPolyData = self.hardenedGeometry.update(model)
+        if hardenModel.GetPolyData() is not hardenPolyData:
+            hardenModel.SetAndObservePolyData(hardenPolyData)
         hardenModel.SetName(
             "SurfaceRegistration_" + model.GetName() + "_hardenCopy_" + str(slicer.app.applicationPid()))
-        if model.GetParentTransformNode():
-            hardenModel.SetAndObserveTransformNodeID(model.GetParentTransformNode().GetID())
         hardenModel.HideFromEditorsOn()
-        slicer.mrmlScene.AddNode(hardenModel)
-        logic = slicer.vtkSlicerTransformLogic()
-        logic.hardenTransform(hardenModel)
+        if hardenModel.GetScene() is None:
+            slicer.mrmlScene.AddNode(hardenModel)
+        self.memoryBudget.record("hardenCopy", model.GetID(),
+                                 self.hardenedGeometry.memoryFootprint(model.GetID())["owned"],
+                                 self.releaseHardenModel)
+        return hardenModel
+
+    def getHardenModel(self, fidList):
+        # the hardened copy may have been released by the memory budget, it is then computed again
+        hardenModel = None
+        if fidList.GetAttribute("hardenModelID"):
+            hardenModel = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("hardenModelID"))
+        model = slicer.mrmlScene.GetNodeByID(fidList.GetAttribute("connectedModelID")) \
+            if fidList.GetAttribute("connectedModelID") else None
+        if hardenModel is None and model is not None:
+            hardenModel = self.createIntermediateHardenModel(model)
+            model.SetAttribute("hardenModelID", hardenModel.GetID())
+            fidList.SetAttribute("hardenModelID", hardenModel.GetID())
+        elif model is not None:
+            self.memoryBudget.touch("hardenCopy", model.GetID())
         return hardenModel
 
+    def releaseHardenModel(self, modelID):
+        entry = self.hardenedGeometry.entries.get(modelID)
+        self.hardenedGeometry.remove(modelID)
+        self.memoryBudget.discard("hardenCopy", modelID)
+        if entry is None:
+            return
+        for hardenModel in slicer.util.getNodesByClass("vtkMRMLModelNode"):
+            if hardenModel.GetPolyData() is entry["polyData"]:
+                self.locatorCache.remove(hardenModel.GetID())
+                self.adjacencyCache.remove(hardenModel.GetID())
+                slicer.mrmlScene.RemoveNode(hardenModel)
+
+    def releaseModel(self, modelID):
+        # the model node has been removed from the scene
+        self.releaseHardenModel(modelID)
+        self.locatorCache.remove(modelID)
+        self.boundsCache.pop(modelID, None)
+        self.memoryBudget.discard("bounds", modelID)
+
+    def updateProtectedModels(self):
+        protectedIDs = set()
+        if self.selectedModel:
+            protectedIDs.add(self.selectedModel.GetID())
+            if self.selectedModel.GetAttribute("hardenModelID"):
+                protectedIDs.add(self.selectedModel.GetAttribute("hardenModelID"))
+        self.memoryBudget.setProtectedIDs(protectedIDs)
+
+    def getModelBounds(self, model):
+        """World bounds of a model, without hardening its transform.
+
+        For linear transforms the 8 corners of the local bounds are transformed, which gives
+        the bounds of the transformed box. Non-linear transforms need every point to be transformed.
+        The result is cached until the polydata or the transform to world is modified.
+        """
+        polyData = model.GetPolyData()
+        if polyData is None or polyData.GetNumberOfPoints() == 0:
+            return None
+        transformNode = model.GetParentTransformNode()
+        if transformNode:
+            cacheKey = (polyData.GetMTime(), transformNode.GetID(), transformNode.GetTransformToWorldMTime())
+        else:
+            cacheKey = (polyData.GetMTime(), None, None)
+        cached = self.boundsCache.get(model.GetID())
+        if cached is not None and cached[0] == cacheKey and cached[1] is polyData:
+            return cached[2]
+        bounds = polyData.GetBounds()
+        if transformNode and transformNode.IsTransformToWorldLinear():
+            matrix = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformToWorld(matrix)
+            matrix = slicer.util.arrayFromVTKMatrix(matrix)
+            corners = numpy.array([[bounds[x], bounds[2 + y], bounds[4 + z], 1.0]
+                                   for x in (0, 1) for y in (0, 1) for z in (0, 1)])
+            corners = corners.dot(matrix.T)[:, :3]
+            bounds = (corners[:, 0].min(), corners[:, 0].max(),
+                      corners[:, 1].min(), corners[:, 1].max(),
+                      corners[:, 2].min(), corners[:, 2].max())
+        elif transformNode:
+            transformToWorld = vtk.vtkGeneralTransform()
+            transformNode.GetTransformToWorld(transformToWorld)
+            transformedPoints = vtk.vtkPoints()
+            transformToWorld.TransformPoints(polyData.GetPoints(), transformedPoints)
+            bounds = transformedPoints.GetBounds()
+        bounds = tuple(float(value) for value in bounds)
+        self.boundsCache[model.GetID()] = (cacheKey, polyData, bounds)
+        self.memoryBudget.record("bounds", model.GetID(), 256, self.releaseBounds)
+        return bounds
+
+    def releaseBounds(self, modelID):
+        self.boundsCache.pop(modelID, None)
+
+    @instrumentation.timed()
     def onModelModified(self, obj, event):
+        transformNode = obj.GetParentTransformNode()
+        self.recordEvent("modelTransformed", model=obj.GetID(),
+                         transform=transformNode.GetID() if transformNode else None,
+                         matrix=self.getTransformMatrix(transformNode))
         #recompute the harden model
         hardenModel = self.createIntermediateHardenModel(obj)
         obj.SetAttribute("hardenModelID",hardenModel.GetID())
@@ -828,25 +1992,20 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
                     #replace the harden model with the new one
                     fidList.SetAttribute("hardenModelID",hardenModel.GetID())
                     #reproject the fiducials on the new model
-                    landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
+                    registry = self.getLandmarkRegistry(fidList)
+                    projectedIDs = list()
                     for n in range(fidList.GetNumberOfMarkups()):
                         markupID = fidList.GetNthMarkupID(n)
-                        if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                            hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                            markupsIndex = fidList.GetNthControlPointIndexByID(markupID)
-                            self.replaceLandmark(hardenModel.GetPolyData(), fidList, markupsIndex,
-                                                 landmarkDescription[markupID]["projection"]["closestPointIndex"])
-                        fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                        if registry.get(markupID).isProjected == True:
+                            projectedIDs.append(markupID)
+                    indices = [registry.get(markupID).closestPointIndex for markupID in projectedIDs]
+                    self.replaceLandmarks(hardenModel.GetPolyData(), fidList, projectedIDs, indices)
 
     def ModelChanged(self, inputModelSelector, inputLandmarksSelector):
         inputModel = inputModelSelector.currentNode()
         # if a Model Node is present
         if inputModel:
-            self.selectedModel = inputModel
-            hardenModel = self.createIntermediateHardenModel(inputModel)
-            inputModel.SetAttribute("hardenModelID",hardenModel.GetID())
-            modelModifieTagEvent = inputModel.AddObserver(inputModel.TransformModifiedEvent, self.onModelModified)
-            inputModel.SetAttribute("modelModifieTagEvent",self.encodeJSON({'modelModifieTagEvent':modelModifieTagEvent}))
+            self.connectModel(inputModel)
             inputLandmarksSelector.setEnabled(True)
         # if no model is selected
         else:
@@ -854,6 +2013,20 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
             inputLandmarksSelector.setCurrentNode(None)
             inputLandmarksSelector.setEnabled(False)
 
+    def connectModel(self, inputModel):
+        # harden the model and follow its transform
+        self.selectedModel = inputModel
+        hardenModel = self.createIntermediateHardenModel(inputModel)
+        inputModel.SetAttribute("hardenModelID",hardenModel.GetID())
+        self.updateProtectedModels()
+        try:
+            tag = self.decodeJSON(inputModel.GetAttribute("modelModifieTagEvent"))
+            inputModel.RemoveObserver(tag["modelModifieTagEvent"])
+        except:
+            pass
+        modelModifieTagEvent = inputModel.AddObserver(inputModel.TransformModifiedEvent, self.onModelModified)
+        inputModel.SetAttribute("modelModifieTagEvent",self.encodeJSON({'modelModifieTagEvent':modelModifieTagEvent}))
+
     def isUnderTransform(self, markups):
         if markups.GetParentTransformNode():
             messageBox = ctk.ctkMessageBox()
@@ -900,28 +2073,17 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
     def createNewDataStructure(self,landmarks, model, onSurface):
         landmarks.SetAttribute("connectedModelID",model.GetID())
         landmarks.SetAttribute("hardenModelID",model.GetAttribute("hardenModelID"))
-        landmarkDescription = dict()
+        registry = LandmarkRegistry(landmarks)
         for n in range(landmarks.GetNumberOfMarkups()):
             markupID = landmarks.GetNthMarkupID(n)
-            landmarkDescription[markupID] = dict()
             landmarkLabel = landmarks.GetNthMarkupLabel(n)
-            landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-            landmarkDescription[markupID]["ROIradius"] = 0
-            landmarkDescription[markupID]["projection"] = dict()
-            if onSurface:
-                landmarkDescription[markupID]["projection"]["isProjected"] = True
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, landmarks, markupID)
-            else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarkDescription[markupID]["midPoint"] = dict()
-            landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-            landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-            landmarkDescription[markupID]["midPoint"]["Point1"] = None
-            landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        landmarks.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+            registry.add(Landmark(markupID, landmarkLabel, onSurface), n)
+        self.landmarkRegistries[landmarks.GetID()] = registry
+        if onSurface:
+            hardenModel = self.getHardenModel(landmarks)
+            closestPointIndices = self.projectLandmarksOnSurface(hardenModel, landmarks, list(registry.keys()))
+            for markupID, closestPointIndex in closestPointIndices.items():
+                registry.get(markupID).closestPointIndex = closestPointIndex
         planeDescription = dict()
         landmarks.SetAttribute("planeDescription",self.encodeJSON(planeDescription))
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
@@ -931,18 +2093,23 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
     def changementOfConnectedModel(self,landmarks, model, onSurface):
         landmarks.SetAttribute("connectedModelID",model.GetID())
         landmarks.SetAttribute("hardenModelID",model.GetAttribute("hardenModelID"))
-        landmarkDescription = self.decodeJSON(landmarks.GetAttribute("landmarkDescription"))
+        registry = self.getLandmarkRegistry(landmarks)
+        projectedIDs = list()
         for n in range(landmarks.GetNumberOfMarkups()):
             markupID = landmarks.GetNthMarkupID(n)
+            landmark = registry.get(markupID)
             if onSurface:
-                if landmarkDescription[markupID]["projection"]["isProjected"] == True:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(landmarks.GetAttribute("hardenModelID"))
-                    landmarkDescription[markupID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, landmarks, markupID)
+                if landmark.isProjected == True:
+                    projectedIDs.append(markupID)
             else:
-                landmarkDescription[markupID]["projection"]["isProjected"] = False
-                landmarkDescription[markupID]["projection"]["closestPointIndex"] = None
-            landmarks.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+                landmark.isProjected = False
+                landmark.closestPointIndex = None
+        if projectedIDs:
+            hardenModel = self.getHardenModel(landmarks)
+            closestPointIndices = self.projectLandmarksOnSurface(hardenModel, landmarks, projectedIDs)
+            for markupID, closestPointIndex in closestPointIndices.items():
+                registry.get(markupID).closestPointIndex = closestPointIndex
+        registry.markModified()
         landmarks.SetAttribute("isClean",self.encodeJSON({"isClean":False}))
 
     def connectLandmarks(self, modelSelector, landmarkSelector, onSurface):
@@ -952,33 +2119,39 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
         self.selectedModel = model
         if not (model and landmarks):
             return
-
-        if self.isUnderTransform(landmarks):
+        if not self.connectFiducialList(model, landmarks, onSurface):
             landmarkSelector.setCurrentNode(None)
             return
+        #update of the landmark Combo Box
+        self.updateLandmarkComboBox(landmarks, self.interface.landmarkComboBox, False)
+
+    def connectFiducialList(self, model, landmarks, onSurface):
+        # observe the landmarks placed on model, returns False if the user refused to modify them
+        if self.isUnderTransform(landmarks):
+            return False
         connectedModelID = landmarks.GetAttribute("connectedModelID")
         try:
             tag = self.decodeJSON(landmarks.GetAttribute("PointAddedEventTag"))
             landmarks.RemoveObserver(tag["PointAddedEventTag"])
-            print("adding observers removed!")
+            logging.debug("adding observers removed")
         except:
             pass
         try:
             tag = self.decodeJSON(landmarks.GetAttribute("PointModifiedEventTag"))
             landmarks.RemoveObserver(tag["PointModifiedEventTag"])
-            print("moving observers removed!")
+            logging.debug("moving observers removed")
         except:
             pass
         try:
             tag = self.decodeJSON(landmarks.GetAttribute("PointRemovedEventTag"))
             landmarks.RemoveObserver(tag["PointRemovedEventTag"])
-            print("removing observers removed!")
+            logging.debug("removing observers removed")
         except:
             pass
         try:
             tag = self.decodeJSON(landmarks.GetAttribute("UpdatesPlanesEventTag"))
             landmarks.RemoveObserver(tag["UpdatesPlanesEventTag"])
-            print("Planes observers removed!")
+            logging.debug("Planes observers removed")
         except:
             pass
         if connectedModelID:
@@ -986,15 +2159,12 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
                 if self.connectedModelChangement():
                     self.changementOfConnectedModel(landmarks, model, onSurface)
                 else:
-                    landmarkSelector.setCurrentNode(None)
-                    return
+                    return False
             else:
                 landmarks.SetAttribute("hardenModelID",model.GetAttribute("hardenModelID"))
         # creation of the data structure
         else:
             self.createNewDataStructure(landmarks, model, onSurface)
-        #update of the landmark Combo Box
-        self.updateLandmarkComboBox(landmarks, self.interface.landmarkComboBox, False)
         #adding of listeners
         PointAddedEventTag = landmarks.AddObserver(landmarks.PointAddedEvent, self.onPointAddedEvent)
         landmarks.SetAttribute("PointAddedEventTag",self.encodeJSON({"PointAddedEventTag":PointAddedEventTag}))
@@ -1002,99 +2172,186 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
         landmarks.SetAttribute("PointModifiedEventTag",self.encodeJSON({"PointModifiedEventTag":PointModifiedEventTag}))
         PointRemovedEventTag = landmarks.AddObserver(landmarks.PointRemovedEvent, self.onPointRemovedEvent)
         landmarks.SetAttribute("PointRemovedEventTag",self.encodeJSON({"PointRemovedEventTag":PointRemovedEventTag}))
-        UpdatesPlanesEventTag = landmarks.AddObserver(landmarks.PointModifiedEvent, self.updatePlanesEvent)
-        landmarks.SetAttribute("UpdatesPlanesEventTag",self.encodeJSON({"UpdatesPlanesEventTag":UpdatesPlanesEventTag}))
+        # the planes are updated by processPointModifiedEvent, "UpdatesPlanesEventTag" is only removed above
+        # for the fiducial lists that were connected by a previous version of the module
+        return True
 
     # Called when a landmark is added on a model
+    @instrumentation.timed()
     def onPointAddedEvent(self, obj, event):
-        print("------markup adding-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
+        logging.debug("Markup added to %s", obj.GetName())
+        registry = self.getLandmarkRegistry(obj)
         numOfMarkups = obj.GetNumberOfMarkups()
         markupID = obj.GetNthMarkupID(numOfMarkups - 1)
-        landmarkDescription[markupID] = dict()
         landmarkLabel = obj.GetNthMarkupLabel(numOfMarkups - 1)
-        landmarkDescription[markupID]["landmarkLabel"] = landmarkLabel
-        landmarkDescription[markupID]["ROIradius"] = 0
-        landmarkDescription[markupID]["projection"] = dict()
-        landmarkDescription[markupID]["projection"]["isProjected"] = True
+        if self.journal is not None:
+            position = [0.0, 0.0, 0.0]
+            obj.GetNthFiducialPosition(numOfMarkups - 1, position)
+            self.journal.record("pointAdded", node=obj.GetID(), markup=markupID, label=landmarkLabel,
+                                position=position)
         # The landmark will be projected by onPointModifiedEvent
-        landmarkDescription[markupID]["midPoint"] = dict()
-        landmarkDescription[markupID]["midPoint"]["definedByThisMarkup"] = list()
-        landmarkDescription[markupID]["midPoint"]["isMidPoint"] = False
-        landmarkDescription[markupID]["midPoint"]["Point1"] = None
-        landmarkDescription[markupID]["midPoint"]["Point2"] = None
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
-        self.updateAllLandmarkComboBox(obj, markupID)
-        self.interface.UpdateInterface()
+        registry.add(Landmark(markupID, landmarkLabel, True), numOfMarkups - 1)
+        self.activeLandmarkIDs[obj.GetID()] = markupID
+        if self.interface is not None:
+            self.updateAllLandmarkComboBox(obj, markupID)
+            self.interface.UpdateInterface()
         qt.QTimer.singleShot(0, lambda : self.onPointModifiedEvent(obj,None))
 
+    @instrumentation.timed()
     def updateMidPoint(self, fidList, landmarkID):
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        for midPointID in landmarkDescription[landmarkID]["midPoint"]["definedByThisMarkup"]:
-            if landmarkDescription[midPointID]["midPoint"]["isMidPoint"]:
-                landmark1ID = landmarkDescription[midPointID]["midPoint"]["Point1"]
-                landmark2ID = landmarkDescription[midPointID]["midPoint"]["Point2"]
-                coord = self.calculateMidPointCoord(fidList, landmark1ID, landmark2ID)
-                index = fidList.GetNthControlPointIndexByID(midPointID)
-                fidList.SetNthFiducialPositionFromArray(index, coord)
-                if landmarkDescription[midPointID]["projection"]["isProjected"]:
-                    hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
-                    landmarkDescription[midPointID]["projection"]["closestPointIndex"] = \
-                        self.projectOnSurface(hardenModel, fidList, midPointID)
-                    fidList.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
-                self.updateMidPoint(fidList, midPointID)
-
-    # Called when a landmarks is moved
-    def onPointModifiedEvent(self, obj, event):
-        print("----onPointModifiedEvent Angle plane-----")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
-        if not landmarkDescription:
+        # each midpoint depending on the landmark is recomputed once, after the landmarks it depends on
+        registry = self.getLandmarkRegistry(fidList)
+        midPointIDs = registry.dependentsInOrder(landmarkID)
+        if not midPointIDs:
             return
-        selectedLandmarkID = self.findIDFromLabel(obj, self.interface.landmarkComboBox.currentText)
-        # remove observer to make sure, the callback function won't work..
-        tag = self.decodeJSON(obj.GetAttribute("PointModifiedEventTag"))
-        obj.RemoveObserver(tag["PointModifiedEventTag"])
-        if selectedLandmarkID:
-            activeLandmarkState = landmarkDescription[selectedLandmarkID]
-            if activeLandmarkState["projection"]["isProjected"]:
-                hardenModel = slicer.app.mrmlScene().GetNodeByID(obj.GetAttribute("hardenModelID"))
-                activeLandmarkState["projection"]["closestPointIndex"] = \
-                    self.projectOnSurface(hardenModel, obj, selectedLandmarkID)
-                obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
-            self.updateMidPoint(obj,selectedLandmarkID)
-            self.findROI(obj)
-        time.sleep(0.08)
-        # Add the observer again
-        PointModifiedEventTag = obj.AddObserver(obj.PointModifiedEvent, self.onPointModifiedEvent)
-        obj.SetAttribute("PointModifiedEventTag",self.encodeJSON({"PointModifiedEventTag":PointModifiedEventTag}))
-
+        positions = dict()
+        def getPosition(markupID):
+            if markupID not in positions:
+                positions[markupID] = numpy.zeros(3)
+                fidList.GetNthFiducialPosition(self.getMarkupIndex(fidList, markupID), positions[markupID])
+            return positions[markupID]
+        hardenModel = None
+        for midPointID in midPointIDs:
+            midPoint = registry.get(midPointID)
+            if self.getMarkupIndex(fidList, midPoint.point1) < 0 or self.getMarkupIndex(fidList, midPoint.point2) < 0:
+                continue
+            coord = geometry.midPoints(getPosition(midPoint.point1), getPosition(midPoint.point2))
+            if midPoint.isProjected:
+                if hardenModel is None:
+                    hardenModel = self.getHardenModel(fidList)
+                polyData = hardenModel.GetPolyData()
+                midPoint.closestPointIndex = int(self.getClosestPointIndices(polyData, [coord], hardenModel.GetID())[0])
+                coord = numpy.array(polyData.GetPoint(midPoint.closestPointIndex))
+                registry.markModified()
+            positions[midPointID] = coord
+        wasModifying = fidList.StartModify()
+        for midPointID in midPointIDs:
+            if midPointID in positions:
+                fidList.SetNthFiducialPositionFromArray(self.getMarkupIndex(fidList, midPointID), positions[midPointID])
+        fidList.EndModify(wasModifying)
+        instrumentation.count("midpoints updated", len(midPointIDs))
+
+    # Called when a landmarks is moved (or renamed)
+    # The heavy work is done by processPointModifiedEvent, at most once per frame
+    @vtk.calldata_type(vtk.VTK_INT)
+    @instrumentation.timed()
+    def onPointModifiedEvent(self, obj, event, callData=None):
+        # the markups moved by processPointModifiedEvent must not trigger it again
+        if obj.GetID() in self.updatingFidListIDs:
+            self.pointModifiedScheduler.ignore()
+            return
+        if callData is not None and 0 <= callData < obj.GetNumberOfMarkups():
+            self.activeLandmarkIDs[obj.GetID()] = obj.GetNthMarkupID(callData)
+            self.updateLandmarkLabel(obj, obj.GetNthMarkupID(callData), obj.GetNthMarkupLabel(callData))
+            if self.journal is not None:
+                position = [0.0, 0.0, 0.0]
+                obj.GetNthFiducialPosition(callData, position)
+                self.journal.record("pointModified", node=obj.GetID(), markup=obj.GetNthMarkupID(callData),
+                                    label=obj.GetNthMarkupLabel(callData), position=position)
+        self.pointModifiedScheduler.schedule(obj)
+
+    @instrumentation.timed()
+    def processPointModifiedEvent(self, obj):
+        logging.debug("processPointModifiedEvent %s", obj.GetName())
+        registry = self.getLandmarkRegistry(obj)
+        if not registry:
+            return
+        selectedLandmarkID = self.getActiveLandmarkID(obj, registry)
+        self.updatingFidListIDs.add(obj.GetID())
+        try:
+            if selectedLandmarkID:
+                activeLandmarkState = registry.get(selectedLandmarkID)
+                if activeLandmarkState.isProjected:
+                    hardenModel = self.getHardenModel(obj)
+                    if self.projectAsynchronously:
+                        self.requestProjection(obj, hardenModel, selectedLandmarkID)
+                    else:
+                        activeLandmarkState.closestPointIndex = \
+                            self.projectOnSurface(hardenModel, obj, selectedLandmarkID)
+                        registry.markModified()
+                self.updateMidPoint(obj,selectedLandmarkID)
+                self.findROI(obj)
+            self.updatePlanesEvent(obj, None)
+        finally:
+            self.updatingFidListIDs.discard(obj.GetID())
+
+    def getActiveLandmarkID(self, fidList, registry):
+        # landmark selected in the interface, or the last one added or moved without interface
+        if self.interface is not None:
+            return registry.findID(self.interface.landmarkComboBox.currentText)
+        markupID = self.activeLandmarkIDs.get(fidList.GetID())
+        return markupID if registry.get(markupID) else None
+
+    def requestProjection(self, fidList, hardenModel, markupID):
+        # until applyProjection snaps it on the surface, the landmark follows the mouse
+        position = numpy.zeros(3)
+        fidList.GetNthFiducialPosition(self.getMarkupIndex(fidList, markupID), position)
+        snapshot = self.locatorCache.getSnapshot(hardenModel.GetID(), hardenModel.GetPolyData())
+        self.projectionWorker.submit((fidList.GetID(), markupID), snapshot, position)
+
+    @instrumentation.timed()
+    def applyProjection(self, key, snapshot, position, closestPointIndex):
+        fidListID, markupID = key
+        fidList = slicer.mrmlScene.GetNodeByID(fidListID)
+        registry = self.getLandmarkRegistry(fidList) if fidList is not None else None
+        landmark = registry.get(markupID) if registry else None
+        if landmark is None or not landmark.isProjected:
+            return
+        index = self.getMarkupIndex(fidList, markupID)
+        currentPosition = numpy.zeros(3)
+        fidList.GetNthFiducialPosition(index, currentPosition)
+        if not numpy.array_equal(currentPosition, position):
+            # the landmark has moved since the request, a newer one is coming
+            self.projectionWorker.staleResults += 1
+            return
+        hardenModel = self.getHardenModel(fidList)
+        if hardenModel is None:
+            return
+        if not snapshot.isCurrent(hardenModel.GetPolyData()):
+            # the model has been modified (e.g. transformed) since the request
+            self.requestProjection(fidList, hardenModel, markupID)
+            return
+        self.updatingFidListIDs.add(fidListID)
+        try:
+            fidList.SetNthFiducialPositionFromArray(index, snapshot.points[closestPointIndex])
+            landmark.closestPointIndex = int(closestPointIndex)
+            registry.markModified()
+            instrumentation.count("projected landmarks")
+            self.updateMidPoint(fidList, markupID)
+            self.findROI(fidList)
+            self.updatePlanesEvent(fidList, None)
+        finally:
+            self.updatingFidListIDs.discard(fidListID)
+
+    @instrumentation.timed()
     def onPointRemovedEvent(self, obj, event):
-        print("------markup deleting-------")
-        landmarkDescription = self.decodeJSON(obj.GetAttribute("landmarkDescription"))
-        IDs = []
-        for ID, value in landmarkDescription.items():
-            isFound = False
-            for n in range(obj.GetNumberOfMarkups()):
-                markupID = obj.GetNthMarkupID(n)
-                if ID == markupID:
-                    isFound = True
-            if not isFound:
-                IDs.append(ID)
+        logging.debug("Markup removed from %s", obj.GetName())
+        registry = self.getLandmarkRegistry(obj)
+        IDs = registry.findRemovedIDs()
+        self.recordEvent("pointRemoved", node=obj.GetID(), markups=IDs)
         for ID in IDs:
-            self.deleteLandmark(obj, landmarkDescription[ID]["landmarkLabel"])
-            landmarkDescription.pop(ID,None)
-        obj.SetAttribute("landmarkDescription",self.encodeJSON(landmarkDescription))
+            self.deleteLandmark(obj, registry.get(ID).landmarkLabel)
+            registry.remove(ID)
 
+    @instrumentation.timed()
     def updatePlanesEvent(self, obj, event):
-        for planeControls in self.interface.planeControlsDictionary.values():
+        if self.interface is None:
+            return
+        planesToClip = list()
+        updatedPlanes = list()
+        for key, planeControls in self.interface.planeControlsDictionary.items():
             if planeControls.fidlist is obj:
-                planeControls.update()
+                updatedPlanes.append(key)
+                if planeControls.updatePlane():
+                    planesToClip.append(planeControls)
+        self.interface.clipPlanesToBox(planesToClip)
+        self.interface.angleTracker.planesModified(updatedPlanes)
 
     def addLandmarkToCombox(self, fidList, combobox, markupID):
         if not fidList:
             return
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        combobox.addItem(landmarkDescription[markupID]["landmarkLabel"])
+        registry = self.getLandmarkRegistry(fidList)
+        combobox.addItem(registry.get(markupID).landmarkLabel)
 
     def updateAllLandmarkComboBox(self, fidList, markupID):
         # update of the Combobox that are always updated
@@ -1113,16 +2370,16 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
 
     def updateLandmarkComboBox(self, fidList, combobox, displayMidPoint = True):
         combobox.blockSignals(True)
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
         combobox.clear()
         if not fidList:
             return
+        registry = self.getLandmarkRegistry(fidList)
         numOfFid = fidList.GetNumberOfMarkups()
         if numOfFid > 0:
             for i in range(0, numOfFid):
                 if displayMidPoint is False:
                     ID = fidList.GetNthMarkupID(i)
-                    if not landmarkDescription[ID]["midPoint"]["isMidPoint"]:
+                    if not registry.get(ID).isMidPoint:
                         landmarkLabel = fidList.GetNthMarkupLabel(i)
                         combobox.addItem(landmarkLabel)
                 else:
@@ -1133,6 +2390,8 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
 
     def deleteLandmark(self, fidList, label):
         # update of the Combobox that are always updated
+        if self.interface is None:
+            return
         self.interface.landmarkComboBox.removeItem(self.interface.landmarkComboBox.findText(label))
         for planeControls in self.interface.planeControlsDictionary.values():
             if planeControls.fidlist is fidList:
@@ -1140,24 +2399,35 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
                 planeControls.landmark2ComboBox.removeItem(planeControls.landmark2ComboBox.findText(label))
                 planeControls.landmark3ComboBox.removeItem(planeControls.landmark3ComboBox.findText(label))
 
+    def updateLandmarkLabel(self, fidList, markupID, landmarkLabel):
+        oldLabel = self.getLandmarkRegistry(fidList).setLabel(markupID, landmarkLabel)
+        if oldLabel is None or self.interface is None:
+            return
+        comboBoxes = [self.interface.landmarkComboBox]
+        for planeControls in self.interface.planeControlsDictionary.values():
+            if planeControls.fidlist is fidList:
+                comboBoxes += [planeControls.landmark1ComboBox,
+                               planeControls.landmark2ComboBox,
+                               planeControls.landmark3ComboBox]
+        key = self.interface.selectPlaneForMidPoint.currentText
+        if key in self.interface.planeControlsDictionary \
+                and self.interface.planeControlsDictionary[key].fidlist is fidList:
+            comboBoxes += [self.interface.landmarkComboBox1MidPoint, self.interface.landmarkComboBox2MidPoint]
+        for combobox in comboBoxes:
+            index = combobox.findText(oldLabel)
+            if index > -1:
+                combobox.setItemText(index, landmarkLabel)
+
     def findIDFromLabel(self, fidList, landmarkLabel):
         # find the ID of the markupsNode from the label of a landmark!
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
-        for ID, value in landmarkDescription.items():
-            if value["landmarkLabel"] == landmarkLabel:
-                return ID
-        return None
+        return self.getLandmarkRegistry(fidList).findID(landmarkLabel)
 
-    def getClosestPointIndex(self, fidNode, inputPolyData, landmarkID):
+    def getClosestPointIndex(self, fidNode, inputPolyData, landmarkID, modelID=None):
         landmarkCoord = numpy.zeros(3)
         landmarkCoord[1] = 42
         fidNode.GetNthFiducialPosition(landmarkID, landmarkCoord)
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(inputPolyData)
-        pointLocator.AutomaticOn()
-        pointLocator.BuildLocator()
-        indexClosestPoint = pointLocator.FindClosestPoint(landmarkCoord)
-        return indexClosestPoint
+        indexClosestPoint = self.getClosestPointIndices(inputPolyData, [landmarkCoord], modelID)[0]
+        return int(indexClosestPoint)
 
     def replaceLandmark(self, inputModelPolyData, fidNode, landmarkID, indexClosestPoint):
         landmarkCoord = [-1, -1, -1]
@@ -1166,179 +2436,117 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
 
     def projectOnSurface(self, modelOnProject, fidNode, selectedFidReflID):
         if selectedFidReflID:
-            markupsIndex = fidNode.GetNthControlPointIndexByID(selectedFidReflID)
-            indexClosestPoint = self.getClosestPointIndex(fidNode, modelOnProject.GetPolyData(), markupsIndex)
+            markupsIndex = self.getMarkupIndex(fidNode, selectedFidReflID)
+            indexClosestPoint = self.getClosestPointIndex(fidNode, modelOnProject.GetPolyData(), markupsIndex,
+                                                          modelOnProject.GetID())
             self.replaceLandmark(modelOnProject.GetPolyData(), fidNode, markupsIndex, indexClosestPoint)
             return indexClosestPoint
 
+    def getLandmarkPositions(self, fidNode, markupIDs):
+        # (N,3) array with the positions of the given markups
+        coords = numpy.zeros((len(markupIDs), 3))
+        for i, markupID in enumerate(markupIDs):
+            fidNode.GetNthFiducialPosition(self.getMarkupIndex(fidNode, markupID), coords[i])
+        return coords
+
+    def getClosestPointIndices(self, inputPolyData, coords, modelID=None):
+        # query the (cached) locator once for every row of coords
+        if modelID:
+            pointLocator = self.locatorCache.getLocator(modelID, inputPolyData)
+        else:
+            pointLocator = vtk.vtkPointLocator()
+            pointLocator.SetDataSet(inputPolyData)
+            pointLocator.AutomaticOn()
+            pointLocator.BuildLocator()
+        findClosestPoint = pointLocator.FindClosestPoint
+        return numpy.fromiter((findClosestPoint(coord) for coord in coords), dtype=numpy.int64, count=len(coords))
+
+    def replaceLandmarks(self, inputModelPolyData, fidNode, markupIDs, indicesClosestPoint):
+        # move all the markups at once, the modified events are sent when EndModify is called
+        if len(markupIDs) == 0:
+            return
+        points = vtk_to_numpy(inputModelPolyData.GetPoints().GetData())
+        coords = points[numpy.asarray(indicesClosestPoint, dtype=numpy.int64)]
+        wasModifying = fidNode.StartModify()
+        for markupID, coord in zip(markupIDs, coords):
+            markupsIndex = self.getMarkupIndex(fidNode, markupID)
+            fidNode.SetNthFiducialPositionFromArray(markupsIndex, coord)
+        fidNode.EndModify(wasModifying)
+
+    @instrumentation.timed()
+    def projectLandmarksOnSurface(self, modelOnProject, fidNode, markupIDs):
+        """Project several landmarks in one pass and return {markupID: closestPointIndex}"""
+        markupIDs = [markupID for markupID in markupIDs if markupID]
+        if not markupIDs:
+            return dict()
+        polyData = modelOnProject.GetPolyData()
+        coords = self.getLandmarkPositions(fidNode, markupIDs)
+        indicesClosestPoint = self.getClosestPointIndices(polyData, coords, modelOnProject.GetID())
+        self.replaceLandmarks(polyData, fidNode, markupIDs, indicesClosestPoint)
+        instrumentation.count("projected landmarks", len(markupIDs))
+        return dict(zip(markupIDs, indicesClosestPoint.tolist()))
+
     def calculateMidPointCoord(self, fidList, landmark1ID, landmark2ID):
         """Set the midpoint when you know the the mrml nodes"""
-        landmark1Index = fidList.GetNthControlPointIndexByID(landmark1ID)
-        landmark2Index = fidList.GetNthControlPointIndexByID(landmark2ID)
+        landmark1Index = self.getMarkupIndex(fidList, landmark1ID)
+        landmark2Index = self.getMarkupIndex(fidList, landmark2ID)
         coord1 = [-1, -1, -1]
         coord2 = [-1, -1, -1]
         fidList.GetNthFiducialPosition(landmark1Index, coord1)
         fidList.GetNthFiducialPosition(landmark2Index, coord2)
-        midCoord = [-1, -1, -1]
-        midCoord[0] = int((coord1[0] + coord2[0]) / 2)
-        midCoord[1] = int((coord1[1] + coord2[1]) / 2)
-        midCoord[2] = int((coord1[2] + coord2[2]) / 2)
-        return midCoord
+        return geometry.midPoints(coord1, coord2).tolist()
+
+    def getSliceNode(self, colorPlane):
+        return slicer.mrmlScene.GetNodeByID(self.ColorNodeCorrespondence[colorPlane])
 
     def getMatrix(self, slice):
-        # print "--- get Matrix ---"
+        # Matrix with the elements of SliceToRAS, copied in one call
         self.mat = slice.GetSliceToRAS()
-        # print self.mat
-        # Matrix with the elements of SliceToRAS
-        m = numpy.matrix([[self.mat.GetElement(0, 0), self.mat.GetElement(0, 1), self.mat.GetElement(0, 2), self.mat.GetElement(0, 3)],
-                          [self.mat.GetElement(1, 0), self.mat.GetElement(1, 1), self.mat.GetElement(1, 2), self.mat.GetElement(1, 3)],
-                          [self.mat.GetElement(2, 0), self.mat.GetElement(2, 1), self.mat.GetElement(2, 2), self.mat.GetElement(2, 3)],
-                          [self.mat.GetElement(3, 0), self.mat.GetElement(3, 1), self.mat.GetElement(3, 2), self.mat.GetElement(3, 3)]])
-        # print m
-        return m
+        return numpy.matrix(slicer.util.arrayFromVTKMatrix(self.mat))
+
+    def getSliceNormal(self, slice):
+        """Normal of a slice as given by defineNormal, cached until its SliceToRAS matrix is modified"""
+        sliceToRAS = slice.GetSliceToRAS()
+        entry = self.sliceNormals.get(slice.GetID())
+        if entry is not None and entry[0] is sliceToRAS and entry[1] == sliceToRAS.GetMTime():
+            return entry[2]
+        normal = self.defineNormal(slicer.util.arrayFromVTKMatrix(sliceToRAS))
+        self.sliceNormals[slice.GetID()] = (sliceToRAS, sliceToRAS.GetMTime(), normal)
+        return normal
 
     def defineNormal(self, matrix):
-        # print "--- defineNormal ---"
-        # Normal vector to the Red slice:
-        n_vector = numpy.matrix([[0], [0], [1], [1]])
+        # (4, 1) matrix, as it used to be
+        normal = geometry.sliceNormals(matrix)
+        return numpy.matrix([[normal[0]], [normal[1]], [normal[2]], [1.0]])
 
-        # point on the Red slice:
-        A = numpy.matrix([[0], [0], [0], [1]])
+    def computeAngleMatrices(self, normals):
+        """Angles between all the pairs of planes defined by an (N, 3) array of normals (see geometry.angleMatrices)"""
+        return geometry.angleMatrices(normals)
 
-        normalVector = matrix * n_vector
-        # print "n : \n", normalVector
-        A = matrix * A
-
-        normalVector1 = normalVector
-
-        normalVector1[0] = normalVector[0] - A[0]
-        normalVector1[1] = normalVector[1] - A[1]
-        normalVector1[2] = normalVector[2] - A[2]
-
-        # print normalVector1
-
-        return normalVector1
+    def getPlaneNormal(self, normal):
+        # normals are either (4, 1) matrices given by defineNormal or (3, 1) matrices given by normalLandmarks
+        return numpy.asarray(normal, dtype=numpy.float64).ravel()[:3]
 
     def getAngle(self, normalVect1, normalVect2):
-        # print "--- getAngle ---"
-        norm1 = sqrt(
-            normalVect1[0] * normalVect1[0] + normalVect1[1] * normalVect1[1] + normalVect1[2] * normalVect1[2])
-        # print "norme 1: \n", norm1
-        norm2 = sqrt(
-            normalVect2[0] * normalVect2[0] + normalVect2[1] * normalVect2[1] + normalVect2[2] * normalVect2[2])
-        # print "norme 2: \n", norm2
-
-
-        scalar_product = (
-            normalVect1[0] * normalVect2[0] + normalVect1[1] * normalVect2[1] + normalVect1[2] * normalVect2[2])
-        # print "scalar product : \n", scalar_product
-
-        angle = acos(scalar_product / (norm1 * norm2))
-
-        # print "radian angle : ", angle
-
-        angle_degree = angle * 180 / pi
-        # print "Angle in degree", angle_degree
-
-
-        norm1_RL = sqrt(normalVect1[1] * normalVect1[1] + normalVect1[2] * normalVect1[2])
-        # print "norme RL: \n", norm1_RL
-        norm2_RL = sqrt(normalVect2[1] * normalVect2[1] + normalVect2[2] * normalVect2[2])
-        # print "norme RL: \n", norm2_RL
-
-        if (norm1_RL == 0 or norm2_RL == 0):
-            self.angle_degre_RL = 0
-            self.angle_degre_RL_comp = 0
-        else:
-            scalar_product_RL = (normalVect1[1] * normalVect2[1] + normalVect1[2] * normalVect2[2])
-            # print "scalar product : \n", scalar_product_RL
-            inter = scalar_product_RL / (norm1_RL * norm2_RL)
-            if inter >= [[ 0.99999]]:
-                angleRL = 0
+        angles = self.computeAngleMatrices([self.getPlaneNormal(normalVect1), self.getPlaneNormal(normalVect2)])
+        for view in ["RL", "SI", "AP"]:
+            angle = angles[view][0, 1]
+            if numpy.isnan(angle):
+                setattr(self, "angle_degre_" + view, 0)
+                setattr(self, "angle_degre_" + view + "_comp", 0)
             else:
-                angleRL = acos(inter)
-            # print "radian angle : ", angleRL
-
-            self.angle_degre_RL = angleRL * 180 / pi
-            self.angle_degre_RL = round(self.angle_degre_RL, 2)
-            # print self.angle_degre_RL
-            self.angle_degre_RL_comp = 180 - self.angle_degre_RL
-
-        norm1_SI = sqrt(normalVect1[0] * normalVect1[0] + normalVect1[1] * normalVect1[1])
-        # print "norme1_SI : \n", norm1_SI
-        norm2_SI = sqrt(normalVect2[0] * normalVect2[0] + normalVect2[1] * normalVect2[1])
-        # print "norme2_SI : \n", norm2_SI
-
-        if (norm1_SI == 0 or norm2_SI == 0):
-            self.angle_degre_SI = 0
-            self.angle_degre_SI_comp = 0
-        else:
-            scalar_product_SI = (normalVect1[0] * normalVect2[0] + normalVect1[1] * normalVect2[1])
-            # print "scalar product_SI : \n", scalar_product_SI
-
-            inter = scalar_product_SI / (norm1_SI * norm2_SI)
-            if inter >= [[ 0.99999]]:
-                angleSI = 0
-            else:
-                angleSI = acos(inter)
-            # print "radian angle : ", angleSI
-
-            self.angle_degre_SI = angleSI * 180 / pi
-            self.angle_degre_SI = round(self.angle_degre_SI, 2)
-            # print self.angle_degre_SI
-            self.angle_degre_SI_comp = 180 - self.angle_degre_SI
-            # print self.angle_degre_SI_comp
-
-        norm1_AP = sqrt(normalVect1[0] * normalVect1[0] + normalVect1[2] * normalVect1[2])
-        # print "norme1_SI : \n", norm1_AP
-        norm2_AP = sqrt(normalVect2[0] * normalVect2[0] + normalVect2[2] * normalVect2[2])
-        # print "norme2_SI : \n", norm2_AP
-
-        if (norm1_AP == 0 or norm2_AP == 0):
-            self.angle_degre_AP = 0
-            self.angle_degre_AP_comp = 0
-        else:
-            scalar_product_AP = (normalVect1[0] * normalVect2[0] + normalVect1[2] * normalVect2[2])
-            # print "scalar product_SI : \n", scalar_product_AP
-
-            # print "VALUE :", scalar_product_AP/(norm1_AP*norm2_AP)
-            inter = scalar_product_AP / (norm1_AP * norm2_AP)
-            if inter >= [[ 0.99999]]:
-                angleAP = 0
-            else:
-                angleAP = acos(inter)
-
-            # print "radian angle : ", angleAP
-
-            self.angle_degre_AP = angleAP * 180 / pi
-            self.angle_degre_AP = round(self.angle_degre_AP, 2)
-            # print self.angle_degre_AP
-            self.angle_degre_AP_comp = 180 - self.angle_degre_AP
+                angle = round(float(angle), 2)
+                setattr(self, "angle_degre_" + view, angle)
+                setattr(self, "angle_degre_" + view + "_comp", 180 - angle)
 
     def normalLandmarks(self, GA, GB):
-        # print "--- normalLandmarks ---"
-        Vn = numpy.matrix([[0], [0], [0]])
-        Vn[0] = GA[1] * GB[2] - GA[2] * GB[1]
-        Vn[1] = GA[2] * GB[0] - GA[0] * GB[2]
-        Vn[2] = GA[0] * GB[1] - GA[1] * GB[0]
-
-        # print "Vn = ",Vn
-
-        norm_Vn = sqrt(Vn[0] * Vn[0] + Vn[1] * Vn[1] + Vn[2] * Vn[2])
-
-        # print "norm_Vn = ",norm_Vn
-
-        Normal = Vn / norm_Vn
-
-        # print "N = ",Normal
-
-        return Normal
+        normal = geometry.landmarkNormals(GA, GB)
+        return numpy.matrix(normal).T
 
-    def planeLandmarks(self, fidList, Landmark1Label, Landmark2Label, Landmark3Label, Normal,
-                       AdaptToBoundingBoxCheckBox, sliderOpacity, planeCollection, actor):
-        # print "--- planeLandmarks ---"
-        # Limit the number of 3 landmarks to define a plane
-        # Keep the coordinates of the landmarks
+    @instrumentation.timed()
+    def planeLandmarks(self, fidList, Landmark1Label, Landmark2Label, Landmark3Label, planeSource,
+                       adaptToBoundingBox):
+        # Place planeSource on the 3 landmarks and return the normal of the plane
         landmark1ID = self.findIDFromLabel(fidList, Landmark1Label)
         landmark2ID = self.findIDFromLabel(fidList, Landmark2Label)
         landmark3ID = self.findIDFromLabel(fidList, Landmark3Label)
@@ -1347,148 +2555,87 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
             # print "landmark not defined"
             return
 
-        if AdaptToBoundingBoxCheckBox.isChecked():
+        if adaptToBoundingBox:
             slider = 10000
         else:
             slider = 1
 
-        coord = numpy.zeros(3)
-        landmark1Index = fidList.GetNthControlPointIndexByID(landmark1ID)
-        fidList.GetNthFiducialPosition(landmark1Index, coord)
-        # print "Landmark1Value: ", coord
-        r1 = coord[0]
-        a1 = coord[1]
-        s1 = coord[2]
-        landmark2Index = fidList.GetNthControlPointIndexByID(landmark2ID)
-        fidList.GetNthFiducialPosition(landmark2Index, coord)
-        # print "Landmark2Value: ", coord
-        r2 = coord[0]
-        a2 = coord[1]
-        s2 = coord[2]
-        landmark3Index = fidList.GetNthControlPointIndexByID(landmark3ID)
-        fidList.GetNthFiducialPosition(landmark3Index, coord)
-        # print "Landmark3Value: ", coord
-        r3 = coord[0]
-        a3 = coord[1]
-        s3 = coord[2]
-
-        points = vtk.vtkPoints()
-        if points.GetNumberOfPoints() == 0:
-            points.InsertNextPoint(r1, a1, s1)
-            points.InsertNextPoint(r2, a2, s2)
-            points.InsertNextPoint(r3, a3, s3)
-        else:
-            points.SetPoint(0, r1, a1, s1)
-            points.SetPoint(1, r2, a2, s2)
-            points.SetPoint(2, r3, a3, s3)
-        # print "points ", points
-
-        polydata = vtk.vtkPolyData()
-        polydata.SetPoints(points)
-
-        centerOfMass = vtk.vtkCenterOfMass()
-        centerOfMass.SetInputData(polydata)
-        centerOfMass.SetUseScalarsAsWeights(False)
-        centerOfMass.Update()
-
-        G = centerOfMass.GetCenter()
-
-        # print "Center of mass = ",G
-
-        A = (r1, a1, s1)
-        B = (r2, a2, s2)
-        C = (r3, a3, s3)
-
-        # Vector GA
-        GA = numpy.matrix([[0.0], [0.0], [0.0]])
-        GA[0] = A[0] - G[0]
-        GA[1] = A[1] - G[1]
-        GA[2] = A[2] - G[2]
-
-        # print "GA = ", GA
-
-        # Vector BG
-        GB = numpy.matrix([[0.0], [0.0], [0.0]])
-        GB[0] = B[0] - G[0]
-        GB[1] = B[1] - G[1]
-        GB[2] = B[2] - G[2]
-
-        # print "GB = ", GB
-
-        # Vector CG
-        GC = numpy.matrix([[0.0], [0.0], [0.0]])
-        GC[0] = C[0] - G[0]
-        GC[1] = C[1] - G[1]
-        GC[2] = C[2] - G[2]
-
-        # print "GC = ", GC
-
-        normal = self.normalLandmarks(GA, GB)
+        # A, B and C are the rows of coords
+        coords = self.getLandmarkPositions(fidList, [landmark1ID, landmark2ID, landmark3ID])
+        normal = numpy.matrix(geometry.planeNormals(coords)).T
+        D, E, F = geometry.planeCorners(coords, slider)
 
-        D = numpy.matrix([[0.0], [0.0], [0.0]])
-        E = numpy.matrix([[0.0], [0.0], [0.0]])
-        F = numpy.matrix([[0.0], [0.0], [0.0]])
-
-        D[0] = slider * GA[0] + G[0]
-        D[1] = slider * GA[1] + G[1]
-        D[2] = slider * GA[2] + G[2]
-
-        # print "Slider value : ", slider
-
-        # print "D = ",D
-
-        E[0] = slider * GB[0] + G[0]
-        E[1] = slider * GB[1] + G[1]
-        E[2] = slider * GB[2] + G[2]
-
-        # print "E = ",E
-
-        F[0] = slider * GC[0] + G[0]
-        F[1] = slider * GC[1] + G[1]
-        F[2] = slider * GC[2] + G[2]
-
-        # print "F = ",F
-
-        planeSource = vtk.vtkPlaneSource()
         planeSource.SetNormal(normal[0], normal[1], normal[2])
 
         planeSource.SetOrigin(D[0], D[1], D[2])
         planeSource.SetPoint1(E[0], E[1], E[2])
         planeSource.SetPoint2(F[0], F[1], F[2])
 
-        planeSource.Update()
+        return normal
 
-        if AdaptToBoundingBoxCheckBox.isChecked():
-            clipper = vtk.vtkClipClosedSurface()
-            clipper.SetClippingPlanes(planeCollection)
-            clipper.SetInputData(planeSource.GetOutput())
-            clipper.Update()
-            plane = clipper.GetOutput()
-        else:
-            plane = planeSource.GetOutput()
+    @instrumentation.timed()
+    def estimateAngleUncertainty(self, planes, sd, samples=2000, reproject=True, seed=None):
+        """Distributions of the angles between two planes whose landmarks are jittered (see AnglePlanesLib.uncertainty).
 
-        mapper = vtk.vtkPolyDataMapper()
-        mapper.SetInputData(plane)
-        mapper.Update()
+        A plane is either a fixed normal (slice) or (fiducial list, landmark labels). Each landmark gets an
+        isotropic standard deviation sd (mm). With reproject, the samples of the projected landmarks are
+        projected on their model. The normals of the samples are computed as the ones of the displayed angles
+        (geometry.measuredPlanes), so that sd = 0 gives back the displayed angles.
+        Returns the summary of each angle, None if a landmark is not found.
+        """
+        columns = OrderedDict()
+        landmarkPlanes = list()
+        for plane in planes:
+            if not isinstance(plane, tuple):
+                continue
+            fidList, labels = plane
+            indices = list()
+            for label in labels:
+                markupID = self.findIDFromLabel(fidList, label)
+                if not markupID:
+                    return None
+                indices.append(columns.setdefault((fidList, markupID), len(columns)))
+            landmarkPlanes.append(indices)
+        landmarks = numpy.zeros((len(columns), 3))
+        for (fidList, markupID), column in columns.items():
+            fidList.GetNthFiducialPosition(self.getMarkupIndex(fidList, markupID), landmarks[column])
+        covariances = uncertainty.landmarkCovariances(len(columns), sd)
+        positions = uncertainty.sampleLandmarks(landmarks, covariances, samples, numpy.random.default_rng(seed))
+        if reproject:
+            for fidList in set(fidList for fidList, markupID in columns):
+                registry = self.getLandmarkRegistry(fidList)
+                projected = [column for (otherList, markupID), column in columns.items()
+                             if otherList is fidList and registry.get(markupID).isProjected]
+                if not projected:
+                    continue
+                hardenModel = self.getHardenModel(fidList)
+                polyData = hardenModel.GetPolyData()
+                indices = self.getClosestPointIndices(polyData, positions[:, projected].reshape(-1, 3), hardenModel.GetID())
+                points = vtk_to_numpy(polyData.GetPoints().GetData())
+                positions[:, projected] = points[indices].reshape(samples, len(projected), 3)
+        if landmarkPlanes:
+            landmarkNormals = iter(numpy.moveaxis(uncertainty.samplePlaneNormals(positions, landmarkPlanes), 1, 0))
+        normals = [next(landmarkNormals) if isinstance(plane, tuple)
+                   else numpy.broadcast_to(numpy.asarray(plane, dtype=numpy.float64), (samples, 3))
+                   for plane in planes]
+        return uncertainty.angleDistributions(normals[0], normals[1])
+
+    def getThreeDViews(self):
+        layoutManager = slicer.app.layoutManager()
+        return [layoutManager.threeDWidget(i).threeDView() for i in range(0, layoutManager.threeDViewCount)]
 
-        actor.SetMapper(mapper)
-        actor.GetProperty().SetColor(0, 0.4, 0.8)
-        actor.GetProperty().SetOpacity(sliderOpacity)
+    def addActorToThreeDViews(self, actor):
+        # AddViewProp does nothing if the renderer already has the actor
+        threeDViews = self.getThreeDViews()
+        for threeDView in threeDViews:
+            renderer = threeDView.renderWindow().GetRenderers().GetFirstRenderer()
+            renderer.AddViewProp(actor)
+        return len(threeDViews)
 
-        renderer = list()
-        renderWindow = list()
-        layoutManager = slicer.app.layoutManager()
-        for i in range(0, layoutManager.threeDViewCount):
-            threeDWidget = layoutManager.threeDWidget(i)
-            threeDView = threeDWidget.threeDView()
-            renderWindow.append(threeDView.renderWindow())
-            renderers = renderWindow[i].GetRenderers()
-            renderer.append(renderers.GetFirstRenderer())
-            renderer[i].AddViewProp(actor)
-            renderWindow[i].AddRenderer(renderer[i])
-            renderer[i].Render()
-            renderWindow[i].Render()
-        return normal
+    def requestRender(self):
+        # scheduleRender compresses all the requests received before the next frame into one render
+        for threeDView in self.getThreeDViews():
+            threeDView.scheduleRender()
 
     def GetConnectedVertices(self, connectedVerticesIDList, polyData, pointID):
         # Return IDs of all the vertices that compose the first neighbor.
@@ -1505,63 +2652,108 @@ class AnglePlanesLogic(ScriptedLoadableModuleLogic):
                 connectedVerticesIDList.InsertUniqueId(pointIdList.GetId(j))
         return connectedVerticesIDList
 
-    def addArrayFromIdList(self, connectedIdList, inputModelNode, arrayName):
-        if not inputModelNode:
-            return
-        inputModelNodePolydata = inputModelNode.GetPolyData()
-        pointData = inputModelNodePolydata.GetPointData()
-        numberofIds = connectedIdList.GetNumberOfIds()
-        hasArrayInt = pointData.HasArray(arrayName)
-        if hasArrayInt == 1:  # ROI Array found
-            pointData.RemoveArray(arrayName)
-        arrayToAdd = vtk.vtkDoubleArray()
-        arrayToAdd.SetName(arrayName)
-        for i in range(0, inputModelNodePolydata.GetNumberOfPoints()):
-            arrayToAdd.InsertNextValue(0.0)
-        for i in range(0, numberofIds):
-            arrayToAdd.SetValue(connectedIdList.GetId(i), 1.0)
+    def defineNeighbor(self, connectedVerticesList, inputModelNodePolyData, indexClosestPoint, distance,
+                       modelID=None):
+        # ROI of 'distance' rings of neighbors around the vertex indexClosestPoint
+        if modelID:
+            indptr, indices = self.adjacencyCache.getAdjacency(modelID, inputModelNodePolyData)
+        else:
+            indptr, indices = meshes.AdjacencyCache.computeAdjacency(inputModelNodePolyData)
+        ROIPointIDs = meshes.growROI(indptr, indices, indexClosestPoint, distance)
+        connectedVerticesList.SetNumberOfIds(len(ROIPointIDs))
+        for i, pointID in enumerate(ROIPointIDs.tolist()):
+            connectedVerticesList.SetId(i, pointID)
+        return ROIPointIDs
+
+    def getROIPointIDs(self, hardenModel, pointID, ROIradius):
+        indptr, indices = self.adjacencyCache.getAdjacency(hardenModel.GetID(), hardenModel.GetPolyData())
+        return meshes.growROI(indptr, indices, pointID, ROIradius)
+
+    def updateROIUnion(self, fidList, hardenModel):
+        """Grow again the ROIs of the landmarks whose projection or radius changed.
+
+        Returns the ROI union of the fiducial list and the vertices that entered or left it.
+        """
+        polyData = hardenModel.GetPolyData()
+        union = self.ROIUnions.get(fidList.GetID())
+        if union is None or not union.isValidFor(polyData):
+            union = AnglePlanesROIUnion(polyData)
+            self.ROIUnions[fidList.GetID()] = union
+        registry = self.getLandmarkRegistry(fidList)
+        changedPointIDs = [numpy.zeros(0, dtype=numpy.int64)]
+        for markupID, landmark in registry.items():
+            key = None
+            if landmark.ROIradius != 0 and landmark.closestPointIndex is not None:
+                key = (landmark.closestPointIndex, landmark.ROIradius)
+            if union.keyOf(markupID) == key:
+                continue
+            if key is None:
+                changedPointIDs.append(union.remove(markupID))
+            else:
+                pointIDs = self.getROIPointIDs(hardenModel, landmark.closestPointIndex, landmark.ROIradius)
+                changedPointIDs.append(union.update(markupID, key, pointIDs))
+        for markupID in union.markupIDs() - set(registry.keys()):
+            changedPointIDs.append(union.remove(markupID))
+        return union, numpy.unique(numpy.concatenate(changedPointIDs))
+
+    def createROIArray(self, inputModelNode, arrayName):
+        polyData = inputModelNode.GetPolyData()
+        ROIArray = vtk.vtkUnsignedCharArray()
+        ROIArray.SetName(arrayName)
+        ROIArray.SetNumberOfTuples(polyData.GetNumberOfPoints())
+        ROIArray.Fill(0)
         lut = vtk.vtkLookupTable()
-        tableSize = 2
-        lut.SetNumberOfTableValues(tableSize)
+        lut.SetNumberOfTableValues(2)
         lut.Build()
-        displayNode = inputModelNode.GetDisplayNode()
-        rgb = displayNode.GetColor()
+        ROIArray.SetLookupTable(lut)
+        polyData.GetPointData().AddArray(ROIArray)
+        return ROIArray
+
+    def updateROIArray(self, inputModelNode, arrayName, union, changedPointIDs):
+        """Write the changed vertices of the ROI union in the ROI array of the model.
+
+        The array is a uint8 array allocated once per model and modified in place through a NumPy view.
+        """
+        if not inputModelNode:
+            return
+        polyData = inputModelNode.GetPolyData()
+        ROIArray = polyData.GetPointData().GetArray(arrayName)
+        if not isinstance(ROIArray, vtk.vtkUnsignedCharArray) \
+                or ROIArray.GetNumberOfTuples() != polyData.GetNumberOfPoints():
+            ROIArray = self.createROIArray(inputModelNode, arrayName)
+            changedPointIDs = union.pointIDs()
+        lut = ROIArray.GetLookupTable()
+        rgb = inputModelNode.GetDisplayNode().GetColor()
         lut.SetTableValue(0, rgb[0], rgb[1], rgb[2], 1)
         lut.SetTableValue(1, 1.0, 0.0, 0.0, 1)
-        arrayToAdd.SetLookupTable(lut)
-        pointData.AddArray(arrayToAdd)
-        inputModelNodePolydata.Modified()
+        values = vtk_to_numpy(ROIArray)
+        values[changedPointIDs] = union.counts[changedPointIDs] > 0
+        ROIArray.Modified()
+        polyData.Modified()
         return True
 
     def displayROI(self, inputModelNode, scalarName):
-        PolyData = inputModelNode.GetPolyData()
-        PolyData.Modified()
         displayNode = inputModelNode.GetModelDisplayNode()
-        displayNode.SetScalarVisibility(False)
+        if displayNode.GetScalarVisibility() and displayNode.GetActiveScalarName() == scalarName:
+            return
         disabledModify = displayNode.StartModify()
         displayNode.SetActiveScalarName(scalarName)
         displayNode.SetScalarVisibility(True)
         displayNode.EndModify(disabledModify)
 
+    @instrumentation.timed()
     def findROI(self, fidList):
-        hardenModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("hardenModelID"))
+        hardenModel = self.getHardenModel(fidList)
         connectedModel = slicer.app.mrmlScene().GetNodeByID(fidList.GetAttribute("connectedModelID"))
-        landmarkDescription = self.decodeJSON(fidList.GetAttribute("landmarkDescription"))
         arrayName = fidList.GetAttribute("arrayName")
-        ROIPointListID = vtk.vtkIdList()
-        for key,activeLandmarkState in landmarkDescription.items():
-            tempROIPointListID = vtk.vtkIdList()
-            if activeLandmarkState["ROIradius"] != 0:
-                self.defineNeighbor(tempROIPointListID,
-                                    hardenModel.GetPolyData(),
-                                    activeLandmarkState["projection"]["closestPointIndex"],
-                                    activeLandmarkState["ROIradius"])
-            for j in range(0, tempROIPointListID.GetNumberOfIds()):
-                ROIPointListID.InsertUniqueId(tempROIPointListID.GetId(j))
-        listID = ROIPointListID
-        self.addArrayFromIdList(listID, connectedModel, arrayName)
+        # only the ROIs of the landmarks that moved are grown again
+        union, changedPointIDs = self.updateROIUnion(fidList, hardenModel)
+        instrumentation.count("ROI vertices updated", len(changedPointIDs))
+        pointData = connectedModel.GetPolyData().GetPointData()
+        if len(changedPointIDs) or not pointData.HasArray(arrayName):
+            self.updateROIArray(connectedModel, arrayName, union, changedPointIDs)
         self.displayROI(connectedModel, arrayName)
-        return ROIPointListID
+        return union.pointIDs()
 
     def savePlanes(self, filename=None):
         tempDictionary = {}
@@ -1668,10 +2860,13 @@ class AnglePlanesTest(ScriptedLoadableModuleTest):
         plane1 = widget.planeControlsDictionary["Plane 1"]
         movingMarkupsFiducial.AddFiducial(8.08220491, -98.03022892, 93.12060543)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         movingMarkupsFiducial.AddFiducial(-64.97482242, -26.20270453, 40.0195569)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         movingMarkupsFiducial.AddFiducial(-81.14900734, -108.26332837, 121.16330592)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         plane1.landmark1ComboBox.setCurrentIndex(0)
         plane1.landmark2ComboBox.setCurrentIndex(1)
         plane1.landmark3ComboBox.setCurrentIndex(2)
@@ -1686,10 +2881,13 @@ class AnglePlanesTest(ScriptedLoadableModuleTest):
         plane2 = widget.planeControlsDictionary["Plane 2"]
         movingMarkupsFiducial.AddFiducial(-39.70435272, -97.08191652, 91.88711809)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         movingMarkupsFiducial.AddFiducial(-96.02709079, -18.26063616, 21.47774342)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         movingMarkupsFiducial.AddFiducial(-127.93278815, -106.45001448, 92.35628815)
         widget.logic.onPointModifiedEvent(movingMarkupsFiducial,None)
+        widget.logic.flushPendingEvents()
         plane2.landmark1ComboBox.setCurrentIndex(0)
         plane2.landmark2ComboBox.setCurrentIndex(1)
         plane2.landmark3ComboBox.setCurrentIndex(2)
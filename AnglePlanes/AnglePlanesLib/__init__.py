@@ -0,0 +1 @@
+"""Parts of AnglePlanes that run without the Slicer application (NumPy and VTK only)."""
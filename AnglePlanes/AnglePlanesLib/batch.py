@@ -0,0 +1,355 @@
+"""Measure the angles between landmark planes over a cohort, without the AnglePlanes interface.
+
+From the AnglePlanes module directory, with Python and VTK:
+
+    python -m AnglePlanesLib.batch manifest.json -o angles.csv -j 8
+
+or with the Python of Slicer:
+
+    Slicer --no-main-window --python-script AnglePlanesLib/batch.py manifest.json -o angles.parquet
+
+The manifest is a JSON file, its relative paths are relative to the manifest:
+
+    {
+      "planes": {"Occlusal": ["Mx-L", "Mx-R", "Inc"], "Mandibular": ["Me", "Go-L", "Go-R"]},
+      "projectOnSurface": true,
+      "cases": [
+        {"id": "patient01", "model": "patient01.vtk", "fiducials": "patient01.fcsv"},
+        {"id": "patient02", "model": "patient02.vtk", "fiducials": "patient02.mrk.json",
+         "planes": {"Occlusal": ["Mx-L", "Mx-R", "Inc"]}}
+      ]
+    }
+
+"planes", "projectOnSurface" and "modelCoordinateSystem" (coordinate system of the models whose file
+does not tell it, "LPS" by default) can be given for the whole cohort or for a case. For each case,
+the landmarks are projected on the model, a plane is placed on the landmarks of each plane and one
+row is written for every pair of planes, as soon as the case is finished. A plane defined by 3
+landmarks is placed as in the module; with more landmarks, it is the least squares plane and the RMS
+distance of its landmarks is written in the rms1/rms2 columns.
+
+With an "uncertainty" entry, the distributions of the angles are estimated by jittering the landmarks
+and their mean, standard deviation and percentiles are written in the 3D_mean, 3D_sd, 3D_p2.5, ...
+columns (see AnglePlanesLib.uncertainty):
+
+    "uncertainty": {"samples": 2000, "sd": 1.0, "landmarkSD": {"Me": 2.5},
+                    "covariances": {"Inc": [[1, 0, 0], [0, 1, 0], [0, 0, 4]]},
+                    "reproject": true, "seed": 0}
+
+"sd" is the isotropic standard deviation (mm) of all the landmarks, "landmarkSD" and "covariances"
+override it per landmark. The samples are projected on the model if "reproject" is true, which is
+the default when the landmarks are projected.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+from collections import OrderedDict
+
+if __name__ == "__main__" and not __package__:
+    # run as a script: the package has to be importable, by this process and by the workers
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+from AnglePlanesLib import geometry, uncertainty
+
+angleColumns = ["3D", "RL", "RL_comp", "SI", "SI_comp", "AP", "AP_comp"]
+fitColumns = ["rms1", "rms2"]
+resultColumns = ["case", "plane1", "plane2"] + angleColumns + fitColumns + ["error"]
+
+modelReaders = {
+    ".vtk": vtk.vtkPolyDataReader,
+    ".vtp": vtk.vtkXMLPolyDataReader,
+    ".stl": vtk.vtkSTLReader,
+    ".obj": vtk.vtkOBJReader,
+    ".ply": vtk.vtkPLYReader,
+}
+
+# meshes already read by this process, (path, mtime, size) -> mesh
+meshCache = OrderedDict()
+meshCacheSize = 4
+
+
+def initializeWorker(cacheSize):
+    global meshCacheSize
+    meshCacheSize = cacheSize
+
+
+def readModel(path):
+    """Read a model file, returns its polydata and its coordinate system if the file tells it"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in modelReaders:
+        raise ValueError("Unsupported model file: %s" % path)
+    reader = modelReaders[extension]()
+    reader.SetFileName(path)
+    reader.Update()
+    polyData = reader.GetOutput()
+    if polyData.GetNumberOfPoints() == 0:
+        raise ValueError("Cannot read the model %s" % path)
+    coordinateSystem = None
+    if extension == ".vtk":
+        # Slicer writes the coordinate system in the header of the legacy files
+        match = re.search(r"SPACE=(RAS|LPS)", reader.GetHeader() or "")
+        if match:
+            coordinateSystem = match.group(1)
+    return polyData, coordinateSystem
+
+
+def getMesh(path, defaultCoordinateSystem="LPS"):
+    """Points and point locator of a model, read once per process"""
+    key = (path, os.path.getmtime(path), os.path.getsize(path))
+    mesh = meshCache.pop(key, None)
+    if mesh is None:
+        polyData, coordinateSystem = readModel(path)
+        locator = vtk.vtkPointLocator()
+        locator.SetDataSet(polyData)
+        locator.AutomaticOn()
+        locator.BuildLocator()
+        mesh = {"polyData": polyData,
+                "points": vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float64),
+                "locator": locator,
+                "coordinateSystem": coordinateSystem}
+    meshCache[key] = mesh
+    while len(meshCache) > meshCacheSize:
+        meshCache.popitem(last=False)
+    if mesh["coordinateSystem"] is None:
+        return dict(mesh, coordinateSystem=defaultCoordinateSystem)
+    return mesh
+
+
+def readFiducials(path):
+    """Read a markups file (.fcsv or .mrk.json), returns {label: position} and its coordinate system"""
+    landmarks = OrderedDict()
+    if path.lower().endswith(".json"):
+        with open(path) as markupsFile:
+            markups = json.load(markupsFile)["markups"][0]
+        coordinateSystem = markups.get("coordinateSystem", "LPS")
+        for controlPoint in markups.get("controlPoints", []):
+            landmarks[controlPoint["label"]] = controlPoint["position"]
+        return landmarks, coordinateSystem
+    coordinateSystem = "RAS"
+    columns = ["id", "x", "y", "z", "ow", "ox", "oy", "oz", "vis", "sel", "lock", "label"]
+    with open(path) as fcsvFile:
+        for row in csv.reader(fcsvFile):
+            if not row:
+                continue
+            if row[0].startswith("#"):
+                header = ",".join(row)[1:].strip()
+                if header.startswith("CoordinateSystem"):
+                    value = header.split("=")[1].strip()
+                    coordinateSystem = {"0": "RAS", "1": "LPS"}.get(value, value)
+                elif header.startswith("columns"):
+                    columns = [column.strip() for column in header.split("=")[1].split(",")]
+                continue
+            values = dict(zip(columns, row))
+            landmarks[values["label"]] = [float(values["x"]), float(values["y"]), float(values["z"])]
+    return landmarks, coordinateSystem
+
+
+def toCoordinateSystem(coords, fromSystem, toSystem):
+    # RAS and LPS only differ by the sign of the first two axes
+    if fromSystem == toSystem:
+        return coords
+    return coords * numpy.array([-1.0, -1.0, 1.0])
+
+
+def measureCase(case):
+    landmarks, fiducialsCoordinateSystem = readFiducials(case["fiducials"])
+    mesh = getMesh(case["model"], case["modelCoordinateSystem"])
+    planes = case["planes"]
+    labels = sorted(set(label for planeLabels in planes.values() for label in planeLabels))
+    missing = [label for label in labels if label not in landmarks]
+    if missing:
+        raise ValueError("Missing landmarks: %s" % ", ".join(missing))
+    coords = numpy.array([landmarks[label] for label in labels], dtype=numpy.float64)
+    coords = toCoordinateSystem(coords, fiducialsCoordinateSystem, mesh["coordinateSystem"])
+    if case["projectOnSurface"]:
+        findClosestPoint = mesh["locator"].FindClosestPoint
+        coords = mesh["points"][[findClosestPoint(coord) for coord in coords]]
+    positions = dict(zip(labels, coords))
+    names = list(planes.keys())
+    if len(names) < 2:
+        return []
+    # the planes are padded to the same number of landmarks and fitted at once
+    counts = numpy.array([len(planes[name]) for name in names])
+    stacked = numpy.zeros((len(names), counts.max(), 3))
+    for i, name in enumerate(names):
+        stacked[i, :counts[i]] = [positions[label] for label in planes[name]]
+    normals, centroids, rms = geometry.measuredPlanes(stacked, numpy.arange(counts.max()) < counts[:, numpy.newaxis])
+    angles = geometry.angleMatrices(normals)
+    rows = []
+    for i, j in zip(*numpy.triu_indices(len(names), 1)):
+        row = OrderedDict([("case", case["id"]), ("plane1", names[i]), ("plane2", names[j])])
+        for column in angleColumns:
+            row[column] = float(angles[column][i, j])
+        row["rms1"] = float(rms[i])
+        row["rms2"] = float(rms[j])
+        row["error"] = ""
+        rows.append(row)
+    if case.get("uncertainty"):
+        addUncertainty(rows, case, mesh, labels, positions, names)
+    return rows
+
+
+def addUncertainty(rows, case, mesh, labels, positions, names):
+    options = case["uncertainty"]
+    index = dict((label, i) for i, label in enumerate(labels))
+    covariances = uncertainty.landmarkCovariances(
+        len(labels), options.get("sd", 1.0),
+        dict((index[label], sd) for label, sd in options.get("landmarkSD", dict()).items() if label in index),
+        dict((index[label], covariance) for label, covariance in options.get("covariances", dict()).items()
+             if label in index))
+    project = None
+    if options.get("reproject", case["projectOnSurface"]):
+        findClosestPoint = mesh["locator"].FindClosestPoint
+
+        def project(samples):
+            closest = [findClosestPoint(coord) for coord in samples.reshape(-1, 3)]
+            return mesh["points"][closest].reshape(samples.shape)
+    planes = [[index[label] for label in case["planes"][name]] for name in names]
+    pairs = list(zip(*numpy.triu_indices(len(names), 1)))
+    landmarks = numpy.array([positions[label] for label in labels])
+    distributions = uncertainty.angleUncertainty(landmarks, planes, pairs, covariances,
+                                                 options.get("samples", 1000), project, options.get("seed"))
+    for row, distribution in zip(rows, distributions):
+        for view, summary in distribution.items():
+            for name, value in summary.items():
+                row["%s_%s" % (view, name)] = value
+
+
+def processCase(case):
+    """Measure one case in a worker, returns (case id, rows), errors are reported in the rows"""
+    try:
+        return case["id"], measureCase(case)
+    except Exception as e:
+        row = OrderedDict((column, None) for column in resultColumns)
+        row["case"] = case["id"]
+        row["error"] = str(e) or e.__class__.__name__
+        return case["id"], [row]
+
+
+def readManifest(path):
+    with open(path) as manifestFile:
+        manifest = json.load(manifestFile)
+    directory = os.path.dirname(os.path.abspath(path))
+    cases = []
+    for index, entry in enumerate(manifest["cases"]):
+        case = {
+            "id": str(entry.get("id", index)),
+            "model": os.path.join(directory, entry["model"]),
+            "fiducials": os.path.join(directory, entry["fiducials"]),
+            "planes": OrderedDict(entry.get("planes", manifest.get("planes", {}))),
+            "projectOnSurface": entry.get("projectOnSurface", manifest.get("projectOnSurface", True)),
+            "modelCoordinateSystem": entry.get("modelCoordinateSystem",
+                                               manifest.get("modelCoordinateSystem", "LPS")),
+            "uncertainty": entry.get("uncertainty", manifest.get("uncertainty")),
+        }
+        for name, labels in case["planes"].items():
+            if len(labels) < 3:
+                raise ValueError("Plane %s of case %s is not defined by at least 3 landmarks" % (name, case["id"]))
+        cases.append(case)
+    return cases
+
+
+class ResultWriter(object):
+    """Append the rows of the cases to a CSV file, or to a Parquet file (requires pyarrow)"""
+    def __init__(self, path, columns=resultColumns):
+        self.path = path
+        self.csvFile = None
+        self.parquetWriter = None
+        if path.lower().endswith(".parquet"):
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise RuntimeError("Writing a Parquet file requires pyarrow, use a .csv output instead")
+            textColumns = ["case", "plane1", "plane2", "error"]
+            self.schema = pyarrow.schema([(column, pyarrow.string() if column in textColumns else pyarrow.float64())
+                                          for column in columns])
+            self.parquetWriter = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.csvFile = open(path, "w", newline="")
+            self.csvWriter = csv.DictWriter(self.csvFile, columns)
+            self.csvWriter.writeheader()
+
+    def write(self, rows):
+        if self.parquetWriter:
+            import pyarrow
+            self.parquetWriter.write_table(pyarrow.Table.from_pylist(rows, schema=self.schema))
+        else:
+            self.csvWriter.writerows(rows)
+            self.csvFile.flush()
+
+    def close(self):
+        if self.parquetWriter:
+            self.parquetWriter.close()
+        if self.csvFile:
+            self.csvFile.close()
+
+
+def runBatch(cases, outputPath, processes=None, cacheSize=4):
+    """Measure the cases on a pool of processes, returns the number of failed cases"""
+    # cases sharing a model follow each other, so that a worker finds it in its mesh cache
+    cases = sorted(cases, key=lambda case: case["model"])
+    columns = resultColumns
+    if any(case.get("uncertainty") for case in cases):
+        columns = resultColumns[:-1] + uncertainty.summaryColumns() + resultColumns[-1:]
+    writer = ResultWriter(outputPath, columns)
+    pool = None
+    failed = 0
+    try:
+        if processes == 1:
+            initializeWorker(cacheSize)
+            results = (processCase(case) for case in cases)
+        else:
+            pool = multiprocessing.Pool(processes, initializer=initializeWorker, initargs=(cacheSize,))
+            results = pool.imap_unordered(processCase, cases)
+        for done, (caseID, rows) in enumerate(results):
+            writer.write(rows)
+            if rows and rows[0]["error"]:
+                failed += 1
+                logging.error("%s failed: %s", caseID, rows[0]["error"])
+            logging.info("%s measured (%d/%d)", caseID, done + 1, len(cases))
+    finally:
+        writer.close()
+        if pool:
+            pool.close()
+            pool.join()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the angles between landmark planes over a cohort.")
+    parser.add_argument("manifest", help="JSON manifest of the cases")
+    parser.add_argument("-o", "--output", required=True, help="output file (.csv or .parquet)")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--cache-size", type=int, default=4, help="number of meshes kept by each worker")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if "slicer" in sys.modules:
+        # the workers must not start the Slicer application
+        pythonSlicer = os.path.join(os.path.dirname(sys.executable), "PythonSlicer")
+        if sys.platform == "win32":
+            pythonSlicer += ".exe"
+        if os.path.exists(pythonSlicer):
+            multiprocessing.set_executable(pythonSlicer)
+    failed = runBatch(readManifest(args.manifest), args.output, args.processes, args.cache_size)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    # the workers find the functions of the module by its package name
+    from AnglePlanesLib.batch import main
+    status = main(sys.argv[1:])
+    if "slicer" in sys.modules:
+        import slicer
+        slicer.util.exit(status)
+    else:
+        sys.exit(status)
@@ -0,0 +1,205 @@
+"""Geometry of the planes and angles of AnglePlanes, with NumPy only.
+
+The functions take and return arrays, with the batch dimensions first: a single plane is a (3, 3)
+array of landmarks and N planes are a (N, 3, 3) array.
+"""
+from collections import OrderedDict
+
+import numpy
+
+# components of the normals kept when the planes are seen from each view
+projectionAxes = OrderedDict([("3D", [0, 1, 2]), ("RL", [1, 2]), ("SI", [0, 1]), ("AP", [0, 2])])
+
+
+def sliceNormals(sliceToRAS):
+    """Normals of slices given their (..., 4, 4) SliceToRAS matrices"""
+    # image of (0, 0, 1) minus image of the origin
+    return numpy.asarray(sliceToRAS, dtype=numpy.float64)[..., :3, 2]
+
+
+def landmarkNormals(GA, GB):
+    """Unit normals of the planes containing the (..., 3) vectors GA and GB"""
+    # the cross product is truncated to integers, as it always was in AnglePlanes
+    normals = numpy.trunc(numpy.cross(GA, GB))
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return normals / numpy.linalg.norm(normals, axis=-1, keepdims=True)
+
+
+def planeCentroids(landmarks):
+    """Centers of mass of (..., 3, 3) landmark triplets"""
+    return numpy.asarray(landmarks, dtype=numpy.float64).mean(axis=-2)
+
+
+def planeNormals(landmarks):
+    """Unit normals of the planes placed on (..., 3, 3) landmark triplets"""
+    landmarks = numpy.asarray(landmarks, dtype=numpy.float64)
+    G = planeCentroids(landmarks)
+    return landmarkNormals(landmarks[..., 0, :] - G, landmarks[..., 1, :] - G)
+
+
+def planeCorners(landmarks, scale=1.0):
+    """Landmarks moved away from their centroid by scale, used as origin and points of a vtkPlaneSource"""
+    landmarks = numpy.asarray(landmarks, dtype=numpy.float64)
+    G = planeCentroids(landmarks)[..., numpy.newaxis, :]
+    return scale * (landmarks - G) + G
+
+
+def midPoints(coords1, coords2):
+    """Middle of (..., 3) pairs of points, truncated to integers as in AnglePlanesLogic.calculateMidPointCoord"""
+    return numpy.trunc((numpy.asarray(coords1, dtype=numpy.float64) + coords2) / 2)
+
+
+def unitProjections(normals, axes):
+    """Normals projected on a view and scaled to unit length, and whether they are defined (not null)"""
+    projected = numpy.asarray(normals, dtype=numpy.float64)[..., axes]
+    norms = numpy.linalg.norm(projected, axis=-1)
+    defined = norms > 0
+    return projected / numpy.where(defined, norms, 1.0)[..., numpy.newaxis], defined
+
+
+def viewAngles(unitVectors1, unitVectors2):
+    """Angles in degrees between unit vectors, 0 from a cosine of 0.99999 as in the original getAngle"""
+    # element-wise products summed in a fixed order: a pair gives the same angle in any batch
+    cosines = sum(unitVectors1[..., k] * unitVectors2[..., k] for k in range(unitVectors1.shape[-1]))
+    cosines = numpy.clip(cosines, -1.0, 1.0)
+    return numpy.where(cosines >= 0.99999, 0.0, numpy.degrees(numpy.arccos(cosines)))
+
+
+def angleMatrices(normals):
+    """Angles in degrees between all the pairs of planes defined by an (N, 3) array of normals.
+
+    Returns a dictionary of N x N matrices: "3D", "RL", "SI", "AP" and their complements
+    ("3D_comp", ...). The angle of a pair is NaN in a view where one of the normals is orthogonal to the view.
+    """
+    normals = numpy.asarray(normals, dtype=numpy.float64).reshape(-1, 3)
+    angles = dict()
+    for view, axes in projectionAxes.items():
+        unitVectors, defined = unitProjections(normals, axes)
+        angle = viewAngles(unitVectors[:, numpy.newaxis, :], unitVectors[numpy.newaxis, :, :])
+        angle[~numpy.logical_and.outer(defined, defined)] = numpy.nan
+        angles[view] = angle
+        angles[view + "_comp"] = 180 - angle
+    return angles
+
+
+def pairAngles(normals1, normals2):
+    """Angles in degrees between the planes of two (..., 3) arrays of normals, compared element-wise.
+
+    Same dictionary and conventions as angleMatrices, which gives exactly the same angle for a pair.
+    """
+    angles = dict()
+    for view, axes in projectionAxes.items():
+        unitVectors1, defined1 = unitProjections(normals1, axes)
+        unitVectors2, defined2 = unitProjections(normals2, axes)
+        angle = numpy.where(defined1 & defined2, viewAngles(unitVectors1, unitVectors2), numpy.nan)
+        angles[view] = angle
+        angles[view + "_comp"] = 180 - angle
+    return angles
+
+
+def fitPlanes(landmarks, mask=None):
+    """Least squares planes of (..., N, 3) arrays of landmarks, N >= 3, fitted with one batched SVD.
+
+    mask is an optional (..., N) boolean array for planes with fewer than N landmarks: the landmarks
+    of each plane come first and the others are padding. Returns the unit normals (..., 3), the
+    centroids (..., 3) and the RMS distance of the landmarks to their plane (...). The normals are
+    oriented like the ones of planeNormals, i.e. towards the cross product of the first two centered
+    landmarks. Planes with fewer than 3 landmarks or with collinear landmarks (no plane defined) get
+    NaN normals, as planeNormals gives for a null cross product.
+    """
+    landmarks = numpy.asarray(landmarks, dtype=numpy.float64)
+    if mask is None:
+        weights = numpy.ones(landmarks.shape[:-1])
+    else:
+        weights = numpy.asarray(mask, dtype=numpy.float64)
+        # the padding may hold anything, NaN included
+        landmarks = numpy.where(weights[..., numpy.newaxis] > 0, landmarks, 0.0)
+    counts = weights.sum(axis=-1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        centroids = (landmarks * weights[..., numpy.newaxis]).sum(axis=-2) / counts[..., numpy.newaxis]
+    # the padding rows are zeroed, so that they do not change the singular vectors
+    centered = numpy.nan_to_num(landmarks - centroids[..., numpy.newaxis, :]) * weights[..., numpy.newaxis]
+    _, singularValues, vt = numpy.linalg.svd(centered, full_matrices=False)
+    normals = vt[..., -1, :]
+    reference = numpy.cross(centered[..., 0, :], centered[..., 1, :])
+    normals = normals * numpy.where((normals * reference).sum(axis=-1) < 0, -1.0, 1.0)[..., numpy.newaxis]
+    # collinear landmarks: the second singular value vanishes too
+    degenerate = singularValues[..., 1] <= 1e-10 * singularValues[..., 0]
+    normals[(counts < 3) | degenerate] = numpy.nan
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        rms = singularValues[..., -1] / numpy.sqrt(counts)
+    return normals, centroids, rms
+
+
+def measuredPlanes(landmarks, mask=None):
+    """Planes as the module measures them: fitPlanes, except for the planes of exactly 3 landmarks
+    whose normals are the ones of planeNormals (truncated cross product), as in the interface.
+
+    Same arguments and results as fitPlanes.
+    """
+    landmarks = numpy.asarray(landmarks, dtype=numpy.float64)
+    normals, centroids, rms = fitPlanes(landmarks, mask)
+    if mask is None:
+        triplets = numpy.full(landmarks.shape[:-2], landmarks.shape[-2] == 3)
+    else:
+        triplets = numpy.asarray(mask).sum(axis=-1) == 3
+    normals[triplets] = planeNormals(landmarks[triplets][..., :3, :])
+    return normals, centroids, rms
+
+
+# corners of a box are numbered x + 2 * y + 4 * z (0 for min, 1 for max)
+boxEdges = numpy.array([[0, 1], [2, 3], [4, 5], [6, 7],
+                        [0, 2], [1, 3], [4, 6], [5, 7],
+                        [0, 4], [1, 5], [2, 6], [3, 7]])
+
+
+def clipPlanesWithBox(origins, normals, bounds):
+    """Intersection of N planes with the box bounds = [xmin, xmax, ymin, ymax, zmin, zmax].
+
+    Returns a list of N arrays containing the ordered vertices (3 to 6) of each clipped polygon,
+    an array is empty if its plane does not cut the box. A plane lying on a face of the box returns
+    that face, whatever the orientation of its normal, whereas vtkClipClosedSurface drops the face
+    when the box is on the negative side of the plane.
+    """
+    origins = numpy.atleast_2d(numpy.asarray(origins, dtype=float))
+    normals = numpy.atleast_2d(numpy.asarray(normals, dtype=float))
+    normals = normals / numpy.linalg.norm(normals, axis=1)[:, numpy.newaxis]
+    corners = numpy.array([[bounds[x], bounds[2 + y], bounds[4 + z]]
+                           for z in (0, 1) for y in (0, 1) for x in (0, 1)], dtype=float)
+    # signed distance of every corner to every plane, (N, 8)
+    distances = normals.dot(corners.T) - numpy.einsum('ij,ij->i', normals, origins)[:, numpy.newaxis]
+    d0 = distances[:, boxEdges[:, 0]]
+    d1 = distances[:, boxEdges[:, 1]]
+    crossing = (d0 * d1 <= 0) & (d0 != d1)
+    t = numpy.where(crossing, d0 / numpy.where(crossing, d0 - d1, 1.0), 0.0)
+    edgeStart = corners[boxEdges[:, 0]]
+    edgeVector = corners[boxEdges[:, 1]] - edgeStart
+    # intersection of every plane with every edge, (N, 12, 3)
+    points = edgeStart + t[:, :, numpy.newaxis] * edgeVector
+    counts = crossing.sum(axis=1)
+    centers = (points * crossing[:, :, numpy.newaxis]).sum(axis=1) / numpy.maximum(counts, 1)[:, numpy.newaxis]
+    # order the vertices by their angle around the center, in the plane
+    helper = numpy.eye(3)[numpy.argmin(numpy.abs(normals), axis=1)]
+    u = numpy.cross(normals, helper)
+    u /= numpy.linalg.norm(u, axis=1)[:, numpy.newaxis]
+    v = numpy.cross(normals, u)
+    relative = points - centers[:, numpy.newaxis, :]
+    angles = numpy.arctan2(numpy.einsum('ijk,ik->ij', relative, v), numpy.einsum('ijk,ik->ij', relative, u))
+    angles[~crossing] = numpy.inf
+    order = numpy.argsort(angles, axis=1)
+    points = numpy.take_along_axis(points, order[:, :, numpy.newaxis], axis=1)
+    # a plane going through a corner cuts several edges at the same point
+    tolerance = 1e-9 * max(numpy.linalg.norm(corners[7] - corners[0]), 1.0)
+    polygons = list()
+    for i in range(0, len(normals)):
+        polygon = points[i, :counts[i]]
+        if len(polygon):
+            step = numpy.linalg.norm(polygon - numpy.roll(polygon, 1, axis=0), axis=1)
+            keep = step > tolerance
+            if not keep.any():
+                keep[0] = True
+            polygon = polygon[keep]
+        if len(polygon) < 3:
+            polygon = numpy.zeros((0, 3))
+        polygons.append(polygon)
+    return polygons
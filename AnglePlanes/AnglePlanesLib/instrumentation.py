@@ -0,0 +1,125 @@
+"""Timers and counters of the callbacks of AnglePlanes.
+
+The instrumentation is disabled by default: a timed function then only checks one attribute
+before being called. The durations of each timer are kept in a ring buffer of fixed size.
+"""
+import collections
+import functools
+import time
+
+import numpy
+
+
+class RingBuffer(object):
+    """Last `size` values appended, and the number of values ever appended"""
+    def __init__(self, size):
+        self.values = numpy.zeros(size)
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def last(self):
+        return self.values[(self.count - 1) % len(self.values)] if self.count else 0.0
+
+    def samples(self):
+        return self.values[:min(self.count, len(self.values))]
+
+
+class Timer(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nullTimer = NullTimer()
+
+
+class Instrumentation(object):
+    def __init__(self, bufferSize=512):
+        self.enabled = False
+        self.bufferSize = bufferSize
+        self.durations = dict()
+        self.counters = collections.Counter()
+
+    def setEnabled(self, enabled):
+        self.enabled = bool(enabled)
+
+    def record(self, name, duration):
+        buffer = self.durations.get(name)
+        if buffer is None:
+            buffer = self.durations[name] = RingBuffer(self.bufferSize)
+        buffer.append(duration)
+
+    def count(self, name, increment=1):
+        if self.enabled:
+            self.counters[name] += increment
+
+    def timer(self, name):
+        """Context manager recording the duration of its block"""
+        if not self.enabled:
+            return nullTimer
+        return Timer(self, name)
+
+    def timed(self, name=None):
+        """Decorator recording the duration of each call of a function"""
+        def decorator(function):
+            timerName = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(timerName, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def histogram(self, name, bins=8):
+        """Counts and edges (in ms) of the durations kept for a timer"""
+        buffer = self.durations.get(name)
+        if buffer is None or buffer.count == 0:
+            return numpy.zeros(bins, dtype=int), numpy.zeros(bins + 1)
+        return numpy.histogram(buffer.samples() * 1000, bins=bins)
+
+    def summary(self):
+        """One row per timer: calls, last, mean, median, 95th percentile and max duration in ms"""
+        rows = []
+        for name in sorted(self.durations):
+            buffer = self.durations[name]
+            samples = buffer.samples() * 1000
+            rows.append({"name": name,
+                         "calls": buffer.count,
+                         "last": float(buffer.last()) * 1000,
+                         "mean": float(samples.mean()),
+                         "median": float(numpy.median(samples)),
+                         "p95": float(numpy.percentile(samples, 95)),
+                         "max": float(samples.max())})
+        return rows
+
+    def reset(self):
+        self.durations = dict()
+        self.counters = collections.Counter()
+
+
+instrumentation = Instrumentation()
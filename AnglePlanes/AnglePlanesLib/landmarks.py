@@ -0,0 +1,231 @@
+"""Landmarks of the fiducial lists and the midpoints that depend on them (pure Python)."""
+import logging
+from collections import OrderedDict
+
+
+class Landmark(object):
+    """Description of one landmark, i.e. one entry of the "landmarkDescription" attribute"""
+    __slots__ = ("markupID", "landmarkLabel", "ROIradius", "isProjected", "closestPointIndex",
+                 "definedByThisMarkup", "isMidPoint", "point1", "point2")
+
+    def __init__(self, markupID, landmarkLabel, isProjected=False):
+        self.markupID = markupID
+        self.landmarkLabel = landmarkLabel
+        self.ROIradius = 0
+        self.isProjected = isProjected
+        self.closestPointIndex = None
+        self.definedByThisMarkup = list()
+        self.isMidPoint = False
+        self.point1 = None
+        self.point2 = None
+
+    @classmethod
+    def fromDescription(cls, markupID, description):
+        projection = description.get("projection", dict())
+        midPoint = description.get("midPoint", dict())
+        landmark = cls(markupID, description.get("landmarkLabel"), projection.get("isProjected", False))
+        landmark.ROIradius = description.get("ROIradius", 0)
+        landmark.closestPointIndex = projection.get("closestPointIndex")
+        landmark.definedByThisMarkup = list(midPoint.get("definedByThisMarkup", list()))
+        landmark.isMidPoint = midPoint.get("isMidPoint", False)
+        landmark.point1 = midPoint.get("Point1")
+        landmark.point2 = midPoint.get("Point2")
+        return landmark
+
+    def toDescription(self):
+        return {"landmarkLabel": self.landmarkLabel,
+                "ROIradius": self.ROIradius,
+                "projection": {"isProjected": self.isProjected,
+                               "closestPointIndex": self.closestPointIndex},
+                "midPoint": {"definedByThisMarkup": list(self.definedByThisMarkup),
+                             "isMidPoint": self.isMidPoint,
+                             "Point1": self.point1,
+                             "Point2": self.point2}}
+
+
+class LandmarkRegistry(object):
+    """Landmarks of one fiducial list, indexed by markup ID, by label and by control point index.
+
+    The indexes are updated incrementally from the PointAdded/PointRemoved/PointModified callbacks;
+    the control point index of a markup is checked on lookup and all the indexes are rebuilt in one
+    pass if the fiducial list was reordered behind our back.
+    The registry is the working copy of the "landmarkDescription" attribute: callbacks read and
+    modify it directly and it is only written back to the node by AnglePlanesLogic.syncLandmarkRegistries
+    (when the scene is saved or when the module is left), with the same schema as before.
+    The midpoints form a dependency graph: the edges go from point1 and point2 to the midpoint and
+    are stored in the definedByThisMarkup lists. The order in which the dependents of a landmark
+    are recomputed is cached until the graph changes.
+    """
+    def __init__(self, fidList, landmarkDescription=None):
+        self.fidList = fidList
+        self.landmarks = OrderedDict()
+        self.labelToID = dict()
+        self.idToIndex = dict()
+        self.dependentOrders = dict()
+        self.modified = False
+        if landmarkDescription:
+            for markupID, description in landmarkDescription.items():
+                self.add(Landmark.fromDescription(markupID, description))
+            self.modified = False
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def __contains__(self, markupID):
+        return markupID in self.landmarks
+
+    def keys(self):
+        return self.landmarks.keys()
+
+    def values(self):
+        return self.landmarks.values()
+
+    def items(self):
+        return self.landmarks.items()
+
+    def get(self, markupID):
+        return self.landmarks.get(markupID)
+
+    def findID(self, landmarkLabel):
+        return self.labelToID.get(landmarkLabel)
+
+    def indexOf(self, markupID):
+        # control point index of a markup, -1 if the markup is not in the fiducial list
+        index = self.idToIndex.get(markupID)
+        if index is None or index >= self.fidList.GetNumberOfMarkups() \
+                or self.fidList.GetNthMarkupID(index) != markupID:
+            self.refreshIndexes()
+            index = self.idToIndex.get(markupID, -1)
+        return index
+
+    def refreshIndexes(self):
+        self.idToIndex = dict((self.fidList.GetNthMarkupID(n), n) for n in range(self.fidList.GetNumberOfMarkups()))
+
+    def findRemovedIDs(self):
+        # one pass over the fiducial list: IDs that are described but no longer in the list
+        self.refreshIndexes()
+        return [markupID for markupID in self.landmarks if markupID not in self.idToIndex]
+
+    def add(self, landmark, index=None):
+        self.landmarks[landmark.markupID] = landmark
+        self.labelToID.setdefault(landmark.landmarkLabel, landmark.markupID)
+        if index is not None:
+            self.idToIndex[landmark.markupID] = index
+        self.dependentOrders = dict()
+        self.modified = True
+
+    def remove(self, markupID):
+        self.idToIndex.pop(markupID, None)
+        landmark = self.landmarks.pop(markupID, None)
+        if landmark is not None:
+            self.forgetLabel(markupID, landmark.landmarkLabel)
+            if landmark.isMidPoint:
+                for pointID in (landmark.point1, landmark.point2):
+                    point = self.landmarks.get(pointID)
+                    if point is not None and markupID in point.definedByThisMarkup:
+                        point.definedByThisMarkup.remove(markupID)
+            self.dependentOrders = dict()
+            self.modified = True
+        return landmark
+
+    def addMidPoint(self, markupID, point1, point2):
+        """Make the landmark markupID the midpoint of the landmarks point1 and point2"""
+        if markupID in (point1, point2) or markupID in self.ancestors(point1) | self.ancestors(point2):
+            raise ValueError("%s cannot be defined by a landmark that depends on it" % markupID)
+        midPoint = self.landmarks[markupID]
+        midPoint.isMidPoint = True
+        midPoint.point1 = point1
+        midPoint.point2 = point2
+        for pointID in (point1, point2):
+            dependents = self.landmarks[pointID].definedByThisMarkup
+            if markupID not in dependents:
+                dependents.append(markupID)
+        self.dependentOrders = dict()
+        self.modified = True
+
+    def ancestors(self, markupID):
+        # landmarks the position of markupID depends on
+        found = set()
+        stack = [markupID]
+        while stack:
+            landmark = self.landmarks.get(stack.pop())
+            if landmark is None or not landmark.isMidPoint:
+                continue
+            for pointID in (landmark.point1, landmark.point2):
+                if pointID not in found:
+                    found.add(pointID)
+                    stack.append(pointID)
+        return found
+
+    def getDependents(self, markupID):
+        # midpoints directly defined by markupID
+        landmark = self.landmarks.get(markupID)
+        if landmark is None:
+            return []
+        return [dependentID for dependentID in landmark.definedByThisMarkup
+                if dependentID in self.landmarks and self.landmarks[dependentID].isMidPoint]
+
+    def dependentsInOrder(self, markupID):
+        """Midpoints depending (transitively) on markupID, each one after the landmarks it depends on.
+
+        The midpoints that are part of a cycle are left out with a warning.
+        """
+        order = self.dependentOrders.get(markupID)
+        if order is not None:
+            return order
+        reachable = set()
+        stack = [markupID]
+        while stack:
+            for dependentID in self.getDependents(stack.pop()):
+                if dependentID not in reachable:
+                    reachable.add(dependentID)
+                    stack.append(dependentID)
+        # Kahn's algorithm on the reachable part of the graph
+        inDegrees = dict.fromkeys(reachable, 0)
+        for ID in reachable | {markupID}:
+            for dependentID in self.getDependents(ID):
+                inDegrees[dependentID] += 1
+        ready = [markupID] if markupID not in reachable else []
+        order = []
+        while ready:
+            ID = ready.pop()
+            if ID != markupID:
+                order.append(ID)
+            for dependentID in self.getDependents(ID):
+                inDegrees[dependentID] -= 1
+                if inDegrees[dependentID] == 0:
+                    ready.append(dependentID)
+        if len(order) < len(reachable):
+            cycle = sorted(reachable.difference(order))
+            logging.warning("The midpoints %s of %s depend on themselves, they are not updated",
+                            ", ".join(self.landmarks[ID].landmarkLabel for ID in cycle), self.fidList.GetName())
+        self.dependentOrders[markupID] = order
+        return order
+
+    def setLabel(self, markupID, landmarkLabel):
+        # returns the previous label if it has changed, None otherwise
+        landmark = self.landmarks.get(markupID)
+        if landmark is None or landmark.landmarkLabel == landmarkLabel:
+            return None
+        oldLabel = landmark.landmarkLabel
+        self.forgetLabel(markupID, oldLabel)
+        landmark.landmarkLabel = landmarkLabel
+        self.labelToID.setdefault(landmarkLabel, markupID)
+        self.modified = True
+        return oldLabel
+
+    def forgetLabel(self, markupID, landmarkLabel):
+        # the label may still be used by another landmark (labels are not unique)
+        if self.labelToID.get(landmarkLabel) != markupID:
+            return
+        del self.labelToID[landmarkLabel]
+        for otherID, landmark in self.landmarks.items():
+            if otherID != markupID and landmark.landmarkLabel == landmarkLabel:
+                self.labelToID[landmarkLabel] = otherID
+                break
+
+    def markModified(self):
+        self.modified = True
+
+    def toDescription(self):
+        return dict((markupID, landmark.toDescription()) for markupID, landmark in self.landmarks.items())
@@ -0,0 +1,211 @@
+"""Point locators and vertex adjacency of the meshes, kept until they change (NumPy and VTK only)."""
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+
+def pointsMTime(polyData):
+    """vtkPoints object of polyData and its MTime: the locators only depend on them.
+
+    The MTime of the polydata itself is not used, it also changes when a point or cell data array
+    is modified (e.g. the ROI array shared by a hardened copy and its model).
+    """
+    points = polyData.GetPoints()
+    return points, (points.GetMTime() if points is not None else 0)
+
+
+class LocatorCache(object):
+    """Keep one vtkPointLocator per hardened model so that projections only query it.
+
+    Entries are keyed by the ID of the hardened model node. A locator is rebuilt when the
+    polydata object it was built on or its vtkPoints object is replaced, or when its points are
+    modified (MTime of the vtkPoints). Their estimated size is recorded in the memory budget, which
+    releases the least recently used ones.
+    """
+    # rough size of a vtkPointLocator with AutomaticOn (ids + buckets), in bytes per point
+    bytesPerPoint = 32
+
+    def __init__(self, memoryBudget=None):
+        self.memoryBudget = memoryBudget
+        self.entries = dict()
+        self.snapshots = dict()
+
+    def getLocator(self, key, polyData):
+        entry = self.entries.get(key)
+        points, mtime = pointsMTime(polyData)
+        if entry is not None and entry["polyData"] is polyData and entry["points"] is points \
+                and entry["mtime"] == mtime:
+            if self.memoryBudget:
+                self.memoryBudget.touch("locator", key)
+            return entry["locator"]
+        locator = vtk.vtkPointLocator()
+        locator.SetDataSet(polyData)
+        locator.AutomaticOn()
+        locator.BuildLocator()
+        size = polyData.GetNumberOfPoints() * self.bytesPerPoint
+        self.entries[key] = {"polyData": polyData,
+                             "points": points,
+                             "mtime": mtime,
+                             "locator": locator,
+                             "size": size}
+        if self.memoryBudget:
+            self.memoryBudget.record("locator", key, size, self.remove)
+        return locator
+
+    def getSnapshot(self, key, polyData):
+        """Immutable copy of the points of polyData and of their locator, for the projection threads"""
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None and snapshot.isCurrent(polyData):
+            if self.memoryBudget:
+                self.memoryBudget.touch("snapshot", key)
+            return snapshot
+        snapshot = MeshSnapshot(polyData)
+        self.snapshots[key] = snapshot
+        if self.memoryBudget:
+            self.memoryBudget.record("snapshot", key, snapshot.size, self.removeSnapshot)
+        return snapshot
+
+    def memorySize(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        if self.memoryBudget:
+            self.memoryBudget.discard("locator", key)
+        self.removeSnapshot(key)
+
+    def removeSnapshot(self, key):
+        self.snapshots.pop(key, None)
+        if self.memoryBudget:
+            self.memoryBudget.discard("snapshot", key)
+
+    def clear(self):
+        self.entries.clear()
+        self.snapshots.clear()
+
+
+class MeshSnapshot(object):
+    """Copy of the points of a mesh with a vtkStaticPointLocator, whose queries are thread safe.
+
+    Nothing modifies a snapshot once built: the cache replaces it when the points of the mesh change.
+    """
+    # vtkStaticPointLocator stores (point id, bucket id) pairs and the offsets of the buckets
+    bytesPerPoint = 16
+
+    def __init__(self, polyData):
+        self.source = polyData
+        self.sourcePoints, self.mtime = pointsMTime(polyData)
+        points = vtk.vtkPoints()
+        points.DeepCopy(polyData.GetPoints())
+        self.polyData = vtk.vtkPolyData()
+        self.polyData.SetPoints(points)
+        self.points = vtk_to_numpy(points.GetData())
+        self.locator = vtk.vtkStaticPointLocator()
+        self.locator.SetDataSet(self.polyData)
+        self.locator.BuildLocator()
+        self.size = self.points.nbytes + len(self.points) * self.bytesPerPoint
+
+    def isCurrent(self, polyData):
+        # True if the snapshot was taken from the current points of polyData
+        points, mtime = pointsMTime(polyData)
+        return polyData is self.source and points is self.sourcePoints and mtime == self.mtime
+
+    def findClosestPoint(self, position):
+        return self.locator.FindClosestPoint(position)
+
+
+class AdjacencyCache(object):
+    """Vertex adjacency of the meshes, in CSR form (indptr, indices).
+
+    The neighbors of the vertex i are indices[indptr[i]:indptr[i + 1]]: all the other points of the
+    cells (verts, lines, polys and strips) that contain it, as vtkPolyData.GetPointCells and
+    GetCellPoints give them. The graph only depends on the cells, which the hardened copies share
+    with their model, so it is kept until the cell arrays of the polydata are replaced or modified.
+    """
+    def __init__(self, memoryBudget=None):
+        self.memoryBudget = memoryBudget
+        self.entries = dict()
+
+    @staticmethod
+    def getCellArrays(polyData):
+        return [polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()]
+
+    def getAdjacency(self, key, polyData):
+        cellArrays = self.getCellArrays(polyData)
+        mtimes = [cellArray.GetMTime() for cellArray in cellArrays]
+        entry = self.entries.get(key)
+        if entry is not None and all(a is b for a, b in zip(entry["cellArrays"], cellArrays)) \
+                and entry["mtimes"] == mtimes and len(entry["indptr"]) == polyData.GetNumberOfPoints() + 1:
+            if self.memoryBudget:
+                self.memoryBudget.touch("adjacency", key)
+            return entry["indptr"], entry["indices"]
+        indptr, indices = self.computeAdjacency(polyData)
+        self.entries[key] = {"cellArrays": cellArrays, "mtimes": mtimes, "indptr": indptr, "indices": indices}
+        if self.memoryBudget:
+            self.memoryBudget.record("adjacency", key, indptr.nbytes + indices.nbytes, self.remove)
+        return indptr, indices
+
+    @classmethod
+    def computeAdjacency(cls, polyData):
+        numberOfPoints = polyData.GetNumberOfPoints()
+        sources = [numpy.zeros(0, dtype=numpy.int64)]
+        targets = [numpy.zeros(0, dtype=numpy.int64)]
+        for cellArray in cls.getCellArrays(polyData):
+            if cellArray.GetNumberOfCells() == 0:
+                continue
+            offsets = vtk_to_numpy(cellArray.GetOffsetsArray()).astype(numpy.int64)
+            connectivity = vtk_to_numpy(cellArray.GetConnectivityArray()).astype(numpy.int64)
+            sizes = numpy.diff(offsets)
+            # every point of a cell is linked to all the others, the cells of same size at once
+            for size in numpy.unique(sizes[sizes > 1]):
+                starts = offsets[:-1][sizes == size]
+                cells = connectivity[starts[:, numpy.newaxis] + numpy.arange(size)]
+                first, second = numpy.nonzero(~numpy.eye(size, dtype=bool))
+                sources.append(cells[:, first].ravel())
+                targets.append(cells[:, second].ravel())
+        source = numpy.concatenate(sources)
+        target = numpy.concatenate(targets)
+        if len(source) == 0:
+            return numpy.zeros(numberOfPoints + 1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        # sort based unique, much faster than numpy.unique on millions of edges
+        edges = source * numberOfPoints + target
+        edges.sort()
+        edges = edges[numpy.concatenate(([True], edges[1:] != edges[:-1]))]
+        # a point repeated in a cell is not its own neighbor
+        edges = edges[edges // numberOfPoints != edges % numberOfPoints]
+        source = edges // numberOfPoints
+        indices = edges % numberOfPoints
+        indptr = numpy.zeros(numberOfPoints + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(source, minlength=numberOfPoints), out=indptr[1:])
+        return indptr, indices
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+        if self.memoryBudget:
+            self.memoryBudget.discard("adjacency", key)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def growROI(indptr, indices, pointID, numberOfRings):
+    """Vertices at most numberOfRings edges away from pointID, grown one ring at a time"""
+    visited = numpy.zeros(len(indptr) - 1, dtype=bool)
+    visited[pointID] = True
+    frontier = numpy.array([pointID], dtype=numpy.int64)
+    for ring in range(0, int(numberOfRings)):
+        starts = indptr[frontier]
+        lengths = indptr[frontier + 1] - starts
+        if lengths.sum() == 0:
+            break
+        # positions in indices of the neighbors of every vertex of the frontier
+        positions = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths) \
+                    + numpy.arange(lengths.sum())
+        neighbors = indices[positions]
+        neighbors = neighbors[~visited[neighbors]]
+        if len(neighbors) == 0:
+            break
+        visited[neighbors] = True
+        frontier = numpy.sort(neighbors)
+        frontier = frontier[numpy.concatenate(([True], frontier[1:] != frontier[:-1]))]
+    return numpy.flatnonzero(visited)
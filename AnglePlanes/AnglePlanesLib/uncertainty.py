@@ -0,0 +1,98 @@
+"""Monte Carlo uncertainty of the angles between landmark planes.
+
+The landmarks are jittered according to their covariance, optionally projected again on the
+surface, the planes are fitted to every sample and the angles are computed for every sample. The
+normals of the samples are computed as the ones of the measured angles (geometry.measuredPlanes),
+so that without jitter every sample gives exactly the measured angle. All
+the samples are processed at once as stacked arrays: (samples, landmarks, 3) positions,
+(samples, planes, 3) normals and (samples,) angles.
+"""
+from collections import OrderedDict
+
+import numpy
+
+from AnglePlanesLib import geometry
+
+# angles of which the distributions are summarized, the complements are 180 minus these
+uncertaintyAngles = ["3D", "RL", "SI", "AP"]
+defaultPercentiles = (2.5, 50, 97.5)
+
+
+def landmarkCovariances(count, sd=0.0, landmarkSD=None, covariances=None):
+    """(count, 3, 3) covariances: isotropic sd (mm) for all the landmarks, overridden per landmark
+    by landmarkSD ({index: sd}) or by full 3 x 3 covariances ({index: covariance})"""
+    result = numpy.tile(numpy.eye(3) * float(sd) ** 2, (count, 1, 1))
+    for index, value in (landmarkSD or dict()).items():
+        result[index] = numpy.eye(3) * float(value) ** 2
+    for index, value in (covariances or dict()).items():
+        result[index] = numpy.asarray(value, dtype=numpy.float64).reshape(3, 3)
+    return result
+
+
+def sampleLandmarks(landmarks, covariances, samples, random=None):
+    """(samples, L, 3) positions drawn around the (L, 3) landmarks with their (L, 3, 3) covariances"""
+    if random is None:
+        random = numpy.random.default_rng()
+    landmarks = numpy.asarray(landmarks, dtype=numpy.float64)
+    # the covariances may be singular (e.g. a landmark that is not jittered)
+    eigenvalues, eigenvectors = numpy.linalg.eigh(covariances)
+    factors = eigenvectors * numpy.sqrt(numpy.clip(eigenvalues, 0, None))[..., numpy.newaxis, :]
+    noise = random.standard_normal((samples,) + landmarks.shape)
+    return landmarks + numpy.einsum("lij,slj->sli", factors, noise)
+
+
+def samplePlaneNormals(positions, planes):
+    """(samples, P, 3) normals of the planes fitted to each sample (see geometry.measuredPlanes).
+
+    planes is a list of P lists of landmark indices (at least 3) in the (samples, L, 3) positions.
+    """
+    counts = numpy.array([len(plane) for plane in planes])
+    indices = numpy.zeros((len(planes), counts.max()), dtype=numpy.int64)
+    mask = numpy.arange(counts.max()) < counts[:, numpy.newaxis]
+    indices[mask] = [index for plane in planes for index in plane]
+    normals, centroids, rms = geometry.measuredPlanes(positions[:, indices],
+                                                      numpy.broadcast_to(mask, (len(positions),) + mask.shape))
+    return normals
+
+
+def summarize(values, percentiles=defaultPercentiles):
+    """Mean, standard deviation and percentiles of the defined (not NaN) values"""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    values = values[~numpy.isnan(values)]
+    summary = OrderedDict([("mean", numpy.nan), ("sd", numpy.nan)])
+    summary.update(("p%g" % percentile, numpy.nan) for percentile in percentiles)
+    if len(values):
+        # computed on the values shifted by the first one: identical values give it back exactly
+        shifted = values - values[0]
+        summary["mean"] = float(values[0] + shifted.mean())
+        summary["sd"] = float(shifted.std(ddof=1)) if len(values) > 1 else 0.0
+        for percentile, value in zip(percentiles, numpy.percentile(values, percentiles)):
+            summary["p%g" % percentile] = float(value)
+    return summary
+
+
+def angleDistributions(normals1, normals2, percentiles=defaultPercentiles):
+    """Summary of the distribution of each angle between two (samples, 3) arrays of normals"""
+    angles = geometry.pairAngles(normals1, normals2)
+    return OrderedDict((view, summarize(angles[view], percentiles)) for view in uncertaintyAngles)
+
+
+def angleUncertainty(landmarks, planes, pairs, covariances, samples=1000, project=None, seed=None,
+                     percentiles=defaultPercentiles):
+    """Distributions of the angles between pairs of planes defined by landmarks.
+
+    landmarks is an (L, 3) array, planes a list of lists of landmark indices, pairs a list of
+    (plane index, plane index) and covariances the (L, 3, 3) covariances of the landmarks.
+    project, if given, maps a (samples, L, 3) array of positions to their projections on the surface.
+    Returns one angleDistributions dictionary per pair.
+    """
+    positions = sampleLandmarks(landmarks, covariances, samples, numpy.random.default_rng(seed))
+    if project is not None:
+        positions = project(positions)
+    normals = samplePlaneNormals(positions, planes)
+    return [angleDistributions(normals[:, i], normals[:, j], percentiles) for i, j in pairs]
+
+
+def summaryColumns(percentiles=defaultPercentiles):
+    names = ["mean", "sd"] + ["p%g" % percentile for percentile in percentiles]
+    return ["%s_%s" % (view, name) for view in uncertaintyAngles for name in names]
@@ -0,0 +1,315 @@
+"""Benchmarks of the hot paths of AnglePlanes on synthetic meshes, without any download.
+
+With the Python of Slicer, all the benchmarks run:
+
+    Slicer --no-main-window --python-script AnglePlanesBenchmark.py --sizes 10k,100k,1M -o results.json
+
+With Python, NumPy and VTK only, the benchmarks that need the AnglePlanes module are skipped.
+The results of a previous run can be used as a baseline:
+
+    ... --baseline baseline.json --tolerance 0.25
+
+the exit code is then 1 if a benchmark is slower than its baseline by more than the tolerance.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from AnglePlanesLib import geometry, meshes, uncertainty
+from AnglePlanesLib.landmarks import Landmark, LandmarkRegistry
+
+try:
+    import slicer
+    import AnglePlanes
+except ImportError:
+    slicer = None
+    AnglePlanes = None
+
+numberOfLandmarks = 16
+
+
+def parseSize(size):
+    multipliers = {"k": 1000, "M": 1000 * 1000}
+    if size[-1] in multipliers:
+        return int(float(size[:-1]) * multipliers[size[-1]])
+    return int(size)
+
+
+def icosphere(numberOfPoints):
+    # an icosahedron subdivided k times has 10 * 4^k + 2 vertices
+    level = max(int(round(math.log(max(numberOfPoints - 2, 10) / 10.0, 4))), 0)
+    source = vtk.vtkPlatonicSolidSource()
+    source.SetSolidTypeToIcosahedron()
+    subdivision = vtk.vtkLinearSubdivisionFilter()
+    subdivision.SetInputConnection(source.GetOutputPort())
+    subdivision.SetNumberOfSubdivisions(level)
+    subdivision.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.ShallowCopy(subdivision.GetOutput())
+    polyData.GetCellData().Initialize()
+    points = vtk_to_numpy(polyData.GetPoints().GetData())
+    points *= 80.0 / numpy.linalg.norm(points, axis=1)[:, numpy.newaxis]
+    polyData.GetPoints().Modified()
+    return polyData
+
+
+def skullLikeEllipsoid(numberOfPoints):
+    # a sphere source has thetaResolution * (phiResolution - 2) + 2 vertices
+    thetaResolution = max(int(round(math.sqrt(numberOfPoints))), 8)
+    phiResolution = max(int(round(float(numberOfPoints - 2) / thetaResolution)), 6) + 2
+    source = vtk.vtkSphereSource()
+    source.SetThetaResolution(thetaResolution)
+    source.SetPhiResolution(phiResolution)
+    source.Update()
+    polyData = vtk.vtkPolyData()
+    polyData.ShallowCopy(source.GetOutput())
+    polyData.GetPointData().SetNormals(None)
+    points = vtk_to_numpy(polyData.GetPoints().GetData())
+    bumps = 1.0 + 0.06 * numpy.sin(5 * points[:, 0]) * numpy.sin(4 * points[:, 1]) * numpy.cos(3 * points[:, 2])
+    points *= bumps[:, numpy.newaxis] * numpy.array([75.0, 95.0, 70.0]) * 2
+    polyData.GetPoints().Modified()
+    return polyData
+
+
+meshGenerators = [("icosphere", icosphere), ("ellipsoid", skullLikeEllipsoid)]
+
+
+def syntheticLandmarks(polyData, count, seed=0):
+    """Vertex indices and positions of landmarks placed slightly outside of the surface"""
+    random = numpy.random.RandomState(seed)
+    indices = random.randint(0, polyData.GetNumberOfPoints(), count)
+    points = vtk_to_numpy(polyData.GetPoints().GetData())
+    return indices, points[indices] * 1.03
+
+
+def timeFunction(function, repeats, warmup=1):
+    for i in range(warmup):
+        function()
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def makeResult(case, mesh, vertices, parameters, times):
+    return {"case": case, "mesh": mesh, "vertices": vertices, "parameters": parameters,
+            "min": min(times), "median": float(numpy.median(times)), "mean": float(numpy.mean(times)),
+            "repeats": len(times)}
+
+
+def benchmarkMesh(logic, meshName, polyData, repeats):
+    results = []
+    vertices = polyData.GetNumberOfPoints()
+    landmarkIndices, landmarkCoords = syntheticLandmarks(polyData, numberOfLandmarks)
+
+    def buildLocator():
+        logic.locatorCache.remove("benchmark")
+        logic.locatorCache.getLocator("benchmark", polyData)
+    results.append(makeResult("locatorBuild", meshName, vertices, {}, timeFunction(buildLocator, repeats)))
+
+    def projection():
+        logic.getClosestPointIndices(polyData, landmarkCoords, "benchmark")
+    results.append(makeResult("projection", meshName, vertices, {"landmarks": numberOfLandmarks},
+                              timeFunction(projection, repeats)))
+
+    model = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    try:
+        model.SetAndObservePolyData(polyData)
+        model.SetAndObserveTransformNodeID(transformNode.GetID())
+        transform = vtk.vtkTransform()
+
+        def hardening():
+            # a moved transform, the copy of the model is updated in place
+            transform.RotateZ(1.0)
+            transformNode.SetMatrixTransformToParent(transform.GetMatrix())
+            logic.hardenedGeometry.update(model)
+        results.append(makeResult("hardening", meshName, vertices, {"transform": "linear"},
+                                  timeFunction(hardening, repeats)))
+    finally:
+        logic.hardenedGeometry.remove(model.GetID())
+        slicer.mrmlScene.RemoveNode(model)
+        slicer.mrmlScene.RemoveNode(transformNode)
+
+    adjacency = []
+
+    def computeAdjacency():
+        adjacency[:] = meshes.AdjacencyCache.computeAdjacency(polyData)
+    results.append(makeResult("adjacency", meshName, vertices, {}, timeFunction(computeAdjacency, repeats)))
+    indptr, indices = adjacency
+    for numberOfRings in [3, 10, 30]:
+        def growROIs():
+            for pointID in landmarkIndices:
+                meshes.growROI(indptr, indices, pointID, numberOfRings)
+        results.append(makeResult("ROIGrowth", meshName, vertices,
+                                  {"landmarks": numberOfLandmarks, "rings": numberOfRings},
+                                  timeFunction(growROIs, repeats)))
+    logic.locatorCache.remove("benchmark")
+    return results
+
+
+def benchmarkPlaneUpdate(logic, repeats):
+    fidList = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+    try:
+        registry = LandmarkRegistry(fidList)
+        for n, (label, coord) in enumerate([("A", [40, 0, 0]), ("B", [0, 50, 10]), ("C", [-30, -20, 5])]):
+            fidList.AddFiducial(*coord)
+            registry.add(Landmark(fidList.GetNthMarkupID(n), label), n)
+        logic.landmarkRegistries[fidList.GetID()] = registry
+        planeSource = vtk.vtkPlaneSource()
+        bounds = [-100, 100, -120, 120, -90, 90]
+
+        def planeUpdate():
+            normal = logic.planeLandmarks(fidList, "A", "B", "C", planeSource, True)
+            geometry.clipPlanesWithBox([planeSource.GetCenter()], [numpy.asarray(normal).ravel()], bounds)
+        return [makeResult("planeUpdate", "", 0, {"adaptToBoundingBox": True}, timeFunction(planeUpdate, repeats))]
+    finally:
+        logic.landmarkRegistries.pop(fidList.GetID(), None)
+        slicer.mrmlScene.RemoveNode(fidList)
+
+
+def benchmarkLandmarkDescription(logic, repeats):
+    results = []
+    for count in [100, 1000]:
+        registry = LandmarkRegistry(None)
+        for n in range(count):
+            landmark = Landmark("vtkMRMLMarkupsFiducialNode%d" % n, "L%d" % n, True)
+            landmark.ROIradius = n % 5
+            landmark.closestPointIndex = n * 7
+            registry.add(landmark)
+        text = logic.encodeJSON(registry.toDescription())
+
+        def serialization():
+            logic.encodeJSON(registry.toDescription())
+
+        def deserialization():
+            LandmarkRegistry(None, logic.decodeJSON(text))
+        results.append(makeResult("descriptionSerialization", "", 0, {"landmarks": count},
+                                  timeFunction(serialization, repeats)))
+        results.append(makeResult("descriptionDeserialization", "", 0, {"landmarks": count},
+                                  timeFunction(deserialization, repeats)))
+    return results
+
+
+def benchmarkGeometry(repeats):
+    results = []
+    random = numpy.random.RandomState(0)
+    for count in [4, 16, 64, 256]:
+        normals = random.normal(size=(count, 3))
+        results.append(makeResult("batchAngles", "", 0, {"planes": count},
+                                  timeFunction(lambda: geometry.angleMatrices(normals), repeats)))
+    landmarks = random.normal(size=(1000, 3, 3)) * 50
+    results.append(makeResult("planeNormals", "", 0, {"planes": 1000},
+                              timeFunction(lambda: geometry.planeNormals(landmarks), repeats)))
+    for count in [3, 8, 32]:
+        landmarks = random.normal(size=(30, count, 3)) * 50
+        results.append(makeResult("fitPlanes", "", 0, {"planes": 30, "landmarks": count},
+                                  timeFunction(lambda: geometry.fitPlanes(landmarks), repeats)))
+    landmarks = random.normal(size=(6, 3)) * 50
+    covariances = uncertainty.landmarkCovariances(6, 1.0)
+    for samples in [1000, 10000]:
+        results.append(makeResult("angleUncertainty", "", 0, {"planes": 2, "samples": samples},
+                                  timeFunction(lambda: uncertainty.angleUncertainty(
+                                      landmarks, [[0, 1, 2], [3, 4, 5]], [(0, 1)], covariances, samples, seed=0),
+                                      repeats)))
+    return results
+
+
+def runBenchmarks(sizes, repeats):
+    results = benchmarkGeometry(repeats)
+    if AnglePlanes is None:
+        print("The AnglePlanes module cannot be imported without Slicer, only the geometry benchmarks are run")
+        return results
+    logic = AnglePlanes.AnglePlanesLogic()
+    results += benchmarkPlaneUpdate(logic, repeats)
+    results += benchmarkLandmarkDescription(logic, repeats)
+    for size in sizes:
+        for meshName, generator in meshGenerators:
+            polyData = generator(size)
+            results += benchmarkMesh(logic, meshName, polyData, repeats)
+    return results
+
+
+def resultKey(result):
+    return result["case"], result["mesh"], result["vertices"], json.dumps(result["parameters"], sort_keys=True)
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    """Add the baseline median and the ratio to the results, returns the results slower than the tolerance"""
+    baselineResults = dict((resultKey(result), result) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        baselineResult = baselineResults.get(resultKey(result))
+        if baselineResult is None or baselineResult["median"] <= 0:
+            continue
+        result["baselineMedian"] = baselineResult["median"]
+        result["ratio"] = result["median"] / baselineResult["median"]
+        if result["ratio"] > 1.0 + tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def machineDescription():
+    description = {"platform": platform.platform(),
+                   "processor": platform.processor(),
+                   "python": platform.python_version(),
+                   "numpy": numpy.__version__,
+                   "vtk": vtk.vtkVersion.GetVTKVersion()}
+    if slicer is not None:
+        description["slicer"] = slicer.app.applicationVersion
+    return description
+
+
+def printResults(results):
+    for result in results:
+        line = "%-28s %-10s %9s %-40s %10.3f ms" % (result["case"], result["mesh"], result["vertices"] or "",
+                                                   json.dumps(result["parameters"], sort_keys=True),
+                                                   result["median"] * 1000)
+        if "ratio" in result:
+            line += "  x%.2f" % result["ratio"]
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark AnglePlanes on synthetic meshes.")
+    parser.add_argument("--sizes", default="10k,100k,1M",
+                        help="approximate numbers of vertices of the meshes (up to 5M)")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("-o", "--output", help="JSON file where the results are written")
+    parser.add_argument("--baseline", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown relative to the baseline reported as a regression")
+    args = parser.parse_args(argv)
+    sizes = [parseSize(size) for size in args.sizes.split(",")]
+    report = {"machine": machineDescription(), "results": runBenchmarks(sizes, args.repeats)}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compareWithBaseline(report["results"], json.load(baselineFile), args.tolerance)
+    printResults(report["results"])
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    for result in regressions:
+        print("Regression: %s %s %s is %.2f times slower than the baseline"
+              % (result["case"], result["mesh"], json.dumps(result["parameters"], sort_keys=True), result["ratio"]))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    if slicer is not None:
+        slicer.util.exit(status)
+    else:
+        sys.exit(status)
@@ -0,0 +1,316 @@
+"""Tests of AnglePlanesLib.geometry, with Python, NumPy and VTK only."""
+import math
+import os
+import sys
+import unittest
+
+import numpy
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from AnglePlanesLib import geometry
+
+
+# reference implementations, ported from the first version of AnglePlanesLogic
+
+def originalNormalLandmarks(GA, GB):
+    # the cross product was stored in an integer matrix
+    Vn = numpy.zeros(3, dtype=int)
+    Vn[0] = GA[1] * GB[2] - GA[2] * GB[1]
+    Vn[1] = GA[2] * GB[0] - GA[0] * GB[2]
+    Vn[2] = GA[0] * GB[1] - GA[1] * GB[0]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return Vn / math.sqrt(Vn[0] * Vn[0] + Vn[1] * Vn[1] + Vn[2] * Vn[2])
+
+
+def originalMidPoint(coord1, coord2):
+    return [int((coord1[i] + coord2[i]) / 2) for i in range(3)]
+
+
+def originalDefineNormal(matrix):
+    # image of the normal (0, 0, 1) of the slice minus image of its origin
+    normalVector = numpy.dot(matrix, [0, 0, 1, 1])
+    A = numpy.dot(matrix, [0, 0, 0, 1])
+    return normalVector[:3] - A[:3]
+
+
+def originalViewAngles(normalVect1, normalVect2):
+    """RL, SI and AP angles of the original getAngle, 0 when a normal is orthogonal to the view"""
+    angles = dict()
+    for view, (i, j) in [("RL", (1, 2)), ("SI", (0, 1)), ("AP", (0, 2))]:
+        norm1 = math.sqrt(normalVect1[i] * normalVect1[i] + normalVect1[j] * normalVect1[j])
+        norm2 = math.sqrt(normalVect2[i] * normalVect2[i] + normalVect2[j] * normalVect2[j])
+        if norm1 == 0 or norm2 == 0:
+            angles[view] = 0
+            continue
+        inter = (normalVect1[i] * normalVect2[i] + normalVect1[j] * normalVect2[j]) / (norm1 * norm2)
+        angle = 0 if inter >= 0.99999 else math.acos(inter)
+        angles[view] = round(angle * 180 / math.pi, 2)
+    return angles
+
+
+def getAngleValues(angles):
+    """Values shown by AnglePlanesLogic.getAngle for the angles of a pair: rounded, NaN shown as 0"""
+    return dict((view, 0 if numpy.isnan(angles[view]) else round(float(angles[view]), 2))
+                for view in ["RL", "SI", "AP"])
+
+
+def polygonArea(polygon):
+    center = polygon.mean(axis=0)
+    return 0.5 * numpy.linalg.norm(numpy.cross(polygon - center, numpy.roll(polygon, -1, axis=0) - center).sum(axis=0))
+
+
+def clipClosedSurfaceCap(origin, normal, bounds):
+    """Area and vertices of the face created by vtkClipClosedSurface when it clips the box with a plane"""
+    cube = vtk.vtkCubeSource()
+    cube.SetBounds(bounds)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(cube.GetOutputPort())
+    clean = vtk.vtkCleanPolyData()
+    clean.SetInputConnection(triangles.GetOutputPort())
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(origin)
+    plane.SetNormal(normal)
+    planes = vtk.vtkPlaneCollection()
+    planes.AddItem(plane)
+    clip = vtk.vtkClipClosedSurface()
+    clip.SetInputConnection(clean.GetOutputPort())
+    clip.SetClippingPlanes(planes)
+    clip.SetScalarModeToLabels()
+    clip.Update()
+    output = clip.GetOutput()
+    if not output.GetNumberOfCells():
+        return 0.0, numpy.zeros((0, 3))
+    points = vtk_to_numpy(output.GetPoints().GetData())
+    labels = vtk_to_numpy(output.GetCellData().GetScalars())
+    area = 0.0
+    vertices = set()
+    for cellID in numpy.flatnonzero(labels == 1):
+        cell = output.GetCell(int(cellID))
+        ids = [cell.GetPointId(i) for i in range(cell.GetNumberOfPoints())]
+        area += polygonArea(points[ids])
+        vertices.update(ids)
+    return area, points[sorted(vertices)].astype(float)
+
+
+def distances(points1, points2):
+    """Distance of every point of points1 to its closest point in points2"""
+    return numpy.linalg.norm(points1[:, numpy.newaxis] - points2[numpy.newaxis], axis=2).min(axis=1)
+
+
+class GeometryTest(unittest.TestCase):
+
+    def test_landmark_normals_truncated(self):
+        random = numpy.random.RandomState(1)
+        GA = random.uniform(-5.0, 5.0, (50, 3))
+        GB = random.uniform(-5.0, 5.0, (50, 3))
+        normals = geometry.landmarkNormals(GA, GB)
+        for i in range(50):
+            numpy.testing.assert_allclose(normals[i], originalNormalLandmarks(GA[i], GB[i]), atol=1e-12)
+        # (0.4, 0, 0) x (0, 0.9, 0) = (0, 0, 0.36), truncated to 0
+        normal = geometry.landmarkNormals([0.4, 0.0, 0.0], [0.0, 0.9, 0.0])
+        self.assertTrue(numpy.isnan(normal).all())
+        self.assertTrue(numpy.isnan(originalNormalLandmarks([0.4, 0.0, 0.0], [0.0, 0.9, 0.0])).all())
+        numpy.testing.assert_allclose(geometry.landmarkNormals([0.0, 2.5, 0.0], [0.0, 0.0, 1.5]), [1.0, 0.0, 0.0])
+
+    def test_plane_normals(self):
+        landmarks = numpy.array([[10.2, -3.1, 4.0], [-7.5, 8.8, 1.2], [2.0, 0.5, -9.7]])
+        G = landmarks.mean(axis=0)
+        numpy.testing.assert_allclose(geometry.planeNormals(landmarks),
+                                      originalNormalLandmarks(landmarks[0] - G, landmarks[1] - G), atol=1e-12)
+        numpy.testing.assert_allclose(geometry.planeNormals(landmarks[numpy.newaxis])[0],
+                                      geometry.planeNormals(landmarks))
+
+    def test_mid_points_truncated(self):
+        coords1 = numpy.array([[1.0, 2.0, 3.0], [-1.0, -2.0, 4.6], [0.3, -0.3, 7.0]])
+        coords2 = numpy.array([[2.0, 3.0, 4.0], [-2.0, 1.0, -9.9], [0.4, -0.4, -7.0]])
+        midPoints = geometry.midPoints(coords1, coords2)
+        for i in range(3):
+            self.assertEqual(midPoints[i].tolist(), originalMidPoint(coords1[i], coords2[i]))
+        # towards zero, not down
+        self.assertEqual(midPoints[1].tolist(), [-1.0, 0.0, -2.0])
+
+    def test_slice_normals(self):
+        random = numpy.random.RandomState(2)
+        matrices = random.normal(size=(5, 4, 4))
+        matrices[:, 3] = [0.0, 0.0, 0.0, 1.0]
+        normals = geometry.sliceNormals(matrices)
+        for matrix, normal in zip(matrices, normals):
+            numpy.testing.assert_allclose(normal, originalDefineNormal(matrix), atol=1e-12)
+
+    def test_angle_matrices_match_get_angle(self):
+        random = numpy.random.RandomState(3)
+        normals = random.normal(size=(12, 3))
+        # normals orthogonal to a view, and a zero normal
+        normals[0] = [1.0, 0.0, 0.0]
+        normals[1] = [0.0, 0.0, 2.0]
+        normals[2] = [0.0, 0.0, 0.0]
+        angles = geometry.angleMatrices(normals)
+        for i in range(len(normals)):
+            for j in range(len(normals)):
+                pair = dict((view, angles[view][i, j]) for view in ["RL", "SI", "AP"])
+                self.assertEqual(getAngleValues(pair), originalViewAngles(normals[i], normals[j]))
+        self.assertTrue(numpy.isnan(angles["RL"][0, 3]))
+        self.assertTrue(numpy.isnan(angles["SI"][1, 3]))
+        for view in geometry.projectionAxes:
+            self.assertTrue(numpy.isnan(angles[view][2]).all())
+            numpy.testing.assert_allclose(angles[view + "_comp"], 180 - angles[view])
+
+    def test_clamp(self):
+        # cosines from 0.99999 are shown as 0, just below they give the arc cosine
+        for cosine, expected in [(0.999995, 0.0), (0.99999, 0.0), (0.9999, math.degrees(math.acos(0.9999)))]:
+            normals = [[1.0, 0.0, 0.0], [cosine, math.sqrt(1 - cosine ** 2), 0.0]]
+            angles = geometry.angleMatrices(normals)
+            self.assertAlmostEqual(angles["SI"][0, 1], expected, places=5)
+            self.assertAlmostEqual(angles["3D"][0, 1], expected, places=5)
+            self.assertEqual(getAngleValues(geometry.pairAngles(*normals))["SI"],
+                             originalViewAngles(*normals)["SI"])
+
+    def test_pair_angles_match_matrices(self):
+        random = numpy.random.RandomState(4)
+        normals = random.normal(size=(8, 3))
+        normals[5] = [0.0, 1.0, 0.0]
+        normals[6] = [0.0, 0.0, 0.0]
+        matrices = geometry.angleMatrices(normals)
+        first, second = numpy.triu_indices(len(normals), 1)
+        angles = geometry.pairAngles(normals[first], normals[second])
+        for name, matrix in matrices.items():
+            numpy.testing.assert_array_equal(angles[name], matrix[first, second])
+        # batch dimensions are kept
+        angles = geometry.pairAngles(normals[first].reshape(4, 7, 3), normals[second].reshape(4, 7, 3))
+        self.assertEqual(angles["AP"].shape, (4, 7))
+
+
+def rotation(seed):
+    q, r = numpy.linalg.qr(numpy.random.RandomState(seed).normal(size=(3, 3)))
+    return q * numpy.sign(numpy.linalg.det(q))
+
+
+class FitPlanesTest(unittest.TestCase):
+
+    def test_three_coplanar_points(self):
+        random = numpy.random.RandomState(5)
+        landmarks = random.uniform(-50.0, 50.0, (20, 3, 3))
+        normals, centroids, rms = geometry.fitPlanes(landmarks)
+        G = landmarks.mean(axis=1)
+        cross = numpy.cross(landmarks[:, 0] - G, landmarks[:, 1] - G)
+        numpy.testing.assert_allclose(normals, cross / numpy.linalg.norm(cross, axis=1)[:, numpy.newaxis],
+                                      atol=1e-12)
+        numpy.testing.assert_allclose(centroids, G)
+        numpy.testing.assert_allclose(rms, 0.0, atol=1e-12)
+        # the landmarks are on their plane
+        distances = numpy.einsum('ijk,ik->ij', landmarks - G[:, numpy.newaxis], normals)
+        numpy.testing.assert_allclose(distances, 0.0, atol=1e-10)
+
+    def test_noisy_points(self):
+        # square of side 10 whose corners are at +/- d from z = 0, rotated and moved
+        d = 0.25
+        square = numpy.array([[5.0, 5.0, d], [-5.0, 5.0, -d], [-5.0, -5.0, d], [5.0, -5.0, -d],
+                              [0.0, 5.0, 0.0], [0.0, -5.0, 0.0]])
+        R = rotation(6)
+        landmarks = square.dot(R.T) + [10.0, -20.0, 30.0]
+        normal, centroid, rms = geometry.fitPlanes(landmarks)
+        self.assertAlmostEqual(float(rms), d * numpy.sqrt(4.0 / 6.0), places=12)
+        self.assertAlmostEqual(abs(normal.dot(R[:, 2])), 1.0, places=12)
+        numpy.testing.assert_allclose(centroid, [10.0, -20.0, 30.0], atol=1e-12)
+        # orientation of planeNormals: towards the cross product of the first two centered landmarks
+        self.assertGreater(normal.dot(numpy.cross(landmarks[0] - centroid, landmarks[1] - centroid)), 0)
+
+    def test_least_squares(self):
+        random = numpy.random.RandomState(7)
+        landmarks = random.normal(size=(10, 8, 3)) * [20.0, 10.0, 0.5]
+        normals, centroids, rms = geometry.fitPlanes(landmarks)
+        for plane, normal, centroid, error in zip(landmarks, normals, centroids, rms):
+            residuals = (plane - centroid).dot(normal)
+            self.assertAlmostEqual(float(error), float(numpy.sqrt((residuals ** 2).mean())), places=12)
+            # no direction fits better than the eigenvector of the smallest eigenvalue of the scatter
+            values, vectors = numpy.linalg.eigh((plane - centroid).T.dot(plane - centroid))
+            self.assertAlmostEqual(abs(normal.dot(vectors[:, 0])), 1.0, places=9)
+            self.assertAlmostEqual(float(error) ** 2, values[0] / len(plane), places=9)
+
+    def test_padding(self):
+        random = numpy.random.RandomState(8)
+        planes = [random.normal(size=(count, 3)) * [10.0, 10.0, 1.0] for count in (3, 5, 7, 4)]
+        padded = numpy.full((4, 7, 3), 1e6)
+        padded[1, 6] = numpy.nan
+        mask = numpy.zeros((4, 7), dtype=bool)
+        for i, plane in enumerate(planes):
+            padded[i, :len(plane)] = plane
+            mask[i, :len(plane)] = True
+        normals, centroids, rms = geometry.fitPlanes(padded, mask)
+        for i, plane in enumerate(planes):
+            normal, centroid, error = geometry.fitPlanes(plane)
+            numpy.testing.assert_allclose(normals[i], normal, atol=1e-12)
+            numpy.testing.assert_allclose(centroids[i], centroid, atol=1e-12)
+            self.assertAlmostEqual(float(rms[i]), float(error), places=12)
+        # fewer than 3 landmarks
+        mask[2, 2:] = False
+        self.assertTrue(numpy.isnan(geometry.fitPlanes(padded, mask)[0][2]).all())
+
+    def test_collinear(self):
+        # no plane is defined: NaN normal, as planeNormals gives
+        line = numpy.array([[0.0, 0.0, 0.0], [1.0, 2.0, 3.0], [2.0, 4.0, 6.0], [-3.0, -6.0, -9.0]])
+        for landmarks in (line[:3], line, numpy.tile([[1.0, 2.0, 3.0]], (4, 1))):
+            normal, centroid, rms = geometry.fitPlanes(landmarks)
+            self.assertTrue(numpy.isnan(normal).all())
+            numpy.testing.assert_allclose(centroid, landmarks.mean(axis=0))
+            self.assertAlmostEqual(float(rms), 0.0, places=12)
+        self.assertTrue(numpy.isnan(geometry.planeNormals(line[:3])).all())
+        normals = geometry.fitPlanes(numpy.stack((line, line + [[0.0, 0.0, 1.0], [0, 0, 0], [0, 0, 0], [0, 0, 0]])))[0]
+        self.assertTrue(numpy.isnan(normals[0]).all())
+        self.assertFalse(numpy.isnan(normals[1]).any())
+
+
+class ClipPlanesWithBoxTest(unittest.TestCase):
+    bounds = [-10.0, 20.0, -5.0, 15.0, 0.0, 30.0]
+
+    def test_random_planes_match_vtk(self):
+        random = numpy.random.RandomState(0)
+        size = numpy.array(self.bounds[1::2]) - numpy.array(self.bounds[0::2])
+        origins = numpy.array(self.bounds[0::2]) + random.uniform(0.1, 0.9, (20, 3)) * size
+        normals = random.normal(size=(20, 3))
+        polygons = geometry.clipPlanesWithBox(origins, normals, self.bounds)
+        self.assertEqual(len(polygons), 20)
+        for origin, normal, polygon in zip(origins, normals, polygons):
+            area, vertices = clipClosedSurfaceCap(origin, normal, self.bounds)
+            self.assertTrue(3 <= len(polygon) <= 6)
+            numpy.testing.assert_allclose(polygonArea(polygon), area, rtol=1e-5)
+            self.assertLess(distances(polygon, vertices).max(), 1e-4)
+            # the vertices are ordered: the polygon is convex and its edges turn the same way
+            edges = numpy.roll(polygon, -1, axis=0) - polygon
+            turns = numpy.cross(edges, numpy.roll(edges, -1, axis=0)).dot(normal)
+            self.assertTrue(numpy.all(turns > 0) or numpy.all(turns < 0))
+
+    def test_plane_outside_box(self):
+        polygons = geometry.clipPlanesWithBox([[0.0, 0.0, 100.0]], [[0.0, 0.0, 1.0]], self.bounds)
+        self.assertEqual(polygons[0].shape, (0, 3))
+        self.assertEqual(clipClosedSurfaceCap([0.0, 0.0, 100.0], [0.0, 0.0, 1.0], self.bounds)[0], 0.0)
+
+    def test_plane_through_corner(self):
+        # the three edges that meet at the corner give a single vertex
+        polygon = geometry.clipPlanesWithBox([[-10.0, -5.0, 0.0]], [[1.0, 1.0, 1.0]], self.bounds)[0]
+        self.assertEqual(polygon.shape, (0, 3))
+        # plane through the three corners next to the first one
+        polygon = geometry.clipPlanesWithBox([[20.0, -5.0, 0.0]], [[2.0, 3.0, 2.0]], self.bounds)[0]
+        self.assertEqual(len(polygon), 3)
+        corners = numpy.array([[20.0, -5.0, 0.0], [-10.0, 15.0, 0.0], [-10.0, -5.0, 30.0]])
+        self.assertLess(distances(polygon, corners).max(), 1e-9)
+        numpy.testing.assert_allclose(polygonArea(polygon), clipClosedSurfaceCap([20.0, -5.0, 0.0], [2.0, 3.0, 2.0],
+                                                                                 self.bounds)[0], rtol=1e-5)
+
+    def test_plane_on_face(self):
+        # the face is kept for both orientations of the normal
+        face = numpy.array([[-10.0, -5.0, 0.0], [20.0, -5.0, 0.0], [20.0, 15.0, 0.0], [-10.0, 15.0, 0.0]])
+        for normal in ([0.0, 0.0, 1.0], [0.0, 0.0, -1.0]):
+            polygon = geometry.clipPlanesWithBox([[0.0, 0.0, 0.0]], [normal], self.bounds)[0]
+            self.assertEqual(len(polygon), 4)
+            self.assertLess(distances(face, polygon).max(), 1e-9)
+            self.assertAlmostEqual(polygonArea(polygon), 600.0)
+        # vtkClipClosedSurface only keeps it when the box is on the positive side of the plane
+        self.assertAlmostEqual(clipClosedSurfaceCap([0.0, 0.0, 0.0], [0.0, 0.0, 1.0], self.bounds)[0], 600.0)
+        self.assertEqual(clipClosedSurfaceCap([0.0, 0.0, 0.0], [0.0, 0.0, -1.0], self.bounds)[0], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests of AnglePlanesLib.landmarks, with Python only."""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from AnglePlanesLib.landmarks import Landmark, LandmarkRegistry
+
+
+class FiducialList(object):
+    """The parts of vtkMRMLMarkupsFiducialNode used by the registry"""
+    def __init__(self, markupIDs):
+        self.markupIDs = list(markupIDs)
+
+    def GetName(self):
+        return "F"
+
+    def GetNumberOfMarkups(self):
+        return len(self.markupIDs)
+
+    def GetNthMarkupID(self, n):
+        return self.markupIDs[n]
+
+
+def makeRegistry(labels):
+    registry = LandmarkRegistry(FiducialList(labels))
+    for n, label in enumerate(labels):
+        registry.add(Landmark(label, label), n)
+    return registry
+
+
+class DependentsInOrderTest(unittest.TestCase):
+
+    def test_chain(self):
+        # midpoint of midpoints
+        registry = makeRegistry(["A", "B", "C", "M1", "M2", "M3"])
+        registry.addMidPoint("M1", "A", "B")
+        registry.addMidPoint("M2", "M1", "C")
+        registry.addMidPoint("M3", "M2", "A")
+        self.assertEqual(registry.dependentsInOrder("A"), ["M1", "M2", "M3"])
+        self.assertEqual(registry.dependentsInOrder("C"), ["M2", "M3"])
+        self.assertEqual(registry.dependentsInOrder("M3"), [])
+        self.assertEqual(registry.ancestors("M3"), {"A", "B", "C", "M1", "M2"})
+
+    def test_diamond(self):
+        # D depends on A through L and through R, it is recomputed once after both
+        registry = makeRegistry(["A", "B", "C", "L", "R", "D"])
+        registry.addMidPoint("L", "A", "B")
+        registry.addMidPoint("R", "A", "C")
+        registry.addMidPoint("D", "L", "R")
+        order = registry.dependentsInOrder("A")
+        self.assertEqual(sorted(order), ["D", "L", "R"])
+        self.assertEqual(order.count("D"), 1)
+        self.assertGreater(order.index("D"), order.index("L"))
+        self.assertGreater(order.index("D"), order.index("R"))
+        self.assertEqual(registry.dependentsInOrder("B"), ["L", "D"])
+
+    def test_cycle_refused(self):
+        registry = makeRegistry(["A", "B", "C", "M", "N"])
+        registry.addMidPoint("M", "A", "B")
+        registry.addMidPoint("N", "M", "C")
+        with self.assertRaises(ValueError):
+            registry.addMidPoint("A", "N", "C")
+        with self.assertRaises(ValueError):
+            registry.addMidPoint("C", "C", "B")
+        self.assertFalse(registry.get("A").isMidPoint)
+        self.assertFalse(registry.get("C").isMidPoint)
+        self.assertEqual(registry.dependentsInOrder("A"), ["M", "N"])
+
+    def test_cycle_in_description(self):
+        # a description written without the check: X and Y define each other
+        description = makeRegistry(["A", "X", "Y"]).toDescription()
+        for markupID, (point1, point2) in [("X", ("Y", "A")), ("Y", ("X", "A"))]:
+            description[markupID]["midPoint"].update(isMidPoint=True, Point1=point1, Point2=point2)
+            description[point1]["midPoint"]["definedByThisMarkup"].append(markupID)
+            description[point2]["midPoint"]["definedByThisMarkup"].append(markupID)
+        registry = LandmarkRegistry(FiducialList(["A", "X", "Y"]), description)
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(registry.dependentsInOrder("A"), [])
+
+    def test_order_updated(self):
+        registry = makeRegistry(["A", "B", "M"])
+        self.assertEqual(registry.dependentsInOrder("A"), [])
+        registry.addMidPoint("M", "A", "B")
+        self.assertEqual(registry.dependentsInOrder("A"), ["M"])
+        registry.remove("M")
+        self.assertEqual(registry.dependentsInOrder("A"), [])
+        self.assertEqual(registry.get("A").definedByThisMarkup, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
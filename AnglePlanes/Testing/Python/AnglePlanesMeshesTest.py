@@ -0,0 +1,141 @@
+"""Tests of AnglePlanesLib.meshes, with Python, NumPy and VTK only."""
+import os
+import sys
+import unittest
+
+import vtk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from AnglePlanesLib import meshes
+
+
+def hardenedSphere():
+    """Sphere and a shallow copy sharing its points and a ROI array, like a model and its hardened copy"""
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(16)
+    sphere.SetPhiResolution(16)
+    sphere.Update()
+    model = sphere.GetOutput()
+    roi = vtk.vtkUnsignedCharArray()
+    roi.SetName("model_ROI")
+    roi.SetNumberOfTuples(model.GetNumberOfPoints())
+    roi.Fill(0)
+    model.GetPointData().AddArray(roi)
+    hardened = vtk.vtkPolyData()
+    hardened.ShallowCopy(model)
+    return model, hardened, roi
+
+
+class LocatorCacheTest(unittest.TestCase):
+
+    def test_roi_array_does_not_rebuild(self):
+        model, hardened, roi = hardenedSphere()
+        cache = meshes.LocatorCache()
+        locator = cache.getLocator("model", hardened)
+        snapshot = cache.getSnapshot("model", hardened)
+        mtime = hardened.GetMTime()
+        roi.SetValue(0, 1)
+        roi.Modified()
+        self.assertGreater(hardened.GetMTime(), mtime)
+        self.assertIs(cache.getLocator("model", hardened), locator)
+        self.assertIs(cache.getSnapshot("model", hardened), snapshot)
+        self.assertTrue(snapshot.isCurrent(hardened))
+
+    def test_points_rebuild(self):
+        model, hardened, roi = hardenedSphere()
+        cache = meshes.LocatorCache()
+        locator = cache.getLocator("model", hardened)
+        snapshot = cache.getSnapshot("model", hardened)
+        hardened.GetPoints().SetPoint(0, 0.0, 0.0, 2.0)
+        hardened.GetPoints().Modified()
+        self.assertFalse(snapshot.isCurrent(hardened))
+        self.assertIsNot(cache.getLocator("model", hardened), locator)
+        newSnapshot = cache.getSnapshot("model", hardened)
+        self.assertIsNot(newSnapshot, snapshot)
+        self.assertEqual(newSnapshot.findClosestPoint((0.0, 0.0, 1.9)), 0)
+
+    def test_replaced_points_rebuild(self):
+        model, hardened, roi = hardenedSphere()
+        cache = meshes.LocatorCache()
+        snapshot = cache.getSnapshot("model", hardened)
+        points = vtk.vtkPoints()
+        points.DeepCopy(hardened.GetPoints())
+        hardened.SetPoints(points)
+        self.assertFalse(snapshot.isCurrent(hardened))
+        self.assertIsNot(cache.getSnapshot("model", hardened), snapshot)
+
+
+def mixedMesh():
+    """Grid of 6 x 5 points covered by triangles, quads, a pentagon, a triangle strip and a line"""
+    points = vtk.vtkPoints()
+    for y in range(5):
+        for x in range(6):
+            points.InsertNextPoint(x, y, 0.0)
+    polys = vtk.vtkCellArray()
+    for cell in ([0, 1, 7], [0, 7, 6], [1, 2, 8, 7], [2, 3, 9, 8], [3, 4, 5, 11, 10, 9],
+                 [6, 7, 13, 12], [7, 8, 14, 13], [8, 9, 15, 14], [9, 10, 16, 15], [10, 11, 17], [10, 17, 16],
+                 [12, 13, 19, 18], [13, 14, 20, 19], [14, 15, 16, 22, 21, 20], [16, 17, 23, 22]):
+        polys.InsertNextCell(len(cell), cell)
+    strips = vtk.vtkCellArray()
+    strips.InsertNextCell(6, [18, 24, 19, 25, 20, 26])
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(4, [22, 27, 28, 29])
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(points)
+    polyData.SetPolys(polys)
+    polyData.SetStrips(strips)
+    polyData.SetLines(lines)
+    return polyData
+
+
+def connectedVertices(polyData, pointIDs):
+    """pointIDs and all the points of the cells that contain them, as AnglePlanesLogic.GetConnectedVertices"""
+    connected = set(pointIDs)
+    for pointID in pointIDs:
+        cellIDs = vtk.vtkIdList()
+        polyData.GetPointCells(pointID, cellIDs)
+        for i in range(cellIDs.GetNumberOfIds()):
+            cellPointIDs = vtk.vtkIdList()
+            polyData.GetCellPoints(cellIDs.GetId(i), cellPointIDs)
+            connected.update(cellPointIDs.GetId(j) for j in range(cellPointIDs.GetNumberOfIds()))
+    return connected
+
+
+class AdjacencyTest(unittest.TestCase):
+
+    def test_rings_match_connected_vertices(self):
+        polyData = mixedMesh()
+        polyData.BuildLinks()
+        indptr, indices = meshes.AdjacencyCache.computeAdjacency(polyData)
+        for pointID in range(polyData.GetNumberOfPoints()):
+            ROI = {pointID}
+            for numberOfRings in range(1, 5):
+                ROI = connectedVertices(polyData, ROI)
+                self.assertEqual(meshes.growROI(indptr, indices, pointID, numberOfRings).tolist(), sorted(ROI))
+
+    def test_quad_diagonals(self):
+        indptr, indices = meshes.AdjacencyCache.computeAdjacency(mixedMesh())
+        self.assertEqual(indices[indptr[1]:indptr[2]].tolist(), [0, 2, 7, 8])
+        self.assertIn(11, indices[indptr[3]:indptr[4]])
+
+    def test_cache(self):
+        polyData = mixedMesh()
+        cache = meshes.AdjacencyCache()
+        indptr, indices = cache.getAdjacency("model", polyData)
+        polyData.GetPointData().AddArray(vtk.vtkUnsignedCharArray())
+        self.assertIs(cache.getAdjacency("model", polyData)[1], indices)
+        polyData.GetLines().InsertNextCell(2, [0, 29])
+        polyData.GetLines().Modified()
+        indptr, indices = cache.getAdjacency("model", polyData)
+        self.assertIn(29, indices[indptr[0]:indptr[1]])
+
+    def test_no_cells(self):
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(vtk.vtkPoints())
+        polyData.GetPoints().InsertNextPoint(0.0, 0.0, 0.0)
+        indptr, indices = meshes.AdjacencyCache.computeAdjacency(polyData)
+        self.assertEqual(meshes.growROI(indptr, indices, 0, 3).tolist(), [0])
+
+
+if __name__ == "__main__":
+    unittest.main()
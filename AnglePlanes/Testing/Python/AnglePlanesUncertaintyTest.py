@@ -0,0 +1,142 @@
+"""Tests of AnglePlanesLib.uncertainty, with Python and NumPy only."""
+import os
+import sys
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from AnglePlanesLib import geometry, uncertainty
+
+# landmarks of three planes: A B C, D E F and the 5 landmarks A B D E G
+landmarks = numpy.array([[12.3, -4.1, 20.7], [-15.8, 7.2, 18.4], [3.6, 19.9, 25.2],
+                         [40.2, -11.5, -3.3], [28.7, 9.4, 30.1], [55.0, 2.8, 12.6], [1.7, 0.9, 22.0]])
+planes = [[0, 1, 2], [3, 4, 5], [0, 1, 3, 4, 6]]
+pairs = [(0, 1), (0, 2), (1, 2)]
+
+
+def measuredAngles():
+    """Angles of the pairs as batch.measureCase and the interface compute them"""
+    counts = numpy.array([len(plane) for plane in planes])
+    stacked = numpy.zeros((len(planes), counts.max(), 3))
+    mask = numpy.arange(counts.max()) < counts[:, numpy.newaxis]
+    stacked[mask] = landmarks[numpy.concatenate(planes)]
+    normals = geometry.measuredPlanes(stacked, mask)[0]
+    return normals, geometry.angleMatrices(normals)
+
+
+class LandmarkCovariancesTest(unittest.TestCase):
+
+    def test_covariances(self):
+        covariance = [[4.0, 1.0, 0.0], [1.0, 2.0, 0.0], [0.0, 0.0, 1.0]]
+        covariances = uncertainty.landmarkCovariances(4, 0.5, {1: 2.0, 2: 3.0}, {2: covariance})
+        self.assertEqual(covariances.shape, (4, 3, 3))
+        numpy.testing.assert_array_equal(covariances[0], numpy.eye(3) * 0.25)
+        numpy.testing.assert_array_equal(covariances[3], numpy.eye(3) * 0.25)
+        numpy.testing.assert_array_equal(covariances[1], numpy.eye(3) * 4.0)
+        # a full covariance overrides the standard deviation of its landmark
+        numpy.testing.assert_array_equal(covariances[2], covariance)
+        numpy.testing.assert_array_equal(uncertainty.landmarkCovariances(2), numpy.zeros((2, 3, 3)))
+
+    def test_samples_follow_covariances(self):
+        covariances = uncertainty.landmarkCovariances(3, 1.0, {1: 0.0}, {2: [[4.0, 1.0, 0.0], [1.0, 1.0, 0.0],
+                                                                          [0.0, 0.0, 0.0]]})
+        samples = uncertainty.sampleLandmarks(landmarks[:3], covariances, 20000, numpy.random.default_rng(0))
+        self.assertEqual(samples.shape, (20000, 3, 3))
+        numpy.testing.assert_allclose(samples.mean(axis=0), landmarks[:3], atol=0.05)
+        for i in range(3):
+            numpy.testing.assert_allclose(numpy.cov(samples[:, i].T), covariances[i], atol=0.1)
+        # a landmark with a null covariance (or a null direction) is not jittered
+        numpy.testing.assert_array_equal(samples[:, 1], numpy.broadcast_to(landmarks[1], (20000, 3)))
+        numpy.testing.assert_allclose(samples[:, 2, 2], landmarks[2, 2], atol=1e-12)
+
+
+class SummarizeTest(unittest.TestCase):
+
+    def test_summary(self):
+        values = numpy.arange(1.0, 101.0)
+        summary = uncertainty.summarize(values)
+        self.assertEqual(list(summary.keys()), ["mean", "sd", "p2.5", "p50", "p97.5"])
+        self.assertAlmostEqual(summary["mean"], 50.5)
+        self.assertAlmostEqual(summary["sd"], numpy.std(values, ddof=1))
+        self.assertAlmostEqual(summary["p2.5"], numpy.percentile(values, 2.5))
+        self.assertAlmostEqual(summary["p50"], 50.5)
+        self.assertAlmostEqual(summary["p97.5"], numpy.percentile(values, 97.5))
+
+    def test_undefined_values(self):
+        summary = uncertainty.summarize([1.0, numpy.nan, 3.0], (50,))
+        self.assertEqual(list(summary.items()), [("mean", 2.0), ("sd", numpy.sqrt(2.0)), ("p50", 2.0)])
+        self.assertTrue(all(numpy.isnan(value) for value in uncertainty.summarize([numpy.nan] * 3).values()))
+        self.assertEqual(uncertainty.summarize([7.25])["sd"], 0.0)
+
+    def test_identical_values(self):
+        value = 88.86455663498752
+        summary = uncertainty.summarize(numpy.full(1000, value))
+        self.assertEqual(summary["sd"], 0.0)
+        for name in ["mean", "p2.5", "p50", "p97.5"]:
+            self.assertEqual(summary[name], value)
+
+
+class AngleDistributionsTest(unittest.TestCase):
+
+    def test_constant_normals(self):
+        normals, angles = measuredAngles()
+        distributions = uncertainty.angleDistributions(numpy.tile(normals[0], (10, 1)), numpy.tile(normals[1], (10, 1)))
+        self.assertEqual(list(distributions.keys()), uncertainty.uncertaintyAngles)
+        for view, summary in distributions.items():
+            self.assertEqual(summary["mean"], angles[view][0, 1])
+            self.assertEqual(summary["sd"], 0.0)
+
+    def test_undefined_angles(self):
+        # the normals orthogonal to a view do not count in its distribution
+        normals1 = numpy.array([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+        normals2 = numpy.array([[0.0, 1.0, 0.0], [1.0, 1.0, 0.0], [1.0, 0.0, 0.0]])
+        distributions = uncertainty.angleDistributions(normals1, normals2, (50,))
+        self.assertTrue(numpy.isnan(distributions["RL"]["mean"]))
+        self.assertAlmostEqual(distributions["SI"]["mean"], 45.0)
+        self.assertAlmostEqual(distributions["3D"]["p50"], 45.0)
+
+
+class AngleUncertaintyTest(unittest.TestCase):
+
+    def test_zero_covariance_gives_measured_angles(self):
+        normals, angles = measuredAngles()
+        covariances = uncertainty.landmarkCovariances(len(landmarks))
+        distributions = uncertainty.angleUncertainty(landmarks, planes, pairs, covariances, samples=200, seed=3)
+        for (i, j), distribution in zip(pairs, distributions):
+            for view, summary in distribution.items():
+                self.assertEqual(summary["sd"], 0.0)
+                for name in ["mean", "p2.5", "p50", "p97.5"]:
+                    self.assertEqual(summary[name], angles[view][i, j])
+
+    def test_seed(self):
+        covariances = uncertainty.landmarkCovariances(len(landmarks), 1.0)
+        first = uncertainty.angleUncertainty(landmarks, planes, pairs, covariances, samples=500, seed=4)
+        second = uncertainty.angleUncertainty(landmarks, planes, pairs, covariances, samples=500, seed=4)
+        self.assertEqual(first, second)
+        normals, angles = measuredAngles()
+        for (i, j), distribution in zip(pairs, first):
+            summary = distribution["3D"]
+            self.assertGreater(summary["sd"], 0.0)
+            self.assertLess(summary["p2.5"], summary["p97.5"])
+            self.assertAlmostEqual(summary["p50"], angles["3D"][i, j], delta=3 * summary["sd"])
+
+    def test_projection(self):
+        # every sample projected back on the landmarks gives the measured angles
+        covariances = uncertainty.landmarkCovariances(len(landmarks), 2.0)
+        normals, angles = measuredAngles()
+        distributions = uncertainty.angleUncertainty(landmarks, planes, pairs, covariances, samples=50, seed=5,
+                                                     project=lambda positions: numpy.broadcast_to(landmarks,
+                                                                                                  positions.shape))
+        self.assertEqual(distributions[2]["AP"]["mean"], angles["AP"][1, 2])
+
+    def test_sample_normals_match_measured_planes(self):
+        positions = landmarks[numpy.newaxis]
+        normals = uncertainty.samplePlaneNormals(positions, planes)[0]
+        numpy.testing.assert_array_equal(normals, measuredAngles()[0])
+        # the triplets keep the truncated cross product of the interface
+        numpy.testing.assert_array_equal(normals[0], geometry.planeNormals(landmarks[planes[0]]))
+
+
+if __name__ == "__main__":
+    unittest.main()